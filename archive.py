@@ -0,0 +1,290 @@
+# archive.py ── Archivado de audit_logs e inventory_movements antiguos
+# =============================================================================
+# Con WAL, una transacción que escribe en la BD principal y en la adjunta no es
+# atómica entre ambas. Por eso cada lote va en dos commits: primero se copian al
+# archivo las filas que aún no están, y después se borran de la tabla caliente
+# solo las que ya figuran en el archivo (id + created_at). Si el proceso se
+# interrumpe entre los dos pasos, la siguiente ejecución termina el lote sin
+# duplicar nada.
+from __future__ import annotations
+
+import argparse
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Iterator, List, Optional
+
+from sqlalchemy import (
+    Column,
+    bindparam,
+    Index,
+    MetaData,
+    Table,
+    delete,
+    exists,
+    false,
+    func,
+    insert,
+    literal,
+    select,
+    true,
+    union_all,
+    update,
+)
+from sqlalchemy.engine import Connection
+
+from models import DB_PATH, AuditLog, InventoryMovement, engine
+
+ARCHIVE_PATH = DB_PATH.with_name("formulair_archive.db")
+OPENING_DESC = "Saldo de apertura (archivado)"
+
+_hot_audit = AuditLog.__table__
+_hot_mov = InventoryMovement.__table__
+
+
+def _archived(table: Table) -> Table:
+    """
+    Copia de la tabla en la BD adjunta ``archive``, sin FKs ni restricciones: SQLite
+    puede reutilizar ids borrados, así que ``id`` tampoco es clave primaria aquí.
+    """
+    return Table(
+        table.name,
+        _archive_meta,
+        *[Column(c.name, c.type) for c in table.columns],
+        schema="archive",
+    )
+
+
+_archive_meta = MetaData()
+audit_archive = _archived(_hot_audit)
+movement_archive = _archived(_hot_mov)
+Index("ix_arch_audit_entity", audit_archive.c.entity, audit_archive.c.entity_id)
+Index("ix_arch_mov_rm", movement_archive.c.raw_material_id, movement_archive.c.created_at)
+Index("ix_arch_audit_id", audit_archive.c.id)
+Index("ix_arch_mov_id", movement_archive.c.id)
+
+
+@dataclass(frozen=True)
+class ArchiveResult:
+    cutoff: datetime
+    audit_rows: int
+    movement_rows: int
+    opening_balances: int
+
+
+@contextmanager
+def attached(path: Path = ARCHIVE_PATH) -> Iterator[Connection]:
+    """Conexión con la BD de archivo adjunta como esquema ``archive``."""
+    with engine.connect() as conn:
+        conn.exec_driver_sql("ATTACH DATABASE ? AS archive", (str(path),))
+        try:
+            _archive_meta.create_all(conn)
+            for table in _archive_meta.tables.values():  # archivos creados antes que la columna o el índice
+                have = {r[1] for r in conn.exec_driver_sql(f"PRAGMA archive.table_info({table.name})")}
+                for col in table.columns:
+                    if col.name not in have:
+                        ddl = f"{col.name} {col.type.compile(dialect=conn.dialect)}"
+                        conn.exec_driver_sql(f"ALTER TABLE archive.{table.name} ADD COLUMN {ddl}")
+                for ix in table.indexes:
+                    ix.create(conn, checkfirst=True)
+            conn.commit()
+            yield conn
+        finally:
+            conn.rollback()
+            conn.exec_driver_sql("DETACH DATABASE archive")
+
+
+# ---------------------------------------------------------------------------#
+# Archivado por lotes
+# ---------------------------------------------------------------------------#
+
+
+def _next_batch(conn: Connection, table: Table, where, batch_size: int):
+    """
+    Condición que selecciona las ``batch_size`` primeras filas (por id) que cumplen
+    ``where``, acotada por rango de id para que SQLite recorra la clave primaria.
+    None cuando no queda nada.
+    """
+    first = select(table.c.id).where(where).order_by(table.c.id).limit(batch_size).subquery()
+    lo, hi = conn.execute(select(func.min(first.c.id), func.max(first.c.id))).one()
+    if hi is None:
+        return None
+    return where & table.c.id.between(lo, hi)
+
+
+def _in_archive(table: Table, arch: Table):
+    a = arch.alias("a")  # mismo nombre de tabla en los dos esquemas
+    return exists().where(a.c.id == table.c.id, a.c.created_at == table.c.created_at)
+
+
+def _copy_batch(conn: Connection, table: Table, arch: Table, batch):
+    """
+    Paso 1: copia al archivo las filas del lote que aún no tiene y lo confirma.
+    Devuelve la condición del paso 2 (las filas del lote ya archivadas).
+    """
+    archived = _in_archive(table, arch)
+    conn.execute(insert(arch).from_select(table.c.keys(), select(table).where(batch, ~archived)))
+    conn.commit()
+    return batch & archived
+
+
+def _archive_audit(conn: Connection, cutoff: datetime, batch_size: int) -> int:
+    moved = 0
+    old = _hot_audit.c.created_at < cutoff
+    while (batch := _next_batch(conn, _hot_audit, old, batch_size)) is not None:
+        done = _copy_batch(conn, _hot_audit, audit_archive, batch)
+        moved += conn.execute(delete(_hot_audit).where(done)).rowcount
+        conn.commit()
+    return moved
+
+
+def _archive_movements(conn: Connection, cutoff: datetime, batch_size: int) -> tuple[int, int]:
+    """
+    Mueve los movimientos anteriores a ``cutoff`` y acumula su suma en una fila de
+    saldo de apertura por materia, de modo que la suma de ``delta_g`` en la tabla
+    caliente siga cuadrando con ``RawMaterial.inventory_g``.
+    """
+    mv = _hot_mov
+    moved = 0
+    materials = set()
+    old = (mv.c.created_at < cutoff) & (mv.c.opening_balance == false())
+    while (batch := _next_batch(conn, mv, old, batch_size)) is not None:
+        done = _copy_batch(conn, mv, movement_archive, batch)
+        # paso 2, en una transacción de la BD principal: borrado + saldos de apertura
+        sums = dict(
+            conn.execute(
+                select(mv.c.raw_material_id, func.sum(mv.c.delta_g)).where(done).group_by(mv.c.raw_material_id)
+            ).all()
+        )
+        opening = {
+            rm_id: (mid, delta)
+            for mid, rm_id, delta in conn.execute(
+                # como mucho una fila por materia (índice parcial ix_mov_opening)
+                select(mv.c.id, mv.c.raw_material_id, mv.c.delta_g).where(mv.c.opening_balance == true())
+            )
+        }
+
+        moved += conn.execute(delete(mv).where(done)).rowcount
+
+        new, upd, gone = [], [], []
+        for rm_id, s in sums.items():
+            mid, prev = opening.get(rm_id, (None, 0.0))
+            total = prev + s
+            if abs(total) <= 1e-9:  # ck_delta_nonzero: saldo nulo → sin fila
+                if mid is not None:
+                    gone.append(mid)
+            elif mid is None:
+                new.append(
+                    dict(
+                        raw_material_id=rm_id,
+                        delta_g=total,
+                        description=OPENING_DESC,
+                        created_at=cutoff,
+                        opening_balance=True,
+                    )
+                )
+            else:
+                upd.append(dict(mid=mid, total=total))
+        if gone:
+            conn.execute(delete(mv).where(mv.c.id.in_(gone)))
+        if upd:
+            conn.execute(
+                update(mv).where(mv.c.id == bindparam("mid")).values(
+                    delta_g=bindparam("total"), created_at=cutoff
+                ),
+                upd,
+            )
+        if new:
+            conn.execute(insert(mv), new)
+        materials.update(sums)
+        conn.commit()
+    return moved, len(materials)
+
+
+def archive_old_rows(
+    days: int = 365, batch_size: int = 5000, path: Path = ARCHIVE_PATH
+) -> ArchiveResult:
+    """Archiva las filas con más de ``days`` días, en transacciones de ``batch_size``."""
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    with attached(path) as conn:
+        audit_rows = _archive_audit(conn, cutoff, batch_size)
+        mov_rows, openings = _archive_movements(conn, cutoff, batch_size)
+    return ArchiveResult(cutoff, audit_rows, mov_rows, openings)
+
+
+# ---------------------------------------------------------------------------#
+# Consultas (caliente + archivo)
+# ---------------------------------------------------------------------------#
+
+
+def movement_history(
+    raw_material_id: int, include_archive: bool = False, path: Path = ARCHIVE_PATH
+) -> List:
+    """
+    Movimientos de una materia por fecha. Sin archivo incluye la fila de saldo de
+    apertura; con archivo la sustituye por los movimientos archivados reales.
+    Cada fila trae ``archived`` (bool).
+    """
+    mv = _hot_mov
+    cols = [mv.c.id, mv.c.delta_g, mv.c.description, mv.c.created_at]
+    hot = select(*cols, literal(False).label("archived")).where(mv.c.raw_material_id == raw_material_id)
+    if not include_archive or not path.exists():
+        with engine.connect() as conn:
+            return conn.execute(hot.order_by(mv.c.created_at, mv.c.id)).all()
+
+    arch = movement_archive
+    cold = select(
+        arch.c.id, arch.c.delta_g, arch.c.description, arch.c.created_at, literal(True).label("archived")
+    ).where(arch.c.raw_material_id == raw_material_id)
+    both = union_all(cold, hot.where(mv.c.opening_balance == false())).subquery()
+    with attached(path) as conn:
+        return conn.execute(select(both).order_by(both.c.created_at, both.c.id)).all()
+
+
+def audit_history(
+    entity: Optional[str] = None,
+    entity_id: Optional[int] = None,
+    include_archive: bool = False,
+    path: Path = ARCHIVE_PATH,
+) -> List:
+    """Registros de auditoría (opcionalmente de una entidad) por fecha, con ``archived``."""
+
+    def _q(t: Table, archived: bool):
+        q = select(
+            t.c.id, t.c.user_id, t.c.action, t.c.entity, t.c.entity_id, t.c.created_at,
+            literal(archived).label("archived"),
+        )
+        if entity is not None:
+            q = q.where(t.c.entity == entity)
+        if entity_id is not None:
+            q = q.where(t.c.entity_id == entity_id)
+        return q
+
+    if not include_archive or not path.exists():
+        with engine.connect() as conn:
+            return conn.execute(_q(_hot_audit, False).order_by(_hot_audit.c.created_at)).all()
+    both = union_all(_q(audit_archive, True), _q(_hot_audit, False)).subquery()
+    with attached(path) as conn:
+        return conn.execute(select(both).order_by(both.c.created_at, both.c.id)).all()
+
+
+# ---------------------------------------------------------------------------#
+# CLI
+# ---------------------------------------------------------------------------#
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Archiva auditoría y movimientos antiguos.")
+    parser.add_argument("--days", type=int, default=365, help="Antigüedad mínima a archivar")
+    parser.add_argument("--batch", type=int, default=5000, help="Filas por transacción")
+    parser.add_argument("--archive", type=Path, default=ARCHIVE_PATH, help="BD de archivo")
+    parser.add_argument("--vacuum", action="store_true", help="Compacta la BD al terminar")
+    args = parser.parse_args()
+
+    res = archive_old_rows(args.days, args.batch, args.archive)
+    print(
+        f"Archivado hasta {res.cutoff:%Y-%m-%d}: {res.audit_rows} registros de auditoría, "
+        f"{res.movement_rows} movimientos ({res.opening_balances} saldos de apertura)."
+    )
+    if args.vacuum:
+        with engine.connect() as conn:
+            conn.exec_driver_sql("VACUUM")
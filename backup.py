@@ -0,0 +1,258 @@
+# backup.py ── Copias en caliente de la BD local (API de backup de SQLite)
+# =============================================================================
+from __future__ import annotations
+
+import argparse
+import gzip
+import re
+import shutil
+import sqlite3
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import List
+
+import events
+from models import DB_PATH, DataVersion, engine
+
+SNAPSHOT_DIR = DB_PATH.with_name("snapshots")
+_STAMP = "%Y%m%d-%H%M%S"
+_NAME_RE = re.compile(r"-(\d{8}-\d{6})(?:-\d+)?\.db(?:\.gz)?$")
+_CHUNK = 4 * 1024 * 1024
+
+
+@dataclass(frozen=True)
+class Snapshot:
+    path: Path
+    created_at: datetime
+    size_bytes: int
+
+
+@dataclass(frozen=True)
+class BackupResult:
+    path: Path
+    db_bytes: int
+    compressed_bytes: int
+    copy_seconds: float
+    compress_seconds: float
+
+    @property
+    def seconds(self) -> float:
+        return self.copy_seconds + self.compress_seconds
+
+    @property
+    def compressed(self) -> bool:
+        return self.path.suffix == ".gz"
+
+    def summary(self) -> str:
+        mb = self.db_bytes / 2**20
+        copy = f"copia {self.copy_seconds:.2f} s, {mb / max(self.copy_seconds, 1e-6):.0f} MB/s"
+        if not self.compressed:
+            return f"{self.path.name}: {mb:.1f} MB en {self.seconds:.2f} s ({copy})"
+        return (
+            f"{self.path.name}: {mb:.1f} MB → {self.compressed_bytes / 2**20:.1f} MB "
+            f"en {self.seconds:.2f} s ({copy}; compresión {self.compress_seconds:.2f} s)"
+        )
+
+
+def _copy_db(src: sqlite3.Connection, dst: sqlite3.Connection, pages: int, pause: float):
+    """
+    En modo WAL los lectores no bloquean a los escritores: basta un único paso.
+    Con diario clásico se copia por tramos de ``pages`` páginas para dejar
+    escribir al resto de conexiones entre paso y paso.
+    """
+    mode = src.execute("PRAGMA journal_mode").fetchone()[0].lower()
+    if mode == "wal":
+        src.backup(dst)
+        return
+
+    def _yield(status, remaining, total):
+        time.sleep(pause)
+
+    src.backup(dst, pages=pages, progress=_yield)
+
+
+# ---------------------------------------------------------------------------#
+# Instantáneas
+# ---------------------------------------------------------------------------#
+
+
+def take_snapshot(
+    dest_dir: Path = SNAPSHOT_DIR,
+    db_path: Path = DB_PATH,
+    pages: int = 4096,
+    pause: float = 0.005,
+    compress: bool = False,
+    level: int = 1,
+) -> BackupResult:
+    """
+    Copia consistente de la BD en caliente (``.db``). La copia va a la velocidad
+    del disco; con ``compress`` se guarda además comprimida con gzip (``.db.gz``,
+    varias veces más lenta de crear y de restaurar, pero ocupa mucho menos).
+    """
+    dest_dir.mkdir(parents=True, exist_ok=True)
+    stamp = datetime.now().strftime(_STAMP)
+    ext = ".db.gz" if compress else ".db"
+    out = dest_dir / f"{db_path.stem}-{stamp}{ext}"
+    n = 0
+    while out.exists():  # dos instantáneas en el mismo segundo
+        n += 1
+        out = dest_dir / f"{db_path.stem}-{stamp}-{n}{ext}"
+    raw = out.with_name(out.name + ".part")
+
+    t0 = time.perf_counter()
+    src = sqlite3.connect(f"{db_path.resolve().as_uri()}?mode=ro", uri=True, timeout=30)
+    dst = sqlite3.connect(raw)
+    try:
+        _copy_db(src, dst, pages, pause)
+    finally:
+        dst.close()
+        src.close()
+    t1 = time.perf_counter()
+    if not compress:
+        raw.replace(out)
+        size = out.stat().st_size
+        return BackupResult(out, size, size, t1 - t0, 0.0)
+
+    try:
+        gz = out.with_name(out.name + ".part.gz")
+        with raw.open("rb") as f_in, gzip.open(gz, "wb", compresslevel=level) as f_out:
+            shutil.copyfileobj(f_in, f_out, _CHUNK)
+        gz.replace(out)
+        db_bytes = raw.stat().st_size
+    finally:
+        raw.unlink(missing_ok=True)
+    t2 = time.perf_counter()
+
+    return BackupResult(out, db_bytes, out.stat().st_size, t1 - t0, t2 - t1)
+
+
+def list_snapshots(dest_dir: Path = SNAPSHOT_DIR) -> List[Snapshot]:
+    """Instantáneas disponibles, de la más reciente a la más antigua."""
+    out = []
+    for p in dest_dir.glob("*.db*"):
+        m = _NAME_RE.search(p.name)
+        if m:
+            out.append(Snapshot(p, datetime.strptime(m.group(1), _STAMP), p.stat().st_size))
+    out.sort(key=lambda sn: sn.created_at, reverse=True)
+    return out
+
+
+def prune_snapshots(
+    dest_dir: Path = SNAPSHOT_DIR,
+    keep_last: int = 7,
+    keep_daily: int = 14,
+    keep_weekly: int = 8,
+) -> List[Path]:
+    """
+    Rotación abuelo-padre-hijo: conserva las ``keep_last`` más recientes, la última
+    de cada uno de los ``keep_daily`` días y de las ``keep_weekly`` semanas previas.
+    Devuelve las rutas eliminadas.
+    """
+    snaps = list_snapshots(dest_dir)
+    keep = {sn.path for sn in snaps[:keep_last]}
+    now = datetime.now()
+    days, weeks = set(), set()
+    for sn in snaps:  # de más reciente a más antigua → primera de cada periodo
+        day = sn.created_at.date()
+        week = sn.created_at.isocalendar()[:2]
+        if now - sn.created_at <= timedelta(days=keep_daily) and day not in days:
+            days.add(day)
+            keep.add(sn.path)
+        if now - sn.created_at <= timedelta(weeks=keep_weekly) and week not in weeks:
+            weeks.add(week)
+            keep.add(sn.path)
+    removed = [sn.path for sn in snaps if sn.path not in keep]
+    for p in removed:
+        p.unlink(missing_ok=True)
+    return removed
+
+
+# ---------------------------------------------------------------------------#
+# Restauración
+# ---------------------------------------------------------------------------#
+
+
+def restore_snapshot(
+    snapshot: Path, db_path: Path = DB_PATH, safety_copy: bool = True, verify: bool = True
+) -> float:
+    """
+    Sustituye el contenido de la BD por el de la instantánea y devuelve los segundos
+    empleados. Antes de tocar nada se verifica la instantánea (en las ``.db``,
+    ``quick_check`` si ``verify``; en las ``.gz`` basta el CRC de gzip, que se
+    comprueba al descomprimir) y, por defecto, se guarda una copia sin comprimir
+    del estado actual.
+    """
+    t0 = time.perf_counter()
+    tmp = None
+    if snapshot.suffix == ".gz":
+        tmp = db_path.with_name(db_path.name + ".restore")
+        with gzip.open(snapshot, "rb") as f_in, tmp.open("wb") as f_out:
+            shutil.copyfileobj(f_in, f_out, _CHUNK)
+    source = tmp or snapshot
+    try:
+        # immutable: nadie más escribe en la instantánea (sin bloqueos ni -wal/-shm)
+        src = sqlite3.connect(f"{source.resolve().as_uri()}?mode=ro&immutable=1", uri=True)
+        try:
+            if verify and tmp is None:  # las .gz ya se han comprobado al descomprimir
+                ok = src.execute("PRAGMA quick_check").fetchone()[0]
+                if ok != "ok":
+                    raise ValueError(f"Instantánea dañada: {ok}")
+            if safety_copy and db_path.exists():
+                take_snapshot(db_path=db_path, dest_dir=snapshot.parent)
+            engine.dispose()  # cierra las conexiones del pool de este proceso
+            dst = sqlite3.connect(db_path, timeout=30)
+            try:
+                src.backup(dst)
+            finally:
+                dst.close()
+            # data_versions vuelve atrás con la copia: época nueva para que las
+            # huellas de informes (jobs.py) no coincidan con las de antes
+            with engine.begin() as conn:
+                DataVersion.__table__.create(conn, checkfirst=True)  # copias anteriores a la tabla
+                epoch = events.new_epoch(conn)
+            # en este proceso: catálogo, índice y pestañas de la GUI se releen enteros
+            events.publish(events.Change(events.EPOCH, events.UPDATE, frozenset(), epoch))
+        finally:
+            src.close()
+    finally:
+        if tmp is not None:
+            tmp.unlink(missing_ok=True)
+    return time.perf_counter() - t0
+
+
+# ---------------------------------------------------------------------------#
+# CLI
+# ---------------------------------------------------------------------------#
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Instantáneas locales de formulair.db")
+    parser.add_argument("--dir", type=Path, default=SNAPSHOT_DIR, help="Carpeta de instantáneas")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p_snap = sub.add_parser("snapshot", help="Crea una instantánea y aplica la rotación")
+    p_snap.add_argument("--gzip", action="store_true", help="Comprimida (más lenta, ocupa menos)")
+    p_snap.add_argument("--level", type=int, default=1, help="Nivel de gzip (1 = más rápido)")
+    sub.add_parser("list", help="Lista las instantáneas")
+    p_res = sub.add_parser("restore", help="Restaura una instantánea")
+    p_res.add_argument("path", type=Path)
+    p_res.add_argument("--no-verify", action="store_true", help="Sin quick_check (.db)")
+    p_pr = sub.add_parser("prune", help="Aplica la política de retención")
+    p_pr.add_argument("--keep-last", type=int, default=7)
+    p_pr.add_argument("--keep-daily", type=int, default=14)
+    p_pr.add_argument("--keep-weekly", type=int, default=8)
+    args = parser.parse_args()
+
+    if args.cmd == "snapshot":
+        res = take_snapshot(args.dir, compress=args.gzip, level=args.level)
+        print(res.summary())
+        for p in prune_snapshots(args.dir):
+            print("Eliminada", p.name)
+    elif args.cmd == "list":
+        for sn in list_snapshots(args.dir):
+            print(f"{sn.created_at:%Y-%m-%d %H:%M:%S}  {sn.size_bytes / 2**20:8.1f} MB  {sn.path.name}")
+    elif args.cmd == "restore":
+        secs = restore_snapshot(args.path, verify=not args.no_verify)
+        print(f"Restaurada {args.path.name} en {secs:.2f} s.")
+    elif args.cmd == "prune":
+        for p in prune_snapshots(args.dir, args.keep_last, args.keep_daily, args.keep_weekly):
+            print("Eliminada", p.name)
@@ -0,0 +1,340 @@
+# catalog.py ── Instantánea del catálogo en memoria (columnas NumPy + CSR)
+# =============================================================================
+# Materias en arrays por columna y entradas de la última revisión de cada
+# fórmula en una matriz CSR cuyas columnas son las filas de materias. Se
+# construye con una consulta por tabla y se actualiza por partes con las
+# notificaciones de ``events``; cada actualización publica una instantánea
+# nueva (copy-on-write), así que quien ya tiene una puede seguir leyéndola.
+# Cada lectura compara además data_versions con las versiones que refleja la
+# instantánea: si otro proceso ha escrito (o se ha restaurado una copia), se
+# relee lo afectado.
+from __future__ import annotations
+
+import sys
+import threading
+from dataclasses import dataclass
+from typing import Dict, Iterable, Optional, Set
+
+import numpy as np
+from scipy import sparse
+from sqlalchemy import select
+
+import events
+from composition import CompositionMatrix, load_composition
+from db import session_scope
+from dto import MaterialDTO
+from models import PyramidLevel, RawMaterial
+
+# Con más ids pendientes se relee la tabla entera en vez de filtrar con IN (…)
+PATCH_MAX = 5000
+# Entidades de data_versions que sigue la instantánea
+_TRACKED = ("RawMaterial", "Formula")
+
+LEVELS = tuple(PyramidLevel)  # código int8 → nivel de la pirámide
+_LEVEL_CODE = {lv: i for i, lv in enumerate(LEVELS)}
+
+
+@dataclass(frozen=True)
+class MaterialColumns:
+    """Materias por columnas: la posición ``r`` de cada campo es la misma materia."""
+
+    ids: np.ndarray  # int64
+    names: tuple  # str internados
+    categories: tuple  # str internados o None
+    cost_per_g: np.ndarray
+    inventory_g: np.ndarray
+    low_stock_threshold_g: np.ndarray
+    level: np.ndarray  # int8, índice en LEVELS
+    ifra_limit_pct: np.ndarray  # NaN = sin límite
+    row: Dict[int, int]  # id → posición
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def rows(self, ids: Iterable[int]) -> np.ndarray:
+        return np.fromiter((self.row[int(i)] for i in ids), dtype=np.int64)
+
+    def dto(self, r: int) -> MaterialDTO:
+        lim = self.ifra_limit_pct[r]
+        return MaterialDTO(
+            id=int(self.ids[r]),
+            name=self.names[r],
+            category=self.categories[r],
+            cost_per_g=float(self.cost_per_g[r]),
+            inventory_g=float(self.inventory_g[r]),
+            low_stock_threshold_g=float(self.low_stock_threshold_g[r]),
+            fragrance_pyramid_level=LEVELS[self.level[r]].value,
+            ifra_limit_pct=None if np.isnan(lim) else float(lim),
+        )
+
+    @property
+    def nbytes(self) -> int:
+        """Tamaño aproximado (arrays + tuplas + índice; las cadenas son compartidas)."""
+        arrays = (self.ids, self.cost_per_g, self.inventory_g, self.low_stock_threshold_g, self.level, self.ifra_limit_pct)
+        return (
+            sum(a.nbytes for a in arrays)
+            + sys.getsizeof(self.names)
+            + sys.getsizeof(self.categories)
+            + sys.getsizeof(self.row)
+        )
+
+
+_ARRAYS = ("ids", "cost_per_g", "inventory_g", "low_stock_threshold_g", "level", "ifra_limit_pct")
+_TUPLES = ("names", "categories")
+
+
+# Columnas que lee MaterialColumns.from_rows, en este orden
+MATERIAL_FIELDS = (
+    RawMaterial.id,
+    RawMaterial.name,
+    RawMaterial.category,
+    RawMaterial.cost_per_g,
+    RawMaterial.inventory_g,
+    RawMaterial.low_stock_threshold_g,
+    RawMaterial.fragrance_pyramid_level,
+    RawMaterial.ifra_limit_pct,
+)
+
+
+def _load_materials(ids: Optional[Iterable[int]] = None) -> MaterialColumns:
+    stmt = select(*MATERIAL_FIELDS).order_by(RawMaterial.id)
+    if ids is not None:
+        stmt = stmt.where(RawMaterial.id.in_(sorted(set(ids))))
+    with session_scope() as s:
+        rows = s.connection().execute(stmt).all()
+    return columns_from_rows(rows)
+
+
+def columns_from_rows(rows) -> MaterialColumns:
+    """MaterialColumns a partir de filas de ``select(*MATERIAL_FIELDS)``, en su orden."""
+    ids_, names, cats, cost, inv, thr, lvl, ifra = zip(*rows) if rows else ((),) * 8
+    return MaterialColumns(
+        ids=np.array(ids_, dtype=np.int64),
+        names=tuple(sys.intern(n) for n in names),
+        categories=tuple(sys.intern(c) if c else None for c in cats),
+        cost_per_g=np.array([c or 0.0 for c in cost], dtype=np.float64),
+        inventory_g=np.array([v or 0.0 for v in inv], dtype=np.float64),
+        low_stock_threshold_g=np.array([v or 0.0 for v in thr], dtype=np.float64),
+        level=np.array([_LEVEL_CODE.get(v, _LEVEL_CODE[PyramidLevel.MIDDLE]) for v in lvl], dtype=np.int8),
+        ifra_limit_pct=np.array([np.nan if v is None else v for v in ifra], dtype=np.float64),
+        row={int(i): r for r, i in enumerate(ids_)},
+    )
+
+
+def _patched(old: MaterialColumns, new: MaterialColumns) -> MaterialColumns:
+    """Copia de ``old`` con las filas de ``new``: sustituye las existentes y añade el resto al final."""
+    src_upd, dst_upd, src_app = [], [], []
+    for k, i in enumerate(new.ids.tolist()):
+        r = old.row.get(i)
+        if r is None:
+            src_app.append(k)
+        else:
+            src_upd.append(k)
+            dst_upd.append(r)
+    fields = {}
+    for f in _ARRAYS:
+        a = getattr(old, f).copy()
+        b = getattr(new, f)
+        a[dst_upd] = b[src_upd]
+        fields[f] = np.concatenate([a, b[src_app]])
+    for f in _TUPLES:
+        a = list(getattr(old, f))
+        b = getattr(new, f)
+        for k, r in zip(src_upd, dst_upd):
+            a[r] = b[k]
+        fields[f] = tuple(a) + tuple(b[k] for k in src_app)
+    row = dict(old.row)
+    row.update((int(new.ids[k]), len(old) + n) for n, k in enumerate(src_app))
+    return MaterialColumns(**fields, row=row)
+
+
+# ---------------------------------------------------------------------------#
+# Catálogo compartido
+# ---------------------------------------------------------------------------#
+
+
+class Catalog:
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._materials: Optional[MaterialColumns] = None
+        self._comp: Optional[CompositionMatrix] = None  # columnas = filas de _materials
+        self._dirty_materials: Set[int] = set()
+        self._dirty_formulas: Set[int] = set()
+        self._stale_materials = False  # cambios de otro proceso: se relee la tabla entera
+        self._versions: Dict[str, int] = {}  # data_versions que refleja la instantánea
+        events.subscribe(self._on_change)
+
+    def invalidate(self) -> None:
+        """Descarta la instantánea: la próxima lectura la reconstruye desde la BD."""
+        with self._lock:
+            self._materials = None
+            self._comp = None
+            self._dirty_materials.clear()
+            self._dirty_formulas.clear()
+            self._stale_materials = False
+            self._versions = {}
+
+    def _on_change(self, ch: events.Change) -> None:
+        if ch.entity not in _TRACKED:
+            return
+        with self._lock:
+            known = self._versions.get(ch.entity)
+            if known is not None and ch.version <= known:
+                return  # la instantánea ya se leyó después de este commit
+            gap = known is None or ch.version != known + 1  # otro proceso escribió por medio
+            self._versions[ch.entity] = ch.version
+            if ch.entity == "RawMaterial":
+                if ch.op == events.DELETE:  # las posiciones cambian: se reconstruye
+                    self._materials = None
+                    self._comp = None
+                elif gap:
+                    self._stale_materials = True
+                else:
+                    self._dirty_materials |= ch.ids
+            elif gap:
+                self._comp = None
+            else:
+                self._dirty_formulas |= ch.ids
+
+    def _sync(self) -> None:
+        """
+        Una consulta mínima por lectura: si data_versions no coincide con lo que
+        refleja la instantánea, otro proceso ha escrito y se relee lo afectado.
+        """
+        with session_scope() as s:
+            versions = events.data_versions(s.connection())
+        current = {e: versions.get(e, 0) for e in (events.EPOCH, *_TRACKED)}
+        if current == self._versions:
+            return
+        if current[events.EPOCH] != self._versions.get(events.EPOCH):  # BD restaurada o primera vez
+            self.invalidate()
+        else:
+            if current["RawMaterial"] != self._versions.get("RawMaterial"):
+                self._stale_materials = True
+            if current["Formula"] != self._versions.get("Formula"):
+                self._comp = None
+        self._versions = current
+
+    def materials(self, ids: Optional[Iterable[int]] = None) -> MaterialColumns:
+        """Instantánea de materias; con ``ids`` se cargan antes los que falten."""
+        with self._lock:
+            self._sync()
+            return self._current_materials(ids)
+
+    def _current_materials(self, ids: Optional[Iterable[int]] = None) -> MaterialColumns:
+        if self._stale_materials and self._materials is not None:
+            fresh = _load_materials()
+            if np.isin(self._materials.ids, fresh.ids).all():  # sin bajas: las posiciones se mantienen
+                self._materials = _patched(self._materials, fresh)
+                self._dirty_materials.clear()
+            else:
+                self._materials = None
+        self._stale_materials = False
+        if self._materials is None:
+            self._materials = _load_materials()
+            self._comp = None
+            self._dirty_materials.clear()
+        missing = set(self._dirty_materials)
+        if ids is not None:
+            missing.update(i for i in ids if i not in self._materials.row)
+        if missing:
+            fresh = _load_materials(missing if len(missing) <= PATCH_MAX else None)
+            self._materials = _patched(self._materials, fresh)
+            self._dirty_materials.clear()
+        return self._materials
+
+    def composition(self, formula_ids: Optional[Iterable[int]] = None) -> CompositionMatrix:
+        """
+        Última revisión de cada fórmula (o solo de ``formula_ids``) con una columna
+        por materia del catálogo, en el mismo orden que ``materials().ids``.
+        """
+        if formula_ids is not None:
+            formula_ids = sorted(set(formula_ids))  # puede ser un generador: se recorre una vez
+        with self._lock:
+            self._sync()
+            if self._comp is None and formula_ids is not None and len(formula_ids) <= PATCH_MAX:
+                # catálogo frío: solo esas fórmulas, sin cachear
+                comp = self._load_composition(formula_ids)
+                mats = self._current_materials()
+                return comp if comp.weights.shape[1] == len(mats) else _reshaped(comp, mats)
+            if self._comp is None:
+                self._comp = self._load_composition(None)
+                self._dirty_formulas.clear()
+            elif len(self._dirty_formulas) > PATCH_MAX:
+                self._comp = self._load_composition(None)
+                self._dirty_formulas.clear()
+            elif self._dirty_formulas:
+                dirty = np.fromiter(self._dirty_formulas, dtype=np.int64)
+                self._dirty_formulas.clear()
+                keep = np.flatnonzero(~np.isin(self._comp.formula_ids, dirty))
+                self._comp = _vstack(_rows(self._comp, keep), self._load_composition(dirty.tolist()))
+            mats = self._current_materials()
+            comp = self._comp
+            if comp.weights.shape[1] != len(mats):  # materias nuevas: columnas vacías
+                comp = _reshaped(comp, mats)
+                self._comp = comp
+        if formula_ids is None:
+            return comp
+        return _rows(comp, np.flatnonzero(np.isin(comp.formula_ids, formula_ids)))
+
+    def _load_composition(self, formula_ids) -> CompositionMatrix:
+        with session_scope() as s:
+            raw = load_composition(s, latest_only=True, formula_ids=formula_ids)
+        mats = self._current_materials(raw.material_ids.tolist())
+        cols = mats.rows(raw.material_ids.tolist())
+        shape = (len(raw.revision_ids), len(mats))
+
+        def remap(m: sparse.csr_matrix) -> sparse.csr_matrix:
+            m = m.tocoo()
+            return sparse.csr_matrix((m.data, (m.row, cols[m.col])), shape=shape)
+
+        return CompositionMatrix(
+            revision_ids=raw.revision_ids,
+            formula_ids=raw.formula_ids,
+            material_ids=mats.ids,
+            weights=remap(raw.weights),
+            active=remap(raw.active),
+        )
+
+
+def _rows(comp: CompositionMatrix, rows: np.ndarray) -> CompositionMatrix:
+    return CompositionMatrix(
+        revision_ids=comp.revision_ids[rows],
+        formula_ids=comp.formula_ids[rows],
+        material_ids=comp.material_ids,
+        weights=comp.weights[rows],
+        active=comp.active[rows],
+    )
+
+
+def _vstack(a: CompositionMatrix, b: CompositionMatrix) -> CompositionMatrix:
+    n_cols = max(a.weights.shape[1], b.weights.shape[1])
+    ids = a.material_ids if len(a.material_ids) >= len(b.material_ids) else b.material_ids
+
+    def stack(x, y):
+        x = sparse.csr_matrix((x.data, x.indices, x.indptr), shape=(x.shape[0], n_cols))
+        y = sparse.csr_matrix((y.data, y.indices, y.indptr), shape=(y.shape[0], n_cols))
+        return sparse.vstack([x, y], format="csr")
+
+    return CompositionMatrix(
+        revision_ids=np.concatenate([a.revision_ids, b.revision_ids]),
+        formula_ids=np.concatenate([a.formula_ids, b.formula_ids]),
+        material_ids=ids,
+        weights=stack(a.weights, b.weights),
+        active=stack(a.active, b.active),
+    )
+
+
+def _reshaped(comp: CompositionMatrix, mats: MaterialColumns) -> CompositionMatrix:
+    shape = (comp.weights.shape[0], len(mats))
+    w, a = comp.weights, comp.active
+    return CompositionMatrix(
+        revision_ids=comp.revision_ids,
+        formula_ids=comp.formula_ids,
+        material_ids=mats.ids,
+        weights=sparse.csr_matrix((w.data, w.indices, w.indptr), shape=shape),
+        active=sparse.csr_matrix((a.data, a.indices, a.indptr), shape=shape),
+    )
+
+
+catalog = Catalog()
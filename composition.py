@@ -0,0 +1,155 @@
+# composition.py ── Matriz de composición revisiones × materias (SciPy sparse)
+# =============================================================================
+from __future__ import annotations
+
+import re
+from dataclasses import dataclass
+from typing import Dict, Iterable, Optional, Sequence
+
+import numpy as np
+from scipy import sparse
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+from models import FormulaEntry, FormulaRevision
+
+_DIL_RE = re.compile(r"(\d+(?:[.,]\d+)?)\s*(%)?")
+
+
+def dilution_factor(dilution: Optional[str]) -> float:
+    """
+    Fracción de materia pura en una entrada: "10%", "10 % DPG" o "0.1" → 0.1.
+    Sin dilución (o ilegible) se considera materia pura (1.0).
+    """
+    if not dilution:
+        return 1.0
+    m = _DIL_RE.search(dilution)
+    if not m:
+        return 1.0
+    v = float(m.group(1).replace(",", "."))
+    if m.group(2) or v > 1:
+        v /= 100.0
+    return v if 0 < v <= 1 else 1.0
+
+
+def latest_revisions(formula_ids: Optional[Iterable[int]] = None):
+    """Subconsulta (formula_id, number) con la última revisión de cada fórmula."""
+    stmt = select(
+        FormulaRevision.formula_id,
+        func.max(FormulaRevision.number).label("number"),
+    )
+    if formula_ids is not None:
+        stmt = stmt.where(FormulaRevision.formula_id.in_(formula_ids))
+    return stmt.group_by(FormulaRevision.formula_id).subquery()
+
+
+def fetch_columns(s: Session, stmt) -> tuple:
+    """
+    Resultado de ``stmt`` por columnas (una tupla por columna), leído con el
+    cursor del driver: sin objetos Row ni procesadores de tipo de SQLAlchemy.
+    """
+    res = s.connection().execute(stmt)
+    try:
+        rows = res.cursor.fetchall()
+        return tuple(zip(*rows)) if rows else ((),) * len(res.keys())
+    finally:
+        res.close()
+
+
+_SEP = "\x1f"  # separador de group_concat para texto (no aparece en los datos)
+
+
+def fetch_arrays(s: Session, stmt, dtypes: Sequence) -> tuple:
+    """
+    Resultado de ``stmt`` por columnas: un array NumPy por cada ``dtype`` (una
+    lista de cadenas para ``str``). En SQLite cada columna llega como una única
+    cadena de ``group_concat``: cientos de miles de tuplas por fila dispararían
+    una y otra vez el recolector de ciclos. Las columnas numéricas no pueden ser
+    NULL (group_concat las omitiría); los textos NULL llegan como "".
+    """
+    if s.get_bind().dialect.name != "sqlite":
+        cols = fetch_columns(s, stmt)
+        return tuple(
+            list(c) if dt is str else np.fromiter(c, dtype=dt, count=len(c)) for c, dt in zip(cols, dtypes)
+        )
+    sub = stmt.subquery()
+    aggs = []
+    for col, dt in zip(sub.c, dtypes):
+        if dt is str:
+            aggs.append(func.group_concat(func.ifnull(col, ""), _SEP))
+        elif np.issubdtype(dt, np.floating):
+            aggs.append(func.group_concat(func.printf("%!.17g", col)))  # 17 cifras: sin pérdida
+        else:
+            aggs.append(func.group_concat(col))
+    row = s.connection().execute(select(*aggs)).one()
+    if row[0] is None:  # sin filas
+        return tuple([] if dt is str else np.empty(0, dtype=dt) for dt in dtypes)
+    return tuple(v.split(_SEP) if dt is str else np.fromstring(v, dtype=dt, sep=",") for v, dt in zip(row, dtypes))
+
+
+@dataclass(frozen=True)
+class CompositionMatrix:
+    revision_ids: np.ndarray  # una fila por revisión
+    formula_ids: np.ndarray  # fórmula de cada fila
+    material_ids: np.ndarray  # una columna por materia
+    weights: sparse.csr_matrix  # g de cada entrada (tal cual se pesa)
+    active: sparse.csr_matrix  # g de materia pura (peso × dilución)
+
+    @property
+    def total_weight(self) -> np.ndarray:
+        return np.asarray(self.weights.sum(axis=1)).ravel()
+
+    def material_index(self) -> Dict[int, int]:
+        return {int(m): i for i, m in enumerate(self.material_ids)}
+
+
+def load_composition(
+    s: Session,
+    latest_only: bool = True,
+    formula_ids: Optional[Iterable[int]] = None,
+    containing: Optional[Iterable[int]] = None,
+) -> CompositionMatrix:
+    """
+    Carga en una sola consulta las entradas de las revisiones (últimas o todas),
+    opcionalmente solo de las fórmulas indicadas o de las revisiones que usan
+    alguna de las materias de ``containing`` (con todas sus entradas).
+    """
+    stmt = select(
+        FormulaRevision.id,
+        FormulaRevision.formula_id,
+        FormulaEntry.raw_material_id,
+        FormulaEntry.weight_g,
+        FormulaEntry.dilution,
+    ).join(FormulaEntry, FormulaEntry.revision_id == FormulaRevision.id)
+    if formula_ids is not None:
+        formula_ids = sorted(set(formula_ids))
+    if latest_only:
+        last = latest_revisions(formula_ids)
+        stmt = stmt.join(
+            last,
+            (last.c.formula_id == FormulaRevision.formula_id)
+            & (last.c.number == FormulaRevision.number),
+        )
+    if formula_ids is not None:
+        stmt = stmt.where(FormulaRevision.formula_id.in_(formula_ids))
+    if containing is not None:
+        uses = select(FormulaEntry.revision_id).where(FormulaEntry.raw_material_id.in_(sorted(set(containing))))
+        stmt = stmt.where(FormulaRevision.id.in_(uses))
+    rev, form, mat, w, dils = fetch_arrays(s, stmt, (np.int64, np.int64, np.int64, np.float64, str))
+
+    factors: Dict[Optional[str], float] = {d: dilution_factor(d) for d in set(dils)}
+    dil = np.fromiter(map(factors.__getitem__, dils), dtype=np.float64, count=len(dils))
+
+    revision_ids, first, row_ix = np.unique(rev, return_index=True, return_inverse=True)
+    material_ids, col_ix = np.unique(mat, return_inverse=True)
+    shape = (len(revision_ids), len(material_ids))
+
+    weights = sparse.csr_matrix((w, (row_ix, col_ix)), shape=shape)
+    active = sparse.csr_matrix((w * dil, (row_ix, col_ix)), shape=shape)
+    return CompositionMatrix(
+        revision_ids=revision_ids,
+        formula_ids=form[first],
+        material_ids=material_ids,
+        weights=weights,
+        active=active,
+    )
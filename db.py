@@ -0,0 +1,106 @@
+# db.py ── Sesiones por hilo/tarea y cola de escritura para SQLite
+# =============================================================================
+from __future__ import annotations
+
+import contextvars
+import queue
+import threading
+from concurrent.futures import Future
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from typing import Callable, Iterator, Optional, TypeVar
+
+from sqlalchemy.orm import Session
+
+from models import SessionLocal, engine
+
+T = TypeVar("T")
+
+# SQLite admite un único escritor: serializamos las escrituras en un hilo propio
+SERIALIZE_WRITES = engine.dialect.name == "sqlite"
+
+# Sesión abierta por session_scope() en el hilo/tarea actual (contextvars)
+_active: ContextVar[Optional[Session]] = ContextVar("active_session", default=None)
+
+
+@contextmanager
+def session_scope() -> Iterator[Session]:
+    """
+    Sesión transaccional del hilo/tarea actual. Un session_scope() anidado reutiliza
+    la sesión exterior, de modo que todo se confirma en un único commit al salir.
+    """
+    outer = _active.get()
+    if outer is not None:
+        yield outer
+        return
+    s = SessionLocal()
+    token = _active.set(s)
+    try:
+        yield s
+        s.commit()
+    except Exception:
+        s.rollback()
+        raise
+    finally:
+        _active.reset(token)
+        s.close()
+
+
+# ---------------------------------------------------------------------------#
+# Cola de escritura
+# ---------------------------------------------------------------------------#
+
+
+class WriteQueue:
+    """
+    Hilo escritor único. Cada tarea se ejecuta con una copia del contexto de quien
+    la encola (usuario actual incluido), pero sin heredar su sesión abierta.
+    """
+
+    def __init__(self):
+        self._q: "queue.Queue[tuple]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def in_writer(self) -> bool:
+        return threading.current_thread() is self._thread
+
+    def submit(self, fn: Callable[..., T], *args, **kwargs) -> "Future[T]":
+        fut: Future = Future()
+        self._q.put((fut, contextvars.copy_context(), fn, args, kwargs))
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+                self._thread.start()
+        return fut
+
+    @staticmethod
+    def _call(fn, args, kwargs):
+        _active.set(None)
+        return fn(*args, **kwargs)
+
+    def _run(self):
+        while True:
+            fut, ctx, fn, args, kwargs = self._q.get()
+            if fut.set_running_or_notify_cancel():
+                try:
+                    fut.set_result(ctx.run(self._call, fn, args, kwargs))
+                except BaseException as e:
+                    fut.set_exception(e)
+            self._q.task_done()
+
+
+write_queue = WriteQueue()
+
+
+def writer(fn: Callable[..., T]) -> Callable[..., T]:
+    """Marca un servicio de escritura: en SQLite se ejecuta en la cola de escritura."""
+
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        if not SERIALIZE_WRITES or write_queue.in_writer():
+            return fn(*args, **kwargs)
+        return write_queue.submit(fn, *args, **kwargs).result()
+
+    return wrapper
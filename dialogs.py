@@ -21,7 +21,8 @@ from PyQt5.QtWidgets import (
 from PyQt5.QtCore import Qt
 
 import services
-from models import PyramidLevel, RawMaterial
+from dto import MaterialDTO
+from models import PyramidLevel
 
 
 # ---------------------------------------------------------------------------#
@@ -59,7 +60,10 @@ class RawMaterialDialog(QDialog):
 
         self.txt_name = QLineEdit()
         self.dsb_cost = QDoubleSpinBox(decimals=4, maximum=9999, suffix=" €/g")
-        self.dsb_ifra = QDoubleSpinBox(decimals=2, maximum=100, suffix=" %")
+        # un paso por debajo de 0 = sin límite; 0 % es un límite válido (materia prohibida)
+        self.dsb_ifra = QDoubleSpinBox(decimals=2, minimum=-1, maximum=100, suffix=" %")
+        self.dsb_ifra.setSpecialValueText("sin límite")
+        self.dsb_ifra.setValue(self.dsb_ifra.minimum())
         self.cbo_level = QComboBox()
         self.cbo_level.addItems([lvl.value for lvl in PyramidLevel])
         self.txt_notes = QTextEdit()
@@ -84,9 +88,9 @@ class RawMaterialDialog(QDialog):
             return dict(
                 name=self.txt_name.text().strip(),
                 cost_per_g=self.dsb_cost.value(),
-                ifra_limit_pct=self.dsb_ifra.value(),
+                ifra_limit_pct=None if self.dsb_ifra.value() < 0 else self.dsb_ifra.value(),
                 fragrance_pyramid_level=self.cbo_level.currentText(),
-                notes=self.txt_notes.toPlainText(),
+                notes=self.txt_notes.toPlainText().strip() or None,
             )
         return None
 
@@ -104,7 +108,7 @@ class FormulaDialog(QDialog):
         self.tbl = QTableWidget(0, 3)
         self.tbl.setHorizontalHeaderLabels(["Materia prima", "Peso g", "Dil ID"])
         self.tbl.horizontalHeader().setStretchLastSection(True)
-        self._materials: List[RawMaterial] = services.list_all(RawMaterial)
+        self._materials: List[MaterialDTO] = services.list_materials()
         self._add_row()
 
         btn_add_row = QPushButton("+ fila")
@@ -0,0 +1,77 @@
+# dto.py ── Objetos inmutables que devuelven los servicios (sin estado ORM)
+# =============================================================================
+from __future__ import annotations
+
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Optional
+
+from models import FormulaRevision, RawMaterial
+
+
+@dataclass(frozen=True, slots=True)
+class MaterialDTO:
+    id: int
+    name: str
+    category: Optional[str]
+    cost_per_g: float
+    inventory_g: float
+    low_stock_threshold_g: float
+    fragrance_pyramid_level: str
+    ifra_limit_pct: Optional[float]
+
+    @classmethod
+    def from_orm(cls, rm: RawMaterial) -> "MaterialDTO":
+        return cls(
+            id=rm.id,
+            name=rm.name,
+            category=rm.category,
+            cost_per_g=rm.cost_per_g,
+            inventory_g=rm.inventory_g,
+            low_stock_threshold_g=rm.low_stock_threshold_g,
+            fragrance_pyramid_level=rm.fragrance_pyramid_level.value,
+            ifra_limit_pct=rm.ifra_limit_pct,
+        )
+
+
+@dataclass(frozen=True, slots=True)
+class RevisionDTO:
+    id: int
+    formula_id: int
+    number: int
+    created_at: datetime
+    author: str
+    comment: Optional[str]
+
+    @classmethod
+    def from_orm(cls, rev: FormulaRevision) -> "RevisionDTO":
+        return cls(rev.id, rev.formula_id, rev.number, rev.created_at, rev.author, rev.comment)
+
+
+@dataclass(frozen=True, slots=True)
+class RevisionStatsDTO:
+    """Fila del historial: revisión con sus totales ya agregados en SQL."""
+
+    id: int
+    number: int
+    created_at: datetime
+    author: str
+    comment: Optional[str]
+    entry_count: int
+    total_weight_g: float
+    cost_estimate: float
+
+
+@dataclass(frozen=True, slots=True)
+class FormulaDTO:
+    id: int
+    name: str
+    description: Optional[str]
+    category: Optional[str]
+    latest_revision: Optional[RevisionDTO]
+    revision_count: int
+    total_weight_g: float  # de la última revisión
+    cost_estimate: float  # de la última revisión
+
+    def latest(self) -> Optional[RevisionDTO]:
+        return self.latest_revision
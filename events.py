@@ -0,0 +1,166 @@
+# events.py ── Bus de notificación de cambios (tras cada commit)
+# =============================================================================
+# Las sesiones ORM anotan en cada flush qué filas se han insertado, modificado o
+# borrado; al confirmar la transacción se publica un Change por entidad y
+# operación. Si se hace rollback no se publica nada. Sin dependencia de Qt:
+# la GUI reenvía las notificaciones a su hilo con una señal.
+#
+# Además, en la misma transacción se incrementa DataVersion de cada entidad
+# modificada: una versión persistente que también ven otros procesos (jobs.py).
+# Cada Change lleva la versión resultante, así que un suscriptor con estado
+# puede saber si ha visto todos los cambios o si otro proceso se le adelantó.
+# Restaurar una copia hace retroceder los contadores; la fila EPOCH (al azar en
+# cada restauración) distingue la BD restaurada de la que había, y en el proceso
+# que restaura se publica un Change con entidad EPOCH: todo se relee entero.
+from __future__ import annotations
+
+import secrets
+import threading
+import traceback
+from dataclasses import dataclass
+from typing import Callable, Dict, FrozenSet, Iterable, List, Set, Tuple
+
+from sqlalchemy import delete, event, insert, select, update
+from sqlalchemy.engine import Connection
+from sqlalchemy.orm import Session
+
+from models import DataVersion, SessionLocal
+
+INSERT, UPDATE, DELETE = "insert", "update", "delete"
+
+# Hijos cuyo cambio se notifica como modificación del padre (entidad, atributo)
+_ROLLUP = {"FormulaRevision": ("Formula", "formula_id")}
+_KEY = "pending_changes"
+_VERSIONS_KEY = "bumped_versions"
+EPOCH = "_epoch"  # fila de data_versions que no es una entidad
+
+
+@dataclass(frozen=True)
+class Change:
+    entity: str  # nombre de la clase ORM, p. ej. "RawMaterial"
+    op: str  # INSERT | UPDATE | DELETE
+    ids: FrozenSet[int]
+    version: int = 0  # DataVersion de la entidad tras este commit
+
+
+Subscriber = Callable[[Change], None]
+_subscribers: List[Subscriber] = []
+_lock = threading.Lock()
+
+
+def subscribe(fn: Subscriber) -> Callable[[], None]:
+    """Registra ``fn``; devuelve la función que cancela la suscripción."""
+    with _lock:
+        _subscribers.append(fn)
+
+    def unsubscribe():
+        with _lock:
+            if fn in _subscribers:
+                _subscribers.remove(fn)
+
+    return unsubscribe
+
+
+def publish(change: Change) -> None:
+    """
+    Llama a los suscriptores en el hilo que confirmó la transacción. Un suscriptor
+    que falla no impide notificar al resto (los datos ya están confirmados).
+    """
+    with _lock:
+        subs = list(_subscribers)
+    for fn in subs:
+        try:
+            fn(change)
+        except Exception:
+            traceback.print_exc()
+
+
+def record(s: Session, entity: str, op: str, ids: Iterable[int]) -> None:
+    """
+    Anota cambios hechos sin pasar por el ORM (``insert``/``update`` de Core en
+    bloque) para publicarlos con el próximo commit de ``s``.
+    """
+    _pending(s).setdefault((entity, op), set()).update(int(i) for i in ids)
+
+
+def data_versions(conn: Connection) -> Dict[str, int]:
+    """Versión actual de cada entidad que ha cambiado alguna vez (las demás valen 0)."""
+    dv = DataVersion.__table__
+    return dict(conn.execute(select(dv.c.entity, dv.c.version)).tuples().all())
+
+
+def new_epoch(conn: Connection) -> int:
+    """Época nueva para la BD (tras restaurar una copia); no hace commit."""
+    dv = DataVersion.__table__
+    epoch = secrets.randbits(31)
+    conn.execute(delete(dv).where(dv.c.entity == EPOCH))
+    conn.execute(insert(dv).values(entity=EPOCH, version=epoch))
+    return epoch
+
+
+def _bump(conn: Connection, entities: Iterable[str]) -> Dict[str, int]:
+    """Incrementa la versión de ``entities`` y devuelve las nuevas (aún sin confirmar)."""
+    dv = DataVersion.__table__
+    entities = sorted(entities)  # mismo orden en todos los procesos
+    for entity in entities:
+        res = conn.execute(update(dv).where(dv.c.entity == entity).values(version=dv.c.version + 1))
+        if not res.rowcount:
+            conn.execute(insert(dv).values(entity=entity, version=1))
+    return dict(conn.execute(select(dv.c.entity, dv.c.version).where(dv.c.entity.in_(entities))).tuples().all())
+
+
+def _pending(s: Session) -> Dict[Tuple[str, str], Set[int]]:
+    return s.info.setdefault(_KEY, {})
+
+
+# ---------------------------------------------------------------------------#
+# Eventos de sesión
+# ---------------------------------------------------------------------------#
+
+
+@event.listens_for(SessionLocal, "after_flush")
+def _collect(s: Session, _ctx) -> None:
+    pending = _pending(s)
+    for op, objs in (
+        (INSERT, s.new),
+        (UPDATE, (o for o in s.dirty if s.is_modified(o, include_collections=False))),
+        (DELETE, s.deleted),
+    ):
+        for obj in objs:
+            name = type(obj).__name__
+            if name in _ROLLUP:
+                parent, attr = _ROLLUP[name]
+                pending.setdefault((parent, UPDATE), set()).add(getattr(obj, attr))
+            elif getattr(obj, "id", None) is not None:
+                pending.setdefault((name, op), set()).add(obj.id)
+
+
+@event.listens_for(SessionLocal, "before_commit")
+def _bump_versions(s: Session) -> None:
+    s.flush()  # lo aún no volcado también cuenta (y pasa por _collect)
+    pending = s.info.get(_KEY)
+    if pending:
+        s.info[_VERSIONS_KEY] = _bump(s.connection(), {entity for (entity, _op), ids in pending.items() if ids})
+
+
+@event.listens_for(SessionLocal, "after_commit")
+def _flush_pending(s: Session) -> None:
+    pending = s.info.pop(_KEY, None)
+    versions = s.info.pop(_VERSIONS_KEY, {})
+    if not pending:
+        return
+    by_entity: Dict[str, Dict[str, Set[int]]] = {}
+    for (entity, op), ids in pending.items():
+        by_entity.setdefault(entity, {})[op] = ids
+    for entity, ops in by_entity.items():
+        # una fila creada o borrada en la misma transacción no se notifica además como modificada
+        upd = ops.get(UPDATE, set()) - ops.get(INSERT, set()) - ops.get(DELETE, set())
+        for op, ids in ((INSERT, ops.get(INSERT)), (UPDATE, upd), (DELETE, ops.get(DELETE))):
+            if ids:
+                publish(Change(entity, op, frozenset(ids), versions.get(entity, 0)))
+
+
+@event.listens_for(SessionLocal, "after_soft_rollback")
+def _discard(s: Session, _previous_transaction) -> None:
+    s.info.pop(_KEY, None)
+    s.info.pop(_VERSIONS_KEY, None)
@@ -3,39 +3,191 @@
 from __future__ import annotations
 
 import csv
+import sys
+from contextlib import contextmanager
 from pathlib import Path
-from typing import List
+from typing import Iterable, List, Optional
 
 from reportlab.graphics import renderPDF
 from reportlab.graphics.shapes import Drawing, Polygon, String
 from reportlab.lib.pagesizes import A4
 from reportlab.pdfgen import canvas
 
+import forecast
 import services
-from models import RawMaterial, Formula
+from catalog import LEVELS, catalog
+from compliance import violations_by_formula
+from mrp import MaterialRequirement
+from pricing import PriceImpact
+from stocktake import StockDiscrepancy
+from substitution import SubstitutionImpact
+from dto import FormulaDTO, MaterialDTO
+from models import Formula
 
 # ---------------------------------------------------------------------------#
 # CSV
 # ---------------------------------------------------------------------------#
-def export_materials_csv(path: Path):
-    headers = ["id", "name", "category", "cost_per_g", "inventory_g", "ifra_limit_pct"]
-    rows: List[RawMaterial] = services.list_all(RawMaterial)
+@contextmanager
+def _csv_writer(path: Optional[Path]):
+    """Escritor CSV sobre ``path``; sin ruta escribe en la salida estándar (CLI)."""
+    if path is None:
+        yield csv.writer(sys.stdout)
+        return
     with path.open("w", newline="", encoding="utf-8") as f:
-        wr = csv.writer(f)
+        yield csv.writer(f)
+
+
+def export_materials_csv(path: Optional[Path]):
+    headers = ["id", "name", "category", "cost_per_g", "inventory_g", "ifra_limit_pct"]
+    rows: List[MaterialDTO] = services.list_materials()
+    with _csv_writer(path) as wr:
         wr.writerow(headers)
         for rm in rows:
             wr.writerow([getattr(rm, h) for h in headers])
 
 
-def export_formulas_csv(path: Path):
-    headers = ["id", "name", "category", "total_weight_g", "cost_estimate"]
-    rows: List[Formula] = services.list_formulas()
-    with path.open("w", newline="", encoding="utf-8") as f:
-        wr = csv.writer(f)
+def export_low_stock_csv(path: Optional[Path]):
+    headers = ["id", "name", "category", "inventory_g", "low_stock_threshold_g", "cost_per_g"]
+    with _csv_writer(path) as wr:
+        wr.writerow(headers)
+        for rm in services.low_stock_alerts():
+            wr.writerow([getattr(rm, h) for h in headers])
+
+
+def export_formulas_csv(path: Optional[Path]):
+    headers = ["id", "name", "category", "total_weight_g", "cost_estimate", "ifra_violations"]
+    rows: List[FormulaDTO] = services.list_formulas()
+    ifra = violations_by_formula(services.ifra_violations())
+    with _csv_writer(path) as wr:
         wr.writerow(headers)
         for fo in rows:
-            rev = fo.latest()
-            wr.writerow([fo.id, fo.name, fo.category, rev.total_weight(), rev.cost_estimate()])
+            wr.writerow(
+                [fo.id, fo.name, fo.category, fo.total_weight_g, fo.cost_estimate, ifra.get(fo.id, 0)]
+            )
+
+
+def export_ifra_report_csv(path: Optional[Path]):
+    headers = [
+        "formula_id",
+        "formula_name",
+        "revision_id",
+        "product_category",
+        "raw_material_id",
+        "material_name",
+        "concentration_pct",
+        "limit_pct",
+    ]
+    with _csv_writer(path) as wr:
+        wr.writerow(headers)
+        for v in services.ifra_violations():
+            wr.writerow([getattr(v, h) for h in headers])
+
+
+def export_price_impact_csv(impacts: Iterable[PriceImpact], path: Optional[Path]):
+    headers = [
+        "formula_id",
+        "formula_name",
+        "revision_number",
+        "old_cost",
+        "new_cost",
+        "delta",
+        "delta_pct",
+    ]
+    with _csv_writer(path) as wr:
+        wr.writerow(headers)
+        for imp in impacts:
+            wr.writerow(
+                [
+                    imp.formula_id,
+                    imp.formula_name,
+                    imp.revision_number,
+                    round(imp.old_cost, 4),
+                    round(imp.new_cost, 4),
+                    round(imp.delta, 4),
+                    round(imp.delta_pct, 2),
+                ]
+            )
+
+
+def export_requirements_csv(reqs: Iterable[MaterialRequirement], path: Optional[Path]):
+    headers = [
+        "raw_material_id",
+        "name",
+        "required_g",
+        "inventory_g",
+        "low_stock_threshold_g",
+        "shortage_g",
+        "purchase_g",
+        "purchase_cost",
+    ]
+    with _csv_writer(path) as wr:
+        wr.writerow(headers)
+        for r in reqs:
+            wr.writerow([getattr(r, h) for h in headers])
+
+
+def export_stocktake_csv(discrepancies: Iterable[StockDiscrepancy], path: Optional[Path]):
+    headers = ["raw_material_id", "name", "inventory_g", "counted_g", "delta_g", "cost_per_g", "value"]
+    with _csv_writer(path) as wr:
+        wr.writerow(headers)
+        for d in discrepancies:
+            wr.writerow([getattr(d, h) for h in headers])
+
+
+def export_substitution_csv(impacts: Iterable[SubstitutionImpact], path: Optional[Path]):
+    headers = [
+        "formula_id",
+        "formula_name",
+        "revision_number",
+        "new_revision_id",
+        "old_cost",
+        "new_cost",
+        "delta",
+        "delta_pct",
+    ]
+    with _csv_writer(path) as wr:
+        wr.writerow(headers)
+        for imp in impacts:
+            wr.writerow(
+                [
+                    imp.formula_id,
+                    imp.formula_name,
+                    imp.revision_number,
+                    imp.new_revision_id,
+                    round(imp.old_cost, 4),
+                    round(imp.new_cost, 4),
+                    round(imp.delta, 4),
+                    round(imp.delta_pct, 2),
+                ]
+            )
+
+
+FORECAST_HEADERS = [
+    "raw_material_id",
+    "name",
+    "inventory_g",
+    "rate_g_day",
+    "recent_rate_g_day",
+    "days_to_stockout",
+    "stockout_date",
+    "low_stock_threshold_g",
+    "suggested_threshold_g",
+]
+
+
+def export_forecast_csv(path: Optional[Path], window_days: int = forecast.WINDOW_DAYS):
+    with _csv_writer(path) as wr:
+        wr.writerow(FORECAST_HEADERS)
+        for fc in services.stock_forecast(window_days=window_days):
+            wr.writerow([getattr(fc, h) for h in FORECAST_HEADERS])
+
+
+def export_duplicates_csv(path: Optional[Path], threshold: float = 0.98):
+    headers = ["formula_a_id", "formula_a", "formula_b_id", "formula_b", "score"]
+    with _csv_writer(path) as wr:
+        wr.writerow(headers)
+        for p in services.duplicate_report(threshold):
+            wr.writerow([getattr(p, h) for h in headers])
 
 
 # ---------------------------------------------------------------------------#
@@ -58,7 +210,7 @@ def _draw_table(c: canvas.Canvas, headers, data, x=40, y=780, line_h=16):
 
 
 def export_materials_pdf(path: Path):
-    rows = services.list_all(RawMaterial)
+    rows = services.list_materials()
     data = [[rm.id, rm.name, rm.category, rm.cost_per_g] for rm in rows]
     c = canvas.Canvas(str(path), pagesize=A4)
     _draw_table(c, ["ID", "Nombre", "Categoría", "€/g"], data)
@@ -69,12 +221,34 @@ def export_materials_pdf(path: Path):
 # Pirámide olfativa
 # ---------------------------------------------------------------------------#
 def export_formula_pyramid_pdf(formula: Formula, path: Path):
-    width, height = 300, 500
-    d = Drawing(width, height)
-    colors = ("#f9d423", "#f56991", "#8e44ad")
     levels = {"top": [], "middle": [], "base": []}
     for e in formula.entries:
         levels[e.raw_material.fragrance_pyramid_level.value].append(e.raw_material.name)
+    renderPDF.drawToFile(_pyramid_drawing(levels), str(path))
+
+
+def export_pyramid_catalogue_pdf(path: Path):
+    """Una página por fórmula (por nombre) con la pirámide de su última revisión."""
+    comp, mats = catalog.composition(), catalog.materials()
+    with services.session_scope() as s:
+        names = dict(s.query(Formula.id, Formula.name).all())
+    w = comp.weights
+    c = canvas.Canvas(str(path), pagesize=A4)
+    for r in sorted(range(len(comp.formula_ids)), key=lambda r: names.get(int(comp.formula_ids[r]), "")):
+        levels = {"top": [], "middle": [], "base": []}
+        for col in w.indices[w.indptr[r] : w.indptr[r + 1]].tolist():
+            levels[LEVELS[mats.level[col]].value].append(mats.names[col])
+        c.setFont("Helvetica-Bold", 14)
+        c.drawString(40, 800, names.get(int(comp.formula_ids[r]), ""))
+        renderPDF.draw(_pyramid_drawing(levels), c, 150, 250)
+        c.showPage()
+    c.save()
+
+
+def _pyramid_drawing(levels: dict) -> Drawing:
+    width, height = 300, 500
+    d = Drawing(width, height)
+    colors = ("#f9d423", "#f56991", "#8e44ad")
 
     y0 = 450
     for i, (lvl, names) in enumerate(levels.items()):
@@ -94,5 +268,4 @@ def export_formula_pyramid_pdf(formula: Formula, path: Path):
         )
         txt = ", ".join(names) if names else "-"
         d.add(String(150, y0 - i * 120 - 40, txt, textAnchor="middle"))
-
-    renderPDF.drawToFile(d, str(path))
+    return d
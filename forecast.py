@@ -0,0 +1,131 @@
+# forecast.py ── Previsión de consumo y días hasta la rotura de stock
+# =============================================================================
+# Los consumos (salidas de tipo CONSUMPTION; ni ajustes manuales, ni recuentos,
+# ni saldos de apertura) se agregan por materia y día en una sola consulta
+# agrupada; el resto es una pasada NumPy sobre la matriz materias × días.
+from __future__ import annotations
+
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
+from typing import TYPE_CHECKING, Iterable, List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy import false, func, select
+from sqlalchemy.orm import Session
+
+from models import InventoryMovement, MovementKind
+
+if TYPE_CHECKING:
+    from catalog import MaterialColumns
+
+WINDOW_DAYS = 30  # consumo medio de referencia
+RECENT_DAYS = 7  # consumo reciente (detecta aceleraciones)
+LEAD_TIME_DAYS = 14  # plazo de reposición para el umbral sugerido
+SERVICE_Z = 1.65  # ≈ 95 % de nivel de servicio
+
+
+@dataclass(frozen=True)
+class StockForecast:
+    raw_material_id: int
+    name: str
+    inventory_g: float
+    low_stock_threshold_g: float
+    rate_g_day: float  # media de la ventana
+    recent_rate_g_day: float  # media de los últimos RECENT_DAYS
+    days_to_stockout: float  # con el mayor de los dos ritmos
+    suggested_threshold_g: float  # consumo en el plazo de reposición + stock de seguridad
+
+    @property
+    def stockout_date(self) -> date:
+        return date.today() + timedelta(days=int(self.days_to_stockout))
+
+
+def daily_consumption(
+    s: Session, days: int, until: date, ids: Optional[Iterable[int]] = None
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Consumo diario (g) de los ``days`` días anteriores a ``until``: ids de las
+    materias con consumo y matriz (materia × día, el último día a la derecha).
+    """
+    mv = InventoryMovement.__table__
+    start = until - timedelta(days=days)
+    day = func.date(mv.c.created_at)
+    stmt = (
+        select(mv.c.raw_material_id, day, -func.sum(mv.c.delta_g))
+        .where(
+            mv.c.delta_g < 0,
+            mv.c.kind == MovementKind.CONSUMPTION,
+            mv.c.opening_balance == false(),
+            mv.c.created_at >= datetime.combine(start, datetime.min.time()),
+            mv.c.created_at < datetime.combine(until, datetime.min.time()),
+        )
+        .group_by(mv.c.raw_material_id, day)
+    )
+    if ids is not None:
+        stmt = stmt.where(mv.c.raw_material_id.in_(list(ids)))
+    rows = s.connection().execute(stmt).all()
+    if not rows:
+        return np.zeros(0, dtype=np.int64), np.zeros((0, days))
+    rm_ids, days_str, grams = zip(*rows)
+    col = (np.array([str(d)[:10] for d in days_str], dtype="datetime64[D]") - np.datetime64(start, "D")).astype(int)
+    ids_arr, row = np.unique(np.array(rm_ids, dtype=np.int64), return_inverse=True)
+    m = np.zeros((len(ids_arr), days))
+    np.add.at(m, (row, col), np.array(grams, dtype=np.float64))
+    return ids_arr, m
+
+
+def forecast(
+    s: Session,
+    materials: MaterialColumns,
+    ids: Optional[Iterable[int]] = None,
+    window_days: int = WINDOW_DAYS,
+    recent_days: int = RECENT_DAYS,
+    lead_time_days: int = LEAD_TIME_DAYS,
+    until: Optional[date] = None,
+) -> List[StockForecast]:
+    """
+    Ritmo de consumo, días hasta agotar el stock y umbral sugerido de las materias
+    con consumo en la ventana (o solo de ``ids``), de menos a más días. Los días
+    usan el mayor de los ritmos de la ventana y reciente, para avisar antes.
+    """
+    if not 0 < recent_days <= window_days:
+        raise ValueError(f"Días recientes no válidos: {recent_days} (de 1 a {window_days}, la ventana)")
+    until = until or date.today() + timedelta(days=1)
+    rm_ids, m = daily_consumption(s, window_days, until, ids)
+    known = np.isin(rm_ids, materials.ids)
+    rm_ids, m = rm_ids[known], m[known]
+    if not len(rm_ids):
+        return []
+    rows = materials.rows(rm_ids)
+    inv = materials.inventory_g[rows]
+
+    rate = m.sum(axis=1) / window_days
+    recent = m[:, -recent_days:].sum(axis=1) / recent_days
+    pace = np.maximum(rate, recent)
+    days = np.divide(inv, pace, out=np.full(len(pace), np.inf), where=pace > 0)
+    days = np.maximum(days, 0.0)
+    suggested = rate * lead_time_days + SERVICE_Z * m.std(axis=1) * np.sqrt(lead_time_days)
+
+    order = np.argsort(days, kind="stable")
+    return [
+        StockForecast(
+            raw_material_id=rm_id,
+            name=materials.names[r],
+            inventory_g=i,
+            low_stock_threshold_g=t,
+            rate_g_day=ra,
+            recent_rate_g_day=re,
+            days_to_stockout=d,
+            suggested_threshold_g=su,
+        )
+        for rm_id, r, i, t, ra, re, d, su in zip(
+            rm_ids[order].tolist(),
+            rows[order].tolist(),
+            inv[order].tolist(),
+            materials.low_stock_threshold_g[rows][order].tolist(),
+            rate[order].tolist(),
+            recent[order].tolist(),
+            days[order].tolist(),
+            suggested[order].tolist(),
+        )
+    ]
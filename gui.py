@@ -2,13 +2,30 @@
 
 from __future__ import annotations
 
+import contextvars
 import sys
 from pathlib import Path
-from typing import Any, List
-
-from PyQt5.QtCore import Qt, QAbstractTableModel, QModelIndex
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+from PyQt5.QtCore import (
+    Qt,
+    QAbstractTableModel,
+    QItemSelection,
+    QItemSelectionModel,
+    QModelIndex,
+    QThread,
+    QUrl,
+    pyqtSignal,
+)
+from PyQt5.QtGui import QColor, QDesktopServices
 from PyQt5.QtWidgets import (
     QApplication,
+    QCheckBox,
+    QComboBox,
+    QDoubleSpinBox,
+    QHBoxLayout,
+    QLineEdit,
     QMainWindow,
     QTabWidget,
     QWidget,
@@ -26,8 +43,11 @@ from PyQt5.QtWidgets import (
 )
 from qtawesome import icon
 
+import backup
+import events
 import services
 import exporter
+import jobs
 from dialogs import (
     LoginDialog,
     RawMaterialDialog,
@@ -35,31 +55,144 @@ from dialogs import (
     RevisionDiffDialog,
 )
 from auth import login
+from compliance import IfraViolation
+from forecast import LEAD_TIME_DAYS, StockForecast
+from importer import load_plan_csv, load_prices_csv
 from session import current_user, require_role
-from models import RawMaterial, Formula, Role
+from dto import FormulaDTO, MaterialDTO, RevisionStatsDTO
+from models import PyramidLevel, Role
 
 
 # ---------------------------------------------------------------------------#
 # Table-models
 # ---------------------------------------------------------------------------#
 class _BaseModel(QAbstractTableModel):
+    """
+    Ventana sobre una consulta de ``services``: orden y filtro se resuelven en SQL.
+    El modelo guarda los ids de todas las filas en su orden y solo los valores de
+    las últimas ``MAX_PAGES`` páginas leídas.
+    """
+
     _headers: List[str] = []
+    _sortable: frozenset = frozenset()  # columnas con ORDER BY en services
+    PAGE = 200
+    MAX_PAGES = 50
 
-    def __init__(self, items: List[Any]):
+    def __init__(self, ids_fn: Callable, fetch_fn: Callable, flt: Any):
         super().__init__()
-        self._items = items
+        self._ids_fn, self._fetch_fn = ids_fn, fetch_fn  # fetch_fn(ids) -> DTOs
+        self._filter = flt
+        self._order_by, self._desc = "id", False
+        self._items: "OrderedDict[int, Any]" = OrderedDict()  # id → DTO (LRU)
+        self._ids: List[int] = self._ids_fn(flt, self._order_by, self._desc)
+        self._row: Dict[int, int] = {}  # id → fila
+        self._index_rows()
+
+    def _index_rows(self):
+        self._row = {obj_id: r for r, obj_id in enumerate(self._ids)}
+
+    def item(self, row: int) -> Any:
+        obj_id = self._ids[row]
+        obj = self._items.get(obj_id)
+        if obj is None:
+            start = row - row % self.PAGE
+            page = [i for i in self._ids[start : start + self.PAGE] if i not in self._items]
+            self._items.update((o.id, o) for o in self._fetch_fn(page))
+            while len(self._items) > self.PAGE * self.MAX_PAGES:
+                self._items.popitem(last=False)
+            obj = self._items.get(obj_id)  # None si otro proceso la borró
+        else:
+            self._items.move_to_end(obj_id)
+        return obj
+
+    def id_at(self, row: int) -> int:
+        return self._ids[row]
+
+    # ---- orden, filtro y relectura -----------------------------------------
+    def reset(self):
+        self.beginResetModel()
+        self._items.clear()
+        self._ids = self._ids_fn(self._filter, self._order_by, self._desc)
+        self._index_rows()
+        self.endResetModel()
+
+    def set_filter(self, flt: Any):
+        self._filter = flt
+        self.reset()
+
+    def sort(self, column: int, order: Qt.SortOrder = Qt.AscendingOrder):  # type: ignore[override]
+        name = self._headers[column]
+        if name not in self._sortable:
+            return
+        self._order_by, self._desc = name, order == Qt.DescendingOrder
+        self.reset()
+
+    # ---- actualización por filas (ids de events.Change) ------------------
+    def resync(self, changed: Iterable[int]):
+        """
+        Relee el orden de ids con el filtro activo y aplica la diferencia fila a
+        fila: bajas con ``beginRemoveRows``, altas con ``beginInsertRows``, las
+        filas de ``changed`` que cambian de sitio se quitan y se vuelven a poner, y
+        las que no se mueven solo se repintan. Si también se movieron filas no
+        notificadas (cambios de otro proceso) se relee todo.
+        """
+        changed = set(changed)
+        for obj_id in changed:
+            self._items.pop(obj_id, None)
+        old, new = self._ids, self._ids_fn(self._filter, self._order_by, self._desc)
+        old_set, new_set = set(old), set(new)
+        moved = set()
+        if [i for i in old if i in new_set] != [i for i in new if i in old_set]:
+            moved = changed & old_set & new_set
+            if [i for i in old if i in new_set and i not in moved] != [
+                i for i in new if i in old_set and i not in moved
+            ]:
+                self.reset()
+                return
+
+        gone = [r for r, i in enumerate(old) if i not in new_set or i in moved]
+        for first, last in reversed(_runs(gone)):
+            self.beginRemoveRows(QModelIndex(), first, last)
+            del self._ids[first : last + 1]
+            self.endRemoveRows()
+        came = [r for r, i in enumerate(new) if i not in old_set or i in moved]
+        for first, last in _runs(came):
+            self.beginInsertRows(QModelIndex(), first, last)
+            self._ids[first:first] = new[first : last + 1]
+            self.endInsertRows()
+        self._index_rows()
+
+        last_col = len(self._headers) - 1
+        for obj_id in (changed & old_set) - moved:
+            r = self._row.get(obj_id)
+            if r is not None:
+                self.dataChanged.emit(self.index(r, 0), self.index(r, last_col))
+
+    def row_of(self, obj_id: int) -> Optional[int]:
+        return self._row.get(obj_id)
+
+    def _column_changed(self, name: str, ids: Optional[Iterable[int]] = None):
+        """Repinta una columna virtual entera o solo en las filas de ``ids``."""
+        col = self._headers.index(name)
+        if ids is None:
+            self.dataChanged.emit(self.index(0, col), self.index(self.rowCount() - 1, col))
+            return
+        for obj_id in ids:
+            r = self.row_of(obj_id)
+            if r is not None:
+                self.dataChanged.emit(self.index(r, col), self.index(r, col))
 
-    def rowCount(self, parent: QModelIndex = ...) -> int:  # type: ignore[override]
-        return len(self._items)
+    def rowCount(self, parent: QModelIndex = QModelIndex()) -> int:  # type: ignore[override]
+        return 0 if parent.isValid() else len(self._ids)
 
-    def columnCount(self, parent: QModelIndex = ...) -> int:  # type: ignore[override]
+    def columnCount(self, parent: QModelIndex = QModelIndex()) -> int:  # type: ignore[override]
         return len(self._headers)
 
     def data(self, idx: QModelIndex, role: int = ...) -> Any:  # type: ignore[override]
         if not idx.isValid() or role != Qt.DisplayRole:
             return None
-        obj = self._items[idx.row()]
-        return getattr(obj, self._headers[idx.column()])
+        obj = self.item(idx.row())
+        return None if obj is None else getattr(obj, self._headers[idx.column()])
 
     def headerData(self, i, o, r):  # type: ignore[override]
         if o == Qt.Horizontal and r == Qt.DisplayRole:
@@ -67,57 +200,338 @@ class _BaseModel(QAbstractTableModel):
         return super().headerData(i, o, r)
 
 
+def _runs(rows: List[int]) -> List[tuple]:
+    """Tramos consecutivos ``(primera, última)`` de una lista ordenada de filas."""
+    out: List[tuple] = []
+    for r in rows:
+        if out and out[-1][1] == r - 1:
+            out[-1] = (out[-1][0], r)
+        else:
+            out.append((r, r))
+    return out
+
+
 class RMModel(_BaseModel):
-    _headers = ["id", "name", "category", "cost_per_g", "inventory_g"]
+    # days_to_stockout es columna virtual (services.stock_forecast)
+    _headers = ["id", "name", "category", "cost_per_g", "inventory_g", "days_to_stockout"]
+    _sortable = frozenset(_headers) - {"days_to_stockout"}
+
+    def __init__(self):
+        super().__init__(services.material_ids, services.list_materials, services.MaterialFilter())
+        self._forecast: Dict[int, StockForecast] = {}
+
+    def set_forecast(self, forecasts: List[StockForecast], ids: Optional[Iterable[int]] = None):
+        """Sustituye la previsión de todas las materias o solo de ``ids``."""
+        if ids is None:
+            self._forecast = {}
+        else:
+            ids = set(ids)
+            for rm_id in ids:
+                self._forecast.pop(rm_id, None)
+        self._forecast.update((fc.raw_material_id, fc) for fc in forecasts)
+        self._column_changed("days_to_stockout", ids)
+
+    def data(self, idx: QModelIndex, role: int = ...):
+        if not idx.isValid():
+            return None
+        obj: Optional[MaterialDTO] = self.item(idx.row())
+        if obj is None or self._headers[idx.column()] != "days_to_stockout":
+            return super().data(idx, role)
+        fc = self._forecast.get(obj.id)
+        if fc is None:  # sin consumo en la ventana
+            return None
+        if role == Qt.DisplayRole:
+            return f"{fc.days_to_stockout:.0f}"
+        if role == Qt.ForegroundRole and fc.days_to_stockout <= LEAD_TIME_DAYS:
+            return QColor("#c0392b")
+        if role == Qt.ToolTipRole:
+            return (
+                f"Consumo: {fc.rate_g_day:.1f} g/día (últimos días: {fc.recent_rate_g_day:.1f})\n"
+                f"Agotado hacia el {fc.stockout_date:%d/%m/%Y}\n"
+                f"Umbral sugerido: {fc.suggested_threshold_g:.0f} g (actual {fc.low_stock_threshold_g:g} g)"
+            )
+        return None
 
 
 class FormulaModel(_BaseModel):
-    _headers = ["id", "name", "description", "latest_rev"]  # latest_rev es col virtual
+    # latest_rev e ifra son columnas virtuales
+    _headers = ["id", "name", "description", "category", "latest_rev", "ifra"]
+    _sortable = frozenset({"id", "name", "category"})
+
+    def __init__(self):
+        super().__init__(services.formula_ids, services.list_formulas, services.FormulaFilter())
+        self._ifra: Dict[int, List[IfraViolation]] = {}
+
+    def set_ifra(self, violations: List[IfraViolation], formula_ids: Optional[Iterable[int]] = None):
+        """Sustituye las infracciones de todas las fórmulas o solo de ``formula_ids``."""
+        if formula_ids is None:
+            self._ifra = {}
+        else:
+            formula_ids = set(formula_ids)
+            for fid in formula_ids:
+                self._ifra.pop(fid, None)
+        for v in violations:
+            self._ifra.setdefault(v.formula_id, []).append(v)
+        self._column_changed("ifra", formula_ids)
 
     def data(self, idx: QModelIndex, role: int = ...):
-        if not idx.isValid() or role != Qt.DisplayRole:
+        if not idx.isValid():
+            return None
+        obj: Optional[FormulaDTO] = self.item(idx.row())
+        if obj is None:
             return None
-        obj: Formula = self._items[idx.row()]
         col = self._headers[idx.column()]
+        if col == "ifra":
+            bad = self._ifra.get(obj.id, [])
+            if role == Qt.DisplayRole:
+                return f"⚠ {len(bad)}" if bad else "OK"
+            if role == Qt.ForegroundRole and bad:
+                return QColor("#c0392b")
+            if role == Qt.ToolTipRole and bad:
+                return "\n".join(
+                    f"{v.material_name}: {v.concentration_pct:.3f}% > {v.limit_pct:g}%"
+                    for v in bad
+                )
+            return None
+        if role != Qt.DisplayRole:
+            return None
         if col == "latest_rev":
-            return obj.latest().number
+            rev = obj.latest()
+            return rev.number if rev else None
         return super().data(idx, role)
 
 
+class RevisionHistoryModel(QAbstractTableModel):
+    """
+    Historial de una fórmula (más reciente primero) cargado por páginas con
+    ``services.revision_history`` a medida que la vista se desplaza.
+    """
+
+    _headers = ["Rev#", "Fecha", "Autor", "Comentario", "Entradas", "Peso g", "Coste €"]
+    PAGE = 100
+
+    def __init__(self, formula_id: int, parent=None):
+        super().__init__(parent)
+        self._formula_id = formula_id
+        self._items: List[RevisionStatsDTO] = []
+        self._more = True
+        self.fetchMore(QModelIndex())
+
+    def rowCount(self, parent: QModelIndex = QModelIndex()) -> int:  # type: ignore[override]
+        return 0 if parent.isValid() else len(self._items)
+
+    def columnCount(self, parent: QModelIndex = QModelIndex()) -> int:  # type: ignore[override]
+        return len(self._headers)
+
+    def canFetchMore(self, parent: QModelIndex) -> bool:  # type: ignore[override]
+        return not parent.isValid() and self._more
+
+    def fetchMore(self, parent: QModelIndex) -> None:  # type: ignore[override]
+        after = self._items[-1].number if self._items else None
+        page = services.revision_history(self._formula_id, after=after, limit=self.PAGE)
+        self._more = len(page) == self.PAGE
+        if page:
+            first = len(self._items)
+            self.beginInsertRows(QModelIndex(), first, first + len(page) - 1)
+            self._items.extend(page)
+            self.endInsertRows()
+
+    def data(self, idx: QModelIndex, role: int = ...) -> Any:  # type: ignore[override]
+        if not idx.isValid() or role != Qt.DisplayRole:
+            return None
+        rev = self._items[idx.row()]
+        return (
+            rev.number,
+            str(rev.created_at.date()),
+            rev.author,
+            rev.comment,
+            rev.entry_count,
+            f"{rev.total_weight_g:g}",
+            f"{rev.cost_estimate:.2f}",
+        )[idx.column()]
+
+    def headerData(self, i, o, r):  # type: ignore[override]
+        if o == Qt.Horizontal and r == Qt.DisplayRole:
+            return self._headers[i]
+        return super().headerData(i, o, r)
+
+
 # ---------------------------------------------------------------------------#
 # TableTab genérico
 # ---------------------------------------------------------------------------#
 class TableTab(QWidget):
-    def __init__(self, parent, model_cls, fetch_func):
+    """
+    Tabla con su modelo paginado y una barra de filtros opcional. Se actualiza
+    fila a fila con las notificaciones de ``events`` de su entidad; ``refresh``
+    (botón Actualizar) relee todo.
+    """
+
+    entity = ""  # entidad ORM que muestra la pestaña
+    # Por encima de tantas filas cambiadas es más barato releer la tabla entera
+    _RELOAD_AT = 2000
+
+    # Llega desde el hilo que hizo commit; Qt la entrega en el hilo de la GUI
+    changed = pyqtSignal(object)
+
+    def __init__(self, parent, model_cls):
         super().__init__(parent)
         self.model_cls = model_cls
-        self.fetch = fetch_func
+        self._kept: tuple = ((), None)  # selección (ids, id actual) durante un reset
 
         self.table = QTableView()
         self.toolbar = QToolBar()
         self._setup_toolbar()
+        self.model = model_cls()
+        self.table.setModel(self.model)
+        # clic en cabecera → model.sort() → ORDER BY en SQL
+        self.table.horizontalHeader().setSortIndicator(0, Qt.AscendingOrder)
+        self.table.setSortingEnabled(True)
+        # orden, filtro y relectura conservan la selección por id, no por fila
+        self.model.modelAboutToBeReset.connect(self._save_selection)
+        self.model.modelReset.connect(self._restore_selection)
 
         lay = QVBoxLayout(self)
         lay.addWidget(self.toolbar)
+        bar = self._setup_filter()
+        if bar is not None:
+            lay.addWidget(bar)
         lay.addWidget(self.table)
         self.refresh()
 
+        self.changed.connect(self._on_change)
+        unsubscribe = events.subscribe(self.changed.emit)
+        self.destroyed.connect(lambda *_: unsubscribe())
+
     def _setup_toolbar(self):
-        self.act_refresh = QAction(icon("mdi.reload"), "Actualizar", self, triggered=self.refresh)
+        self.act_refresh = QAction(icon("mdi.reload"), "Actualizar", self, triggered=self._reload)
         self.toolbar.addAction(self.act_refresh)
 
+    def _setup_filter(self) -> Optional[QWidget]:
+        return None
+
     def refresh(self):
-        self.model = self.model_cls(self.fetch())
-        self.table.setModel(self.model)
+        self.model.reset()
         self.table.resizeColumnsToContents()
 
+    def _reload(self):
+        services.reload_catalog()  # recoge también cambios de otros procesos
+        self.refresh()
+
+    def _on_change(self, ch: events.Change):
+        if ch.entity == events.EPOCH:  # copia restaurada
+            self.refresh()
+            return
+        if ch.entity != self.entity:
+            return
+        if len(ch.ids) > self._RELOAD_AT:
+            self.refresh()
+            return
+        # altas, bajas y cambios que mueven filas según el orden y el filtro activos
+        self._save_selection()
+        self.model.resync(ch.ids)
+        self._restore_selection()
+
+    # ---- selección por id ----------------------------------------------------
+    def _save_selection(self):
+        sel = self.table.selectionModel()
+        cur = sel.currentIndex()
+        self._kept = (
+            [self.model.id_at(ix.row()) for ix in sel.selectedRows()],
+            self.model.id_at(cur.row()) if cur.isValid() else None,
+        )
+
+    def _restore_selection(self):
+        ids, cur_id = self._kept
+        self._kept = ((), None)
+        sel, last_col = QItemSelection(), self.model.columnCount() - 1
+        for obj_id in ids:
+            r = self.model.row_of(obj_id)
+            if r is not None:
+                sel.select(self.model.index(r, 0), self.model.index(r, last_col))
+        sm = self.table.selectionModel()
+        sm.select(sel, QItemSelectionModel.ClearAndSelect | QItemSelectionModel.Rows)
+        r = self.model.row_of(cur_id) if cur_id is not None else None
+        if r is not None:
+            sm.setCurrentIndex(self.model.index(r, 0), QItemSelectionModel.NoUpdate)
+
+
+def _combo(items: Iterable[str], all_label: str) -> QComboBox:
+    """Combo con una primera opción «todas» (dato None) y un elemento por valor."""
+    cb = QComboBox()
+    cb.addItem(all_label, None)
+    _refill(cb, items)
+    return cb
+
+
+def _refill(cb: QComboBox, items: Iterable[str]):
+    """Sustituye los valores del combo manteniendo la opción elegida si sigue existiendo."""
+    cur = cb.currentData()
+    cb.blockSignals(True)
+    while cb.count() > 1:
+        cb.removeItem(1)
+    for it in items:
+        cb.addItem(str(it), it)
+    cb.setCurrentIndex(max(cb.findData(cur), 0))
+    cb.blockSignals(False)
+
+
+def _cost_spin(special: str) -> QDoubleSpinBox:
+    sp = QDoubleSpinBox()
+    sp.setRange(0, 1e6)
+    sp.setDecimals(4)
+    sp.setSpecialValueText(special)  # 0 = sin límite
+    return sp
+
 
 # ---------------------------------------------------------------------------#
 # Materias primas tab
 # ---------------------------------------------------------------------------#
 class RmTab(TableTab):
+    entity = "RawMaterial"
+
     def __init__(self, parent):
-        super().__init__(parent, RMModel, lambda: services.list_all(RawMaterial))
+        super().__init__(parent, RMModel)
+
+    def _setup_filter(self) -> QWidget:
+        bar = QWidget()
+        self.cb_cat = _combo(services.material_categories(), "Todas las categorías")
+        self.cb_level = _combo([lv.value for lv in PyramidLevel], "Todos los niveles")
+        self.sp_min = _cost_spin("€/g mín.")
+        self.sp_max = _cost_spin("€/g máx.")
+        self.chk_low = QCheckBox("Solo stock bajo")
+        lay = QHBoxLayout(bar)
+        lay.setContentsMargins(0, 0, 0, 0)
+        for w in (self.cb_cat, self.cb_level, self.sp_min, self.sp_max, self.chk_low):
+            lay.addWidget(w)
+        lay.addStretch()
+        self.cb_cat.currentIndexChanged.connect(self._apply_filter)
+        self.cb_level.currentIndexChanged.connect(self._apply_filter)
+        self.sp_min.editingFinished.connect(self._apply_filter)
+        self.sp_max.editingFinished.connect(self._apply_filter)
+        self.chk_low.toggled.connect(self._apply_filter)
+        return bar
+
+    def refresh(self):
+        _refill(self.cb_cat, services.material_categories())
+        super().refresh()
+        self.model.set_forecast(services.stock_forecast())
+
+    def _on_change(self, ch: events.Change):
+        super()._on_change(ch)
+        # los ajustes de stock cambian los días hasta agotar
+        if ch.entity == self.entity and ch.op == events.UPDATE and len(ch.ids) <= self._RELOAD_AT:
+            self.model.set_forecast(services.stock_forecast(ch.ids), ch.ids)
+
+    def _apply_filter(self):
+        self.model.set_filter(
+            services.MaterialFilter(
+                category=self.cb_cat.currentData(),
+                level=self.cb_level.currentData(),
+                min_cost=self.sp_min.value() or None,
+                max_cost=self.sp_max.value() or None,
+                low_stock_only=self.chk_low.isChecked(),
+            )
+        )
 
     def _setup_toolbar(self):
         super()._setup_toolbar()
@@ -125,14 +539,14 @@ class RmTab(TableTab):
         act_add.setEnabled(require_role(Role.ADMIN, Role.PERFUMER))
         act_exp = QAction(icon("mdi.file-export"), "Exportar CSV", self, triggered=self._exp)
         act_imp = QAction(icon("mdi.file-import"), "Importar CSV", self, triggered=self._imp)
-        self.toolbar.addActions([act_add, act_exp, act_imp])
+        act_fc = QAction(icon("mdi.chart-line"), "Previsión de consumo", self, triggered=self._forecast)
+        self.toolbar.addActions([act_add, act_exp, act_imp, act_fc])
 
     def _add_rm(self):
         dlg = RawMaterialDialog(self)
         data = dlg.get_data()
         if data:
             services.create_raw_material(**data)
-            self.refresh()
 
     def _exp(self):
         f, _ = QFileDialog.getSaveFileName(self, "CSV", "", "CSV (*.csv)")
@@ -143,18 +557,23 @@ class RmTab(TableTab):
         f, _ = QFileDialog.getOpenFileName(self, "CSV", "", "CSV (*.csv)")
         if f:
             services.import_materials_csv(Path(f))
-            self.refresh()
+
+    def _forecast(self):
+        f, _ = QFileDialog.getSaveFileName(self, "Previsión de consumo", "prevision.csv", "CSV (*.csv)")
+        if f:
+            exporter.export_forecast_csv(Path(f))
 
 
 # ---------------------------------------------------------------------------#
 # Fórmulas tab con versiones
 # ---------------------------------------------------------------------------#
 class FormulaTab(TableTab):
+    entity = "Formula"
+
     def __init__(self, parent):
-        super().__init__(parent, FormulaModel, services.list_formulas)
-        self.lbl_tot = QLabel()
+        self.lbl_tot = QLabel()  # antes de super(): TableTab.__init__ ya llama a refresh()
+        super().__init__(parent, FormulaModel)
         self.layout().addWidget(self.lbl_tot)
-        self.refresh()
 
     # toolbar extra
     def _setup_toolbar(self):
@@ -163,14 +582,50 @@ class FormulaTab(TableTab):
         self.act_clone = QAction(icon("mdi.content-copy"), "Clonar versión", self, triggered=self._clone)
         self.act_diff = QAction(icon("mdi.compare"), "Dif últimas", self, triggered=self._diff)
         self.act_hist = QAction(icon("mdi.history"), "Historial", self, triggered=self._hist)
-
-        for a in (self.act_new, self.act_clone, self.act_diff, self.act_hist):
+        self.act_ifra = QAction(icon("mdi.alert-decagram"), "Informe IFRA", self, triggered=self._ifra_report)
+        self.act_sim = QAction(icon("mdi.vector-link"), "Similares", self, triggered=self._similar)
+        self.act_dup = QAction(icon("mdi.content-duplicate"), "Duplicados", self, triggered=self._duplicates)
+        self.act_imp = QAction(icon("mdi.file-import"), "Importar CSV", self, triggered=self._import)
+        self.act_imp.setEnabled(require_role(Role.ADMIN, Role.PERFUMER))
+
+        for a in (
+            self.act_new,
+            self.act_clone,
+            self.act_diff,
+            self.act_hist,
+            self.act_ifra,
+            self.act_sim,
+            self.act_dup,
+            self.act_imp,
+        ):
             self.toolbar.addAction(a)
 
+    def _setup_filter(self) -> QWidget:
+        bar = QWidget()
+        self.txt_name = QLineEdit(placeholderText="Buscar por nombre…", clearButtonEnabled=True)
+        self.cb_cat = _combo(services.formula_categories(), "Todas las categorías")
+        lay = QHBoxLayout(bar)
+        lay.setContentsMargins(0, 0, 0, 0)
+        lay.addWidget(self.txt_name)
+        lay.addWidget(self.cb_cat)
+        lay.addStretch()
+        self.txt_name.editingFinished.connect(self._apply_filter)
+        self.cb_cat.currentIndexChanged.connect(self._apply_filter)
+        return bar
+
+    def _apply_filter(self):
+        flt = services.FormulaFilter(
+            category=self.cb_cat.currentData(),
+            name_contains=self.txt_name.text().strip() or None,
+        )
+        if flt != self.model._filter:
+            self.model.set_filter(flt)
+            self._update_totals()
+
     # helpers
-    def _cur_formula(self) -> Formula | None:
+    def _cur_formula(self) -> FormulaDTO | None:
         idx = self.table.currentIndex()
-        return self.model._items[idx.row()] if idx.isValid() else None
+        return self.model.item(idx.row()) if idx.isValid() else None
 
     # acciones
     def _new_formula(self):
@@ -178,7 +633,6 @@ class FormulaTab(TableTab):
         data = dlg.get_data()
         if data:
             services.create_formula(data["name"], data["comment"], data["entries"])
-            self.refresh()
 
     def _clone(self):
         f = self._cur_formula()
@@ -187,44 +641,120 @@ class FormulaTab(TableTab):
         txt, ok = QInputDialog.getText(self, "Comentario", "Describe la nueva versión:")
         if ok:
             services.clone_revision(f.id, txt or "clonado GUI")
-            self.refresh()
 
     def _diff(self):
         f = self._cur_formula()
-        if not f or len(f.revisions) < 2:
+        if not f or f.revision_count < 2:
             return
-        RevisionDiffDialog(f.revisions[-2], f.revisions[-1], self).exec_()
+        newest, previous = services.revision_history(f.id, limit=2)
+        RevisionDiffDialog(previous, newest, self).exec_()
 
     def _hist(self):
         f = self._cur_formula()
         if not f:
             return
         dlg = QDialog(self)
-        dlg.setWindowTitle(f"Historial • {f.name}")
-        tbl = QTableWidget(len(f.revisions), 4)
-        tbl.setHorizontalHeaderLabels(["Rev#", "Fecha", "Autor", "Comentario"])
-        for r, rev in enumerate(f.revisions):
-            tbl.setItem(r, 0, QTableWidgetItem(str(rev.number)))
-            tbl.setItem(r, 1, QTableWidgetItem(str(rev.created_at.date())))
-            tbl.setItem(r, 2, QTableWidgetItem(rev.author))
-            tbl.setItem(r, 3, QTableWidgetItem(rev.comment))
+        dlg.setWindowTitle(f"Historial • {f.name} ({f.revision_count} revisiones)")
+        tbl = QTableView()
+        tbl.setModel(RevisionHistoryModel(f.id, parent=tbl))
         tbl.resizeColumnsToContents()
         lay = QVBoxLayout(dlg)
         lay.addWidget(tbl)
+        dlg.resize(700, 400)
         dlg.exec_()
 
+    def _similar(self):
+        f = self._cur_formula()
+        if not f:
+            return
+        hits = services.similar_formulas(f.id, 10)
+        dlg = QDialog(self)
+        dlg.setWindowTitle(f"Similares • {f.name}")
+        tbl = QTableWidget(len(hits), 3)
+        tbl.setHorizontalHeaderLabels(["ID", "Fórmula", "Similitud"])
+        for r, h in enumerate(hits):
+            tbl.setItem(r, 0, QTableWidgetItem(str(h.formula_id)))
+            tbl.setItem(r, 1, QTableWidgetItem(h.name))
+            tbl.setItem(r, 2, QTableWidgetItem(f"{h.score:.1%}"))
+        tbl.resizeColumnsToContents()
+        lay = QVBoxLayout(dlg)
+        lay.addWidget(tbl)
+        dlg.exec_()
+
+    def _import(self):
+        f, _ = QFileDialog.getOpenFileName(self, "Importar fórmulas", "", "CSV (*.csv)")
+        if not f:
+            return
+
+        def done(res):
+            msg = (
+                f"{res['formulas']} fórmulas nuevas, {res['revisions']} revisiones, "
+                f"{res['entries']} entradas; {res['skipped']} revisiones ya existentes, "
+                f"{res['discarded']} descartadas."
+            )
+            if res["rejected"]:
+                msg += f"\n\n{len(res['rejected'])} filas rechazadas:\n" + "\n".join(res["rejected"][:30])
+            QMessageBox.information(self, "Importar fórmulas", msg)
+
+        # en segundo plano; la tabla se actualiza con las notificaciones de events
+        self.window()._run(services.import_formulas_csv, Path(f), on_done=done)
+
+    def _duplicates(self):
+        f, _ = QFileDialog.getSaveFileName(self, "Duplicados", "", "CSV (*.csv)")
+        if f:
+            exporter.export_duplicates_csv(Path(f))
+
+    def _ifra_report(self):
+        f, _ = QFileDialog.getSaveFileName(self, "Informe IFRA", "", "CSV (*.csv)")
+        if f:
+            exporter.export_ifra_report_csv(Path(f))
+
     # override refresh
     def refresh(self):
+        _refill(self.cb_cat, services.formula_categories())
         super().refresh()
-        forms = self.fetch()
-        total = len(forms)
-        revs = sum(len(f.revisions) for f in forms)
-        self.lbl_tot.setText(f"<b>Fórmulas:</b> {total} &nbsp; <b>Revisiones totales:</b> {revs}")
+        self.model.set_ifra(services.ifra_violations())
+        self._update_totals()
+
+    def _on_change(self, ch: events.Change):
+        if ch.entity == "IfraLimit":  # un límite puede afectar a cualquier fórmula
+            self.model.set_ifra(services.ifra_violations())
+            return
+        super()._on_change(ch)
+        if ch.entity != self.entity:
+            return
+        if ch.op != events.DELETE and len(ch.ids) <= self._RELOAD_AT:
+            self.model.set_ifra(services.ifra_violations(ch.ids), ch.ids)
+        self._update_totals()
+
+    def _update_totals(self):
+        self.lbl_tot.setText(
+            f"<b>Fórmulas:</b> {self.model.rowCount()} &nbsp; "
+            f"<b>Revisiones totales:</b> {services.count_revisions()}"
+        )
 
 
 # ---------------------------------------------------------------------------#
 # MainWindow
 # ---------------------------------------------------------------------------#
+class _Task(QThread):
+    """Ejecuta una función lenta fuera del hilo de la GUI (con el usuario actual)."""
+
+    done = pyqtSignal(object)
+    failed = pyqtSignal(str)
+
+    def __init__(self, fn, *args, parent=None):
+        super().__init__(parent)
+        self._fn, self._args = fn, args
+        self._ctx = contextvars.copy_context()
+
+    def run(self):
+        try:
+            self.done.emit(self._ctx.run(self._fn, *self._args))
+        except Exception as e:  # se muestra al usuario
+            self.failed.emit(str(e))
+
+
 class MainWindow(QMainWindow):
     def __init__(self):
         super().__init__()
@@ -235,6 +765,115 @@ class MainWindow(QMainWindow):
         tabs.addTab(RmTab(tabs), "Materias primas")
         tabs.addTab(FormulaTab(tabs), "Fórmulas")
         self.setCentralWidget(tabs)
+        self._setup_reports_menu()
+        self._setup_admin_menu()
+
+    def _setup_reports_menu(self):
+        menu = self.menuBar().addMenu("Informes")
+        for job in jobs.JOBS.values():
+            menu.addAction(QAction(job.title, self, triggered=lambda _=False, n=job.name: self._report(n)))
+        menu.addSeparator()
+        menu.addAction(QAction(icon("mdi.cart"), "Necesidades de un plan…", self, triggered=self._requirements))
+        menu.addAction(QAction(icon("mdi.cash"), "Simular precios…", self, triggered=self._price_impact))
+        menu.addSeparator()
+        menu.addAction(QAction(icon("mdi.refresh"), "Generar pendientes", self, triggered=self._reports_all))
+
+    def _setup_admin_menu(self):
+        menu = self.menuBar().addMenu("Administración")
+        self.act_backup = QAction(icon("mdi.database-export"), "Copia de seguridad", self, triggered=self._backup)
+        self.act_restore = QAction(icon("mdi.database-import"), "Restaurar copia…", self, triggered=self._restore)
+        for a in (self.act_backup, self.act_restore):
+            a.setEnabled(require_role(Role.ADMIN))
+            menu.addAction(a)
+
+    def _run(self, fn, *args, on_done):
+        self.statusBar().showMessage("Trabajando…")
+        task = _Task(fn, *args, parent=self)
+        task.done.connect(on_done)
+        task.failed.connect(lambda msg: QMessageBox.critical(self, "Error", msg))
+        task.finished.connect(task.deleteLater)
+        task.start()
+
+    def _report(self, name: str):
+        """Abre el informe de la caché al instante o lo genera en segundo plano."""
+        path = jobs.cached(name)
+        if path is not None:
+            QDesktopServices.openUrl(QUrl.fromLocalFile(str(path)))
+            return
+
+        def done(results):
+            r = results[0]
+            if r.error:
+                QMessageBox.critical(self, "Informe", r.error)
+                return
+            self.statusBar().showMessage(f"{jobs.JOBS[name].title}: {r.duration_s:.1f} s", 10000)
+            QDesktopServices.openUrl(QUrl.fromLocalFile(str(r.path)))
+
+        self._run(jobs.run, [name], on_done=done)
+
+    def _csv_report(self, title: str, default: str, build: Callable[[Path, Path], None]):
+        """Pide el CSV de entrada y el de salida; ``build(entrada, salida)`` corre en segundo plano."""
+        src, _ = QFileDialog.getOpenFileName(self, title, "", "CSV (*.csv)")
+        if not src:
+            return
+        out, _ = QFileDialog.getSaveFileName(self, title, default, "CSV (*.csv)")
+        if not out:
+            return
+
+        def done(_):
+            self.statusBar().showMessage(f"{title} → {out}", 10000)
+            QDesktopServices.openUrl(QUrl.fromLocalFile(out))
+
+        self._run(build, Path(src), Path(out), on_done=done)
+
+    def _requirements(self):
+        def build(src: Path, out: Path):
+            exporter.export_requirements_csv(services.material_requirements(load_plan_csv(src)), out)
+
+        self._csv_report("Necesidades de un plan", "compras.csv", build)
+
+    def _price_impact(self):
+        def build(src: Path, out: Path):
+            exporter.export_price_impact_csv(services.simulate_price_change(load_prices_csv(src)), out)
+
+        self._csv_report("Simular precios", "impacto_precios.csv", build)
+
+    def _reports_all(self):
+        def done(results):
+            fresh = [r for r in results if not r.cache_hit and not r.error]
+            failed = [r for r in results if r.error]
+            self.statusBar().showMessage(
+                f"Informes: {len(fresh)} generados, {len(results) - len(fresh) - len(failed)} vigentes"
+                + (f", {len(failed)} con errores" if failed else ""),
+                15000,
+            )
+
+        self._run(jobs.run, on_done=done)
+
+    def _backup(self):
+        def done(res):
+            backup.prune_snapshots()
+            self.statusBar().showMessage(res.summary(), 15000)
+
+        self._run(backup.take_snapshot, on_done=done)
+
+    def _restore(self):
+        f, _ = QFileDialog.getOpenFileName(
+            self, "Restaurar copia", str(backup.SNAPSHOT_DIR), "Instantáneas (*.db *.db.gz)"
+        )
+        if not f:
+            return
+        ok = QMessageBox.question(
+            self, "Restaurar", "Se sustituirán todos los datos actuales. ¿Continuar?"
+        )
+        if ok != QMessageBox.Yes:
+            return
+
+        def done(secs):
+            # las pestañas ya se han releído con la notificación de la época nueva
+            self.statusBar().showMessage(f"Copia restaurada en {secs:.1f} s.", 15000)
+
+        self._run(backup.restore_snapshot, Path(f), on_done=done)
 
 
 # ---------------------------------------------------------------------------#
@@ -266,4 +905,7 @@ def main():
 
 
 if __name__ == "__main__":
+    import multiprocessing
+
+    multiprocessing.freeze_support()  # ejecutable PyInstaller: hijos "spawn" de jobs.py
     main()
@@ -1,13 +1,367 @@
-# importer.py ── CLI rápido
+# importer.py ── CLI sin GUI: import · export · sync · report · stock
+# =============================================================================
+# Nunca importa Qt: puede ejecutarse en servidores, tareas programadas y workers.
+#
+#   python importer.py import materials a.csv b.csv --workers 4
+#   python importer.py --user admin import formulas archivo.csv
+#   python importer.py export formulas formulas.csv
+#   python importer.py report mrp plan.csv --out compras.csv
+#   python importer.py report forecast --window 60 --out prevision.csv
+#   python importer.py stock adjust "Bergamot EO" -25 --desc "merma"
+#   python importer.py stock consume "Bergamot EO" 40 --desc "lote 118"
+#   python importer.py --user admin stock count recuento.csv --apply
+#   python importer.py --user admin substitute "Lilial" "Florhydral" --ratio 0.8 --dry-run
+#   python importer.py jobs run low-stock pyramids      (jobs serve · jobs stats)
+#   python importer.py --user admin sync --pg-url postgresql+pg8000://…
+from __future__ import annotations
+
 import argparse
+import csv
+import getpass
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
+from typing import Dict, List, Optional
+
 import services
+from models import Formula, MovementKind, RawMaterial, SessionLocal, User, init_db
+from mrp import PlanLine
+from session import current_user, set_current_user
 
+_IMPORTERS = {
+    "materials": services.import_materials_csv,
+    "formulas": services.import_formulas_csv,
+}
+
+
+# ---------------------------------------------------------------------------#
+# Lectores CSV auxiliares
+# ---------------------------------------------------------------------------#
+
+
+def load_plan_csv(path: Path) -> List[PlanLine]:
+    """
+    Lee un plan de producción con columnas ``formula`` (nombre) o ``formula_id``
+    y ``batch_g``. Los nombres se resuelven con un único mapa nombre → id.
+    """
+    with services.session_scope() as s:
+        ids = dict(s.query(Formula.name, Formula.id).all())
+    plan = []
+    with path.open(newline="", encoding="utf-8") as f:
+        for n, row in enumerate(csv.DictReader(f), start=2):
+            if row.get("formula_id"):
+                fid = int(row["formula_id"])
+            elif row.get("formula") in ids:
+                fid = ids[row["formula"]]
+            else:
+                raise ValueError(f"Línea {n}: fórmula {row.get('formula')!r} no encontrada.")
+            plan.append(PlanLine(formula_id=fid, batch_g=float(row["batch_g"])))
+    return plan
+
+
+def load_prices_csv(path: Path) -> Dict[int, float]:
+    """Precios propuestos: columnas ``material`` (nombre) o ``raw_material_id`` y ``cost_per_g``."""
+    with services.session_scope() as s:
+        ids = dict(s.query(RawMaterial.name, RawMaterial.id).all())
+    prices = {}
+    with path.open(newline="", encoding="utf-8") as f:
+        for n, row in enumerate(csv.DictReader(f), start=2):
+            if row.get("raw_material_id"):
+                rm_id = int(row["raw_material_id"])
+            elif row.get("material") in ids:
+                rm_id = ids[row["material"]]
+            else:
+                raise ValueError(f"Línea {n}: materia {row.get('material')!r} no encontrada.")
+            prices[rm_id] = float(row["cost_per_g"])
+    return prices
+
+
+def _material_id(ref: str) -> int:
+    if ref.isdigit():
+        return int(ref)
+    with services.session_scope() as s:
+        rm_id = s.query(RawMaterial.id).filter_by(name=ref).scalar()
+    if rm_id is None:
+        raise SystemExit(f"Materia {ref!r} no encontrada.")
+    return rm_id
+
+
+# ---------------------------------------------------------------------------#
+# Usuario y workers
+# ---------------------------------------------------------------------------#
+
+
+def _login(username: Optional[str]) -> None:
+    """Autentica al usuario indicado (contraseña en FORMULAIR_PASSWORD o por teclado)."""
+    if not username:
+        return
+    from auth import login
+
+    pwd = os.getenv("FORMULAIR_PASSWORD") or getpass.getpass(f"Contraseña de {username}: ")
+    if not login(username, pwd):
+        raise SystemExit("Credenciales incorrectas.")
+
+
+def _init_worker(user_id: Optional[int]) -> None:
+    if user_id is not None:
+        with SessionLocal() as s:
+            set_current_user(s.get(User, user_id))
+
+
+def _import_file(kind: str, path: Path) -> dict:
+    return _IMPORTERS[kind](path)
+
+
+def _progress(done: int, total: int, label: str, t0: float) -> None:
+    print(f"[{done}/{total}] {label} ({time.perf_counter() - t0:.1f} s)", file=sys.stderr, flush=True)
+
+
+def _summary(path: Path, res: dict) -> str:
+    """Resumen de una importación; las filas rechazadas se listan aparte en stderr."""
+    res = dict(res)
+    rejected = res.pop("rejected", [])
+    for r in rejected:
+        print(f"{path.name}: {r}", file=sys.stderr)
+    if rejected:
+        res["rejected"] = len(rejected)
+    return f"{path.name}: {res}"
+
+
+# ---------------------------------------------------------------------------#
+# Subcomandos
+# ---------------------------------------------------------------------------#
+
+
+def cmd_import(args) -> None:
+    files: List[Path] = args.files
+    t0 = time.perf_counter()
+    if len(files) == 1 or args.workers == 1:
+        for i, path in enumerate(files, start=1):
+            res = _import_file(args.kind, path)
+            _progress(i, len(files), _summary(path, res), t0)
+        return
+
+    usr = current_user()
+    # "spawn": cada worker abre sus propias conexiones (con fork heredaría las
+    # del pool del padre, y SQLite no admite compartirlas entre procesos)
+    with ProcessPoolExecutor(
+        max_workers=args.workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(usr.id if usr else None,),
+    ) as pool:
+        futures = {pool.submit(_import_file, args.kind, p): p for p in files}
+        failed = 0
+        for i, fut in enumerate(as_completed(futures), start=1):
+            path = futures[fut]
+            try:
+                label = _summary(path, fut.result())
+            except Exception as e:
+                failed += 1
+                label = f"{path.name}: ERROR {e}"
+            _progress(i, len(files), label, t0)
+    if failed:
+        raise SystemExit(f"{failed} fichero(s) con errores.")
+
+
+def cmd_export(args) -> None:
+    import exporter
+
+    out: Path = args.out
+    if args.what == "materials":
+        exporter.export_materials_csv(out)
+    elif args.what == "materials-pdf":
+        exporter.export_materials_pdf(out)
+    elif args.what == "formulas":
+        exporter.export_formulas_csv(out)
+    elif args.what == "ifra":
+        exporter.export_ifra_report_csv(out)
+    elif args.what == "duplicates":
+        exporter.export_duplicates_csv(out)
+    print(f"Exportado {args.what} → {out}")
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Importa CSV al sistema.")
-    parser.add_argument("csv", type=Path, help="Ruta del CSV de materias")
-    args = parser.parse_args()
 
-    res = services.import_materials_csv(args.csv)
-    print("Importación completada.", res)
+def cmd_sync(args) -> None:
+    from sync import sync_to_postgres
+
+    sync_to_postgres(args.pg_url)
+    print("Sincronización completada.")
+
+
+def cmd_report(args) -> None:
+    import exporter
+
+    if args.what in ("mrp", "prices") and args.input is None:
+        raise SystemExit(f"report {args.what} necesita un CSV de entrada.")
+    if args.what == "low-stock":
+        exporter.export_low_stock_csv(args.out)
+    elif args.what == "ifra":
+        exporter.export_ifra_report_csv(args.out)
+    elif args.what == "forecast":
+        exporter.export_forecast_csv(args.out, window_days=args.window)
+    elif args.what == "mrp":
+        exporter.export_requirements_csv(services.material_requirements(load_plan_csv(args.input)), args.out)
+    elif args.what == "prices":
+        impacts = services.simulate_price_change(load_prices_csv(args.input), args.all_revisions)
+        exporter.export_price_impact_csv(impacts, args.out)
+    else:  # duplicates
+        exporter.export_duplicates_csv(args.out)
+
+
+def cmd_stock(args) -> None:
+    rm_id = _material_id(args.material)
+    services.adjust_stock(rm_id, args.delta, args.desc)
+    print(f"Stock de {args.material} ajustado en {args.delta:+g} g.")
+
+
+def cmd_stock_consume(args) -> None:
+    if not args.grams > 0:
+        raise SystemExit("El consumo debe ser mayor que 0 g.")
+    services.adjust_stock(_material_id(args.material), -args.grams, args.desc, kind=MovementKind.CONSUMPTION)
+    print(f"Consumo de {args.grams:g} g de {args.material} registrado.")
+
+
+def cmd_stock_count(args) -> None:
+    """Sin --apply solo muestra las diferencias; con --apply además las regulariza."""
+    import exporter
+
+    if args.apply:
+        res = services.apply_stocktake(args.file, args.desc)
+    else:
+        res = services.preview_stocktake(args.file)
+    for r in res.rejected:
+        print(f"{args.file.name}: {r}", file=sys.stderr)
+    exporter.export_stocktake_csv(res.discrepancies, args.out)
+    verb = "regularizadas" if res.applied else "con diferencias"
+    print(
+        f"{res.counted} materias contadas, {len(res.discrepancies)} {verb} "
+        f"(valor neto {res.value:+.2f}), {len(res.rejected)} filas rechazadas.",
+        file=sys.stderr,
+    )
+
+
+def cmd_substitute(args) -> None:
+    import exporter
+
+    res = services.substitute_material(
+        _material_id(args.old),
+        _material_id(args.new),
+        args.ratio,
+        args.formula or None,
+        args.comment,
+        dry_run=args.dry_run,
+    )
+    exporter.export_substitution_csv(res.impacts, args.out)
+    for k in res.skipped:
+        print(f"{k.formula_name}: sin cambios ({k.reason})", file=sys.stderr)
+    verb = "nuevas revisiones" if res.applied else "fórmulas afectadas (simulación)"
+    delta = sum(i.delta for i in res.impacts)
+    print(f"{len(res.impacts)} {verb}, variación de coste total {delta:+.2f}.", file=sys.stderr)
+
+
+def cmd_jobs(args) -> None:
+    import jobs
+
+    if args.action == "serve":
+        jobs.serve(args.poll, args.workers)
+    elif args.action == "stats":
+        for st in jobs.stats():
+            render = f"{st.avg_render_s:.1f} s (máx. {st.max_render_s:.1f} s)" if st.avg_render_s is not None else "-"
+            print(
+                f"{st.job}: {st.requests} peticiones, aciertos de caché {st.hit_rate:.0%}, "
+                f"{st.errors} errores, generación {render}, última {st.last_run:%Y-%m-%d %H:%M}"
+            )
+    else:
+        failed = 0
+        for r in jobs.run(args.names or None, force=args.force, workers=args.workers):
+            if r.error:
+                failed += 1
+                print(f"{r.job}: ERROR {r.error}", file=sys.stderr)
+            else:
+                print(f"{r.job}: {r.path} ({'caché' if r.cache_hit else f'{r.duration_s:.1f} s'})")
+        if failed:
+            raise SystemExit(f"{failed} informe(s) con errores.")
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Formulair Pro Win · utilidades sin GUI.")
+    parser.add_argument("--user", help="Usuario que firma los cambios (auditoría)")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p = sub.add_parser("import", help="Importa uno o varios CSV (en paralelo)")
+    p.add_argument("kind", choices=sorted(_IMPORTERS))
+    p.add_argument("files", type=Path, nargs="+")
+    p.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    p.set_defaults(func=cmd_import)
+
+    p = sub.add_parser("export", help="Exporta CSV/PDF")
+    p.add_argument("what", choices=["materials", "materials-pdf", "formulas", "ifra", "duplicates"])
+    p.add_argument("out", type=Path)
+    p.set_defaults(func=cmd_export)
+
+    p = sub.add_parser("sync", help="Sube la BD local a PostgreSQL")
+    p.add_argument("--pg-url", default=os.getenv("PGURL"), required=not os.getenv("PGURL"))
+    p.set_defaults(func=cmd_sync)
+
+    p = sub.add_parser("report", help="Informes en CSV (stdout o --out)")
+    p.add_argument("what", choices=["low-stock", "forecast", "ifra", "mrp", "prices", "duplicates"])
+    p.add_argument("input", type=Path, nargs="?", help="Plan (mrp) o precios propuestos (prices)")
+    p.add_argument("--all-revisions", action="store_true", help="prices: todas las revisiones")
+    p.add_argument("--window", type=int, default=30, help="forecast: días de consumo considerados")
+    p.add_argument("--out", type=Path)
+    p.set_defaults(func=cmd_report)
+
+    p = sub.add_parser("stock", help="Movimientos de stock")
+    stock = p.add_subparsers(dest="action", required=True)
+    p = stock.add_parser("adjust", help="Ajusta el stock de una materia")
+    p.add_argument("material", help="id o nombre")
+    p.add_argument("delta", type=float, help="gramos (+ entrada, - salida)")
+    p.add_argument("--desc", default="ajuste CLI")
+    p.set_defaults(func=cmd_stock)
+    p = stock.add_parser("consume", help="Registra un consumo (cuenta en la previsión)")
+    p.add_argument("material", help="id o nombre")
+    p.add_argument("grams", type=float, help="gramos consumidos")
+    p.add_argument("--desc", default="consumo CLI")
+    p.set_defaults(func=cmd_stock_consume)
+    p = stock.add_parser("count", help="Concilia el stock con un recuento físico (CSV)")
+    p.add_argument("file", type=Path, help="columnas material|raw_material_id y counted_g")
+    p.add_argument("--apply", action="store_true", help="Aplica las diferencias (sin él, solo vista previa)")
+    p.add_argument("--desc", default="Recuento físico")
+    p.add_argument("--out", type=Path, help="CSV de diferencias (por defecto stdout)")
+    p.set_defaults(func=cmd_stock_count)
+
+    p = sub.add_parser("substitute", help="Sustituye una materia en todas las fórmulas")
+    p.add_argument("old", help="materia a sustituir (id o nombre)")
+    p.add_argument("new", help="materia sustituta (id o nombre)")
+    p.add_argument("--ratio", type=float, default=1.0, help="g de la nueva por g de la antigua")
+    p.add_argument("--formula", type=int, action="append", help="limita a estas fórmulas (id, repetible)")
+    p.add_argument("--comment", help="comentario de las nuevas revisiones")
+    p.add_argument("--dry-run", action="store_true", help="solo informa del cambio de coste")
+    p.add_argument("--out", type=Path, help="CSV de impacto (por defecto stdout)")
+    p.set_defaults(func=cmd_substitute)
+
+    p = sub.add_parser("jobs", help="Informes programados con caché en disco")
+    p.add_argument("action", choices=["run", "serve", "stats"])
+    p.add_argument("names", nargs="*", help="run: informes (todos por defecto)")
+    p.add_argument("--force", action="store_true", help="run: regenera aunque la caché esté vigente")
+    p.add_argument("--workers", type=int, default=None)
+    p.add_argument("--poll", type=float, default=60.0, help="serve: segundos entre comprobaciones")
+    p.set_defaults(func=cmd_jobs)
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    argv = list(sys.argv[1:] if argv is None else argv)
+    if len(argv) == 1 and argv[0].lower().endswith(".csv"):
+        argv = ["import", "materials", *argv]  # forma antigua: importer.py materias.csv
+    args = build_parser().parse_args(argv)
+    init_db()  # crea o actualiza el esquema, como la GUI al arrancar
+    _login(args.user)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,290 @@
+# jobs.py ── Informes programados: pool de procesos y caché en disco
+# =============================================================================
+# Cada informe declara las entidades que lee; su huella es el hash de sus
+# versiones en data_versions y de la época de la BD (ver events.py). Si la
+# caché ya tiene un fichero con esa huella se sirve tal cual; si no, se genera
+# en un proceso aparte ("spawn": el hijo abre sus propias conexiones) y se
+# escribe de forma atómica.
+# La caché se limita a CACHE_MAX_BYTES borrando primero lo usado hace más
+# tiempo, y cada petición queda en report_runs (duración, acierto de caché).
+from __future__ import annotations
+
+import hashlib
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from datetime import time as clock
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import case, func, select
+
+import events
+import exporter
+from db import session_scope, writer
+from models import DB_PATH, ReportRun
+
+CACHE_DIR = DB_PATH.with_name("report_cache")
+CACHE_MAX_BYTES = 512 * 2**20
+
+
+@dataclass(frozen=True)
+class ReportJob:
+    name: str
+    title: str
+    render: Callable[[Path], None]  # función de módulo (se envía al proceso hijo)
+    entities: Tuple[str, ...]  # entidades cuya versión forma la huella
+    suffix: str
+    at: Optional[clock] = None  # una vez al día a esta hora local
+    every: Optional[timedelta] = None  # o cada tanto tiempo
+
+
+JOBS: Dict[str, ReportJob] = {
+    j.name: j
+    for j in (
+        ReportJob(
+            "low-stock", "Stock bajo", exporter.export_low_stock_csv, ("RawMaterial",), ".csv",
+            every=timedelta(hours=1),
+        ),
+        ReportJob(
+            "formula-costs", "Costes de fórmulas", exporter.export_formulas_csv,
+            ("Formula", "RawMaterial", "IfraLimit"), ".csv", at=clock(2, 0),
+        ),
+        ReportJob(
+            "materials-pdf", "Materias primas (PDF)", exporter.export_materials_pdf, ("RawMaterial",), ".pdf",
+            at=clock(2, 0),
+        ),
+        ReportJob(
+            "pyramids", "Catálogo de pirámides (PDF)", exporter.export_pyramid_catalogue_pdf,
+            ("Formula", "RawMaterial"), ".pdf", at=clock(2, 0),
+        ),
+    )
+}
+
+
+@dataclass(frozen=True)
+class JobResult:
+    job: str
+    path: Optional[Path]  # None si falló
+    cache_hit: bool
+    duration_s: float
+    fingerprint: str
+    error: Optional[str] = None
+
+
+@dataclass(frozen=True)
+class JobStats:
+    job: str
+    requests: int
+    cache_hits: int
+    errors: int
+    avg_render_s: Optional[float]  # solo ejecuciones que generaron el informe
+    max_render_s: Optional[float]
+    last_run: Optional[datetime]
+
+    @property
+    def hit_rate(self) -> float:
+        return self.cache_hits / self.requests if self.requests else 0.0
+
+
+# ---------------------------------------------------------------------------#
+# Huella y caché
+# ---------------------------------------------------------------------------#
+
+
+def _versions() -> Dict[str, int]:
+    with session_scope() as s:
+        return events.data_versions(s.connection())
+
+
+def fingerprint(job: ReportJob, versions: Dict[str, int]) -> str:
+    entities = (events.EPOCH, *job.entities)  # la época cambia al restaurar una copia
+    key = "|".join([job.name, *(f"{e}={versions.get(e, 0)}" for e in entities)])
+    return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+
+def _cache_path(job: ReportJob, fp: str) -> Path:
+    return CACHE_DIR / f"{job.name}-{fp}{job.suffix}"
+
+
+def _touch(path: Path) -> None:
+    os.utime(path)  # la fecha de modificación hace de "último uso" para el LRU
+
+
+def prune_cache(max_bytes: int = CACHE_MAX_BYTES) -> int:
+    """
+    Borra las versiones superadas de cada informe (las versiones solo crecen, así
+    que no volverán a servirse) y, si aun así se pasa de ``max_bytes``, los
+    ficheros usados hace más tiempo. Devuelve los bytes liberados.
+    """
+    if not CACHE_DIR.exists():
+        return 0
+    files = sorted(
+        (p for p in CACHE_DIR.iterdir() if p.is_file() and ".tmp" not in p.suffixes),
+        key=lambda p: p.stat().st_mtime,
+        reverse=True,
+    )
+    seen, total, freed = set(), 0, 0
+    for p in files:
+        job = p.name.rsplit("-", 1)[0]
+        size = p.stat().st_size
+        if job in seen or total + size > max_bytes:
+            p.unlink(missing_ok=True)
+            freed += size
+            continue
+        seen.add(job)
+        total += size
+    return freed
+
+
+def cached(name: str) -> Optional[Path]:
+    """Fichero vigente del informe (sin generarlo); se anota como acierto de caché."""
+    job = JOBS[name]
+    fp = fingerprint(job, _versions())
+    path = _cache_path(job, fp)
+    if not path.exists():
+        return None
+    _touch(path)
+    _record([JobResult(name, path, True, 0.0, fp)])
+    return path
+
+
+# ---------------------------------------------------------------------------#
+# Ejecución
+# ---------------------------------------------------------------------------#
+
+
+def _render(name: str, path: str) -> float:
+    """En el proceso hijo: genera el informe en un temporal y lo publica con rename."""
+    t0 = time.perf_counter()
+    dest = Path(path)
+    tmp = dest.with_name(f"{dest.name}.{os.getpid()}.tmp")
+    try:
+        JOBS[name].render(tmp)
+        os.replace(tmp, dest)
+    finally:
+        tmp.unlink(missing_ok=True)
+    return time.perf_counter() - t0
+
+
+def run(names: Optional[Iterable[str]] = None, force: bool = False, workers: Optional[int] = None) -> List[JobResult]:
+    """
+    Ejecuta los informes indicados (todos por defecto). Los que ya están en la
+    caché con la huella actual no se regeneran salvo con ``force``.
+    """
+    names = list(names or JOBS)
+    for n in names:
+        if n not in JOBS:
+            raise ValueError(f"Informe desconocido: {n!r}")
+    versions = _versions()
+    results: List[JobResult] = []
+    todo: Dict[str, Tuple[str, Path]] = {}
+    for n in names:
+        job = JOBS[n]
+        fp = fingerprint(job, versions)
+        path = _cache_path(job, fp)
+        if path.exists() and not force:
+            _touch(path)
+            results.append(JobResult(n, path, True, 0.0, fp))
+        else:
+            todo[n] = (fp, path)
+
+    if todo:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        with ProcessPoolExecutor(
+            max_workers=min(workers or os.cpu_count() or 1, len(todo)),
+            mp_context=multiprocessing.get_context("spawn"),
+        ) as pool:
+            futures = {pool.submit(_render, n, str(path)): n for n, (_fp, path) in todo.items()}
+            for fut in as_completed(futures):
+                n = futures[fut]
+                fp, path = todo[n]
+                try:
+                    results.append(JobResult(n, path, False, fut.result(), fp))
+                except Exception as e:
+                    results.append(JobResult(n, None, False, 0.0, fp, error=f"{type(e).__name__}: {e}"))
+        prune_cache()
+    _record(results)
+    return results
+
+
+@writer
+def _record(results: List[JobResult]) -> None:
+    with session_scope() as s:
+        s.add_all(
+            ReportRun(
+                job=r.job,
+                duration_s=r.duration_s,
+                cache_hit=r.cache_hit,
+                fingerprint=r.fingerprint,
+                size_bytes=r.path.stat().st_size if r.path and r.path.exists() else None,
+                error=r.error,
+            )
+            for r in results
+        )
+
+
+# ---------------------------------------------------------------------------#
+# Planificación y estadísticas
+# ---------------------------------------------------------------------------#
+
+
+def _last_runs() -> Dict[str, datetime]:
+    with session_scope() as s:
+        return dict(
+            s.execute(
+                select(ReportRun.job, func.max(ReportRun.started_at))
+                .where(ReportRun.error.is_(None))
+                .group_by(ReportRun.job)
+            ).tuples().all()
+        )
+
+
+def due(now: Optional[datetime] = None) -> List[str]:
+    """Informes que tocan según su planificación (``now`` y fechas de BD en UTC)."""
+    now = now or datetime.utcnow()
+    last = _last_runs()
+    out = []
+    for job in JOBS.values():
+        prev = last.get(job.name)
+        if job.every is not None and (prev is None or now - prev >= job.every):
+            out.append(job.name)
+        elif job.at is not None:
+            today = now.replace(tzinfo=timezone.utc).astimezone().date()  # fecha local
+            slot = datetime.combine(today, job.at).astimezone(timezone.utc).replace(tzinfo=None)
+            if now >= slot and (prev is None or prev < slot):
+                out.append(job.name)
+    return out
+
+
+def serve(poll_s: float = 60.0, workers: Optional[int] = None) -> None:
+    """Bucle del planificador: cada ``poll_s`` segundos ejecuta lo que toque."""
+    while True:
+        names = due()
+        if names:
+            for r in run(names, workers=workers):
+                state = r.error or ("caché" if r.cache_hit else f"{r.duration_s:.1f} s")
+                print(f"{datetime.now():%Y-%m-%d %H:%M} {r.job}: {state}", flush=True)
+        time.sleep(poll_s)
+
+
+def stats(since: Optional[datetime] = None) -> List[JobStats]:
+    """Peticiones, aciertos de caché y duración de generación por informe."""
+    rr = ReportRun
+    rendered = (rr.cache_hit.is_(False)) & rr.error.is_(None)
+    stmt = select(
+        rr.job,
+        func.count(),
+        func.sum(case((rr.cache_hit, 1), else_=0)),
+        func.sum(case((rr.error.is_not(None), 1), else_=0)),
+        func.avg(case((rendered, rr.duration_s))),
+        func.max(case((rendered, rr.duration_s))),
+        func.max(rr.started_at),
+    ).group_by(rr.job).order_by(rr.job)
+    if since is not None:
+        stmt = stmt.where(rr.started_at >= since)
+    with session_scope() as s:
+        return [JobStats(*row) for row in s.execute(stmt)]
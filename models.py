@@ -3,6 +3,7 @@
 
 from __future__ import annotations
 import enum
+import os
 from datetime import datetime
 from pathlib import Path
 from typing import List, Optional
@@ -14,11 +15,16 @@ from sqlalchemy import (
     Enum,
     Float,
     ForeignKey,
+    Index,
     Integer,
+    LargeBinary,
     String,
     Text,
     UniqueConstraint,
     create_engine,
+    event,
+    false,
+    text,
 )
 from sqlalchemy.orm import (
     DeclarativeBase,
@@ -29,6 +35,8 @@ from sqlalchemy.orm import (
     validates,
 )
 from sqlalchemy.engine import Engine
+from sqlalchemy.schema import CreateColumn
+from sqlalchemy.pool import QueuePool
 
 # ---------------------------------------------------------------------------#
 # Base
@@ -70,13 +78,13 @@ class AuditLog(Base):
     __tablename__ = "audit_logs"
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
-    user_id: Mapped[int] = mapped_column(ForeignKey("users.id"))
+    user_id: Mapped[Optional[int]] = mapped_column(ForeignKey("users.id"))  # None: "sistema" (CLI sin --user)
     action: Mapped[str] = mapped_column(String(64))
     entity: Mapped[str] = mapped_column(String(64))
     entity_id: Mapped[int] = mapped_column(Integer)
-    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, index=True)
 
-    user: Mapped["User"] = relationship(back_populates="logs")
+    user: Mapped[Optional["User"]] = relationship(back_populates="logs")
 
 
 # ---------------------------------------------------------------------------#
@@ -99,28 +107,72 @@ class RawMaterial(Base):
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     name: Mapped[str] = mapped_column(String(128), nullable=False)
-    category: Mapped[Optional[str]] = mapped_column(String(64))
-    cost_per_g: Mapped[float] = mapped_column(Float, default=0.0)
-    inventory_g: Mapped[float] = mapped_column(Float, default=0.0)
+    # índices: orden y filtro de la tabla de materias se resuelven en SQL
+    category: Mapped[Optional[str]] = mapped_column(String(64), index=True)
+    cost_per_g: Mapped[float] = mapped_column(Float, default=0.0, index=True)
+    inventory_g: Mapped[float] = mapped_column(Float, default=0.0, index=True)
     low_stock_threshold_g: Mapped[float] = mapped_column(Float, default=100)
     fragrance_pyramid_level: Mapped[PyramidLevel] = mapped_column(
         Enum(PyramidLevel), default=PyramidLevel.MIDDLE
     )
+    # Límite IFRA genérico (% en producto final); None = sin restricción
+    ifra_limit_pct: Mapped[Optional[float]] = mapped_column(Float)
+    notes: Mapped[Optional[str]] = mapped_column(Text)
 
     movements: Mapped[List["InventoryMovement"]] = relationship(
         back_populates="raw_material", cascade="all, delete-orphan"
     )
+    ifra_limits: Mapped[List["IfraLimit"]] = relationship(
+        back_populates="raw_material", cascade="all, delete-orphan"
+    )
+
+
+class IfraLimit(Base):
+    """Límite IFRA de una materia para una categoría de producto concreta."""
+
+    __tablename__ = "ifra_limits"
+    __table_args__ = (
+        UniqueConstraint("raw_material_id", "product_category", name="uq_ifra_rm_cat"),
+        CheckConstraint("limit_pct >= 0", name="ck_ifra_nonneg"),
+    )
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    raw_material_id: Mapped[int] = mapped_column(ForeignKey("raw_materials.id"))
+    product_category: Mapped[str] = mapped_column(String(32), nullable=False)
+    limit_pct: Mapped[float] = mapped_column(Float, nullable=False)
+
+    raw_material: Mapped["RawMaterial"] = relationship(back_populates="ifra_limits")
+
+
+class MovementKind(str, enum.Enum):
+    CONSUMPTION = "consumo"  # salida por uso o producción: la única que cuenta en la previsión
+    ADJUSTMENT = "ajuste"  # entradas, mermas y correcciones manuales
+    STOCKTAKE = "recuento"  # regularización de un recuento físico
 
 
 class InventoryMovement(Base):
     __tablename__ = "inventory_movements"
-    __table_args__ = (CheckConstraint("delta_g != 0", name="ck_delta_nonzero"),)
+    __table_args__ = (
+        CheckConstraint("delta_g != 0", name="ck_delta_nonzero"),
+        Index(
+            "ix_mov_opening",
+            "raw_material_id",
+            sqlite_where=text("opening_balance = 1"),
+            postgresql_where=text("opening_balance"),
+        ),
+    )
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
-    raw_material_id: Mapped[int] = mapped_column(ForeignKey("raw_materials.id"))
+    raw_material_id: Mapped[int] = mapped_column(ForeignKey("raw_materials.id"), index=True)
     delta_g: Mapped[float] = mapped_column(Float, nullable=False)
     description: Mapped[str] = mapped_column(String(120))
-    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, index=True)
+    # Saldo de los movimientos ya archivados (ver archive.py); uno por materia como máximo
+    opening_balance: Mapped[bool] = mapped_column(Boolean, default=False, server_default=false())
+    # Las filas anteriores a la columna no se pueden clasificar: quedan como ajustes
+    kind: Mapped[MovementKind] = mapped_column(
+        Enum(MovementKind), default=MovementKind.ADJUSTMENT, server_default=MovementKind.ADJUSTMENT.name
+    )
 
     raw_material: Mapped["RawMaterial"] = relationship(back_populates="movements")
 
@@ -136,6 +188,8 @@ class Formula(Base):
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     name: Mapped[str] = mapped_column(String(120), unique=True, nullable=False)
     description: Mapped[Optional[str]] = mapped_column(Text)
+    # Categoría de producto IFRA (p. ej. "4" = fine fragrance)
+    category: Mapped[Optional[str]] = mapped_column(String(32), index=True)
 
     revisions: Mapped[List["FormulaRevision"]] = relationship(
         back_populates="formula",
@@ -174,8 +228,8 @@ class FormulaEntry(Base):
     __tablename__ = "formula_entries"
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
-    revision_id: Mapped[int] = mapped_column(ForeignKey("formula_revisions.id"))
-    raw_material_id: Mapped[int] = mapped_column(ForeignKey("raw_materials.id"))
+    revision_id: Mapped[int] = mapped_column(ForeignKey("formula_revisions.id"), index=True)
+    raw_material_id: Mapped[int] = mapped_column(ForeignKey("raw_materials.id"), index=True)
     weight_g: Mapped[float] = mapped_column(Float, nullable=False)
     dilution: Mapped[Optional[str]] = mapped_column(String(40))
 
@@ -189,11 +243,93 @@ class FormulaEntry(Base):
         return v
 
 
+class FormulaVector(Base):
+    """Vector de composición normalizado de la última revisión (índice de similitud)."""
+
+    __tablename__ = "formula_vectors"
+
+    formula_id: Mapped[int] = mapped_column(ForeignKey("formulas.id"), primary_key=True)
+    revision_id: Mapped[int] = mapped_column(ForeignKey("formula_revisions.id"))
+    material_ids: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)  # int32[]
+    weights: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)  # float32[]
+
+
+# ---------------------------------------------------------------------------#
+# Versiones de datos e informes programados
+# ---------------------------------------------------------------------------#
+
+
+class DataVersion(Base):
+    """Contador por entidad; sube en cada commit que la modifica (ver events.py)."""
+
+    __tablename__ = "data_versions"
+
+    entity: Mapped[str] = mapped_column(String(64), primary_key=True)
+    version: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+
+
+class ReportRun(Base):
+    """Una petición de informe a jobs.py, servida desde la caché o generada."""
+
+    __tablename__ = "report_runs"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    job: Mapped[str] = mapped_column(String(64), index=True)
+    started_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, index=True)
+    duration_s: Mapped[float] = mapped_column(Float, default=0.0)
+    cache_hit: Mapped[bool] = mapped_column(Boolean, default=False)
+    fingerprint: Mapped[str] = mapped_column(String(40))
+    size_bytes: Mapped[Optional[int]] = mapped_column(Integer)
+    error: Mapped[Optional[str]] = mapped_column(Text)
+
+
 # ---------------------------------------------------------------------------#
 # Engine y semilla
 # ---------------------------------------------------------------------------#
 _DB_PATH = Path(__file__).with_name("formulair.db")
-engine = create_engine(f"sqlite:///{_DB_PATH}", future=True)
+DB_URL = os.getenv("FORMULAIR_DB_URL", f"sqlite:///{_DB_PATH}")
+
+
+def _make_engine(url: str) -> Engine:
+    """
+    SQLite: pool de conexiones compartible entre hilos, WAL (lectores y escritor no
+    se bloquean) y espera de hasta 30 s al escritor de otro proceso. Las escrituras
+    del propio proceso se serializan en db.write_queue.
+    Otros motores (PostgreSQL): QueuePool clásico con comprobación de conexión.
+    """
+    if url.startswith("sqlite"):
+        eng = create_engine(
+            url,
+            future=True,
+            poolclass=QueuePool,
+            pool_size=8,
+            max_overflow=16,
+            connect_args={"timeout": 30, "check_same_thread": False},
+        )
+
+        @event.listens_for(eng, "connect")
+        def _sqlite_pragmas(dbapi_conn, _):
+            cur = dbapi_conn.cursor()
+            cur.execute("PRAGMA journal_mode=WAL")
+            cur.execute("PRAGMA synchronous=NORMAL")
+            cur.close()
+
+        return eng
+    return create_engine(
+        url,
+        future=True,
+        poolclass=QueuePool,
+        pool_size=10,
+        max_overflow=20,
+        pool_pre_ping=True,
+        pool_recycle=1800,
+    )
+
+
+engine = _make_engine(DB_URL)
+# Fichero de la BD en uso (también con FORMULAIR_DB_URL): a su lado van el
+# archivo, las instantáneas y la caché de informes
+DB_PATH = Path(engine.url.database) if engine.dialect.name == "sqlite" else _DB_PATH
 SessionLocal = sessionmaker(bind=engine, future=True, expire_on_commit=False)
 
 
@@ -202,6 +338,53 @@ def get_engine() -> Engine:
     return engine
 
 
+def _rebuild_sqlite_table(conn, table, old_columns: List[str], old_indexes: List[str]) -> None:
+    """SQLite no tiene ALTER COLUMN: se recrea la tabla con el esquema actual y se copian las filas."""
+    for name in old_indexes:
+        conn.exec_driver_sql(f'DROP INDEX "{name}"')
+    conn.exec_driver_sql(f'ALTER TABLE {table.name} RENAME TO "{table.name}__old"')
+    table.create(conn)
+    cols = ", ".join(f'"{c.name}"' for c in table.columns if c.name in old_columns)
+    conn.exec_driver_sql(f'INSERT INTO {table.name} ({cols}) SELECT {cols} FROM "{table.name}__old"')
+    conn.exec_driver_sql(f'DROP TABLE "{table.name}__old"')
+
+
+def _upgrade_schema(eng: Engine) -> None:
+    """
+    Añade a una BD existente las columnas (nullable o con valor por defecto en el
+    servidor) e índices nuevos que create_all no crea, y quita el NOT NULL de las
+    columnas que han pasado a admitir nulos.
+    """
+    from sqlalchemy import inspect
+
+    insp = inspect(eng)
+    with eng.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not insp.has_table(table.name):
+                continue
+            existing = {c["name"]: c for c in insp.get_columns(table.name)}
+            relaxed = [
+                c.name
+                for c in table.columns
+                if c.name in existing and c.nullable and not c.primary_key and not existing[c.name]["nullable"]
+            ]
+            if relaxed and eng.dialect.name == "sqlite":
+                indexes = [ix["name"] for ix in insp.get_indexes(table.name)]
+                _rebuild_sqlite_table(conn, table, list(existing), indexes)
+                continue
+            for name in relaxed:
+                conn.exec_driver_sql(f'ALTER TABLE {table.name} ALTER COLUMN "{name}" DROP NOT NULL')
+            present = set(existing)
+            for col in table.columns:
+                if col.name in present or not (col.nullable or col.server_default is not None):
+                    continue
+                # tipo, DEFAULT y NOT NULL como los escribe el dialecto (false() → 0 / false)
+                ddl = CreateColumn(col).compile(dialect=eng.dialect)
+                conn.exec_driver_sql(f"ALTER TABLE {table.name} ADD COLUMN {ddl}")
+            for idx in table.indexes:
+                idx.create(conn, checkfirst=True)
+
+
 def init_db(drop: bool = False):
     from passlib.hash import pbkdf2_sha256
     from sqlalchemy import select
@@ -210,6 +393,7 @@ def init_db(drop: bool = False):
     if drop:
         Base.metadata.drop_all(engine)
     Base.metadata.create_all(engine)
+    _upgrade_schema(engine)
 
     with Session(engine) as s:
         if not s.scalar(select(User).where(User.username == "admin")):
@@ -0,0 +1,118 @@
+# mrp.py ── Planificación de necesidades de materias (MRP)
+# =============================================================================
+from __future__ import annotations
+
+import math
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Iterable, List, Optional
+
+import numpy as np
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from composition import CompositionMatrix, load_composition
+from models import RawMaterial
+
+if TYPE_CHECKING:
+    from catalog import MaterialColumns
+
+
+@dataclass(frozen=True)
+class PlanLine:
+    formula_id: int
+    batch_g: float
+
+
+@dataclass(frozen=True)
+class MaterialRequirement:
+    raw_material_id: int
+    name: str
+    required_g: float
+    inventory_g: float
+    low_stock_threshold_g: float
+    shortage_g: float  # lo que falta para producir el plan
+    purchase_g: float  # compra sugerida para acabar por encima del umbral
+    purchase_cost: float
+
+
+def plan_requirements(
+    s: Session,
+    plan: Iterable[PlanLine],
+    comp: Optional[CompositionMatrix] = None,
+    materials: Optional[MaterialColumns] = None,
+) -> List[MaterialRequirement]:
+    """
+    Agrega las necesidades de todo el plan (última revisión de cada fórmula escalada
+    al peso del lote) en un único producto disperso y las compara con el stock.
+    Con ``materials`` (instantánea del catálogo) el stock se lee de sus arrays.
+    """
+    plan = list(plan)
+    if comp is None:
+        comp = load_composition(s, latest_only=True, formula_ids=(l.formula_id for l in plan))
+    row_of = {int(f): i for i, f in enumerate(comp.formula_ids)}
+
+    batch = np.zeros(len(comp.formula_ids))
+    for line in plan:
+        if line.formula_id not in row_of:
+            raise ValueError(f"Fórmula {line.formula_id} sin revisión con entradas.")
+        if not math.isfinite(line.batch_g) or line.batch_g <= 0:  # NaN contaminaría todos los totales
+            raise ValueError(f"Peso de lote no válido para la fórmula {line.formula_id}: {line.batch_g!r} (> 0)")
+        batch[row_of[line.formula_id]] += line.batch_g
+
+    total = comp.total_weight
+    scale = np.divide(batch, total, out=np.zeros_like(batch), where=total > 0)
+    required = comp.weights.T @ scale
+
+    need = np.flatnonzero(required > 0)
+    ids = comp.material_ids[need]
+    if materials is not None:
+        rows = materials.rows(ids)
+        names = [materials.names[r] for r in rows.tolist()]
+        inv = materials.inventory_g[rows]
+        thr = materials.low_stock_threshold_g[rows]
+        cost = materials.cost_per_g[rows]
+    else:
+        stock = {
+            rm_id: (name, inv or 0.0, thr or 0.0, cost or 0.0)
+            for rm_id, name, inv, thr, cost in s.execute(
+                select(
+                    RawMaterial.id,
+                    RawMaterial.name,
+                    RawMaterial.inventory_g,
+                    RawMaterial.low_stock_threshold_g,
+                    RawMaterial.cost_per_g,
+                )
+            )
+        }
+        names = [stock[i][0] for i in ids.tolist()]
+        inv = np.array([stock[i][1] for i in ids.tolist()])
+        thr = np.array([stock[i][2] for i in ids.tolist()])
+        cost = np.array([stock[i][3] for i in ids.tolist()])
+    req = required[need]
+    shortage = np.maximum(req - inv, 0.0)
+    purchase = np.maximum(req + thr - inv, 0.0)
+
+    out = [
+        MaterialRequirement(
+            raw_material_id=rm_id,
+            name=name,
+            required_g=r,
+            inventory_g=i,
+            low_stock_threshold_g=t,
+            shortage_g=sh,
+            purchase_g=p,
+            purchase_cost=p * c,
+        )
+        for rm_id, name, r, i, t, sh, p, c in zip(
+            ids.tolist(),
+            names,
+            req.tolist(),
+            inv.tolist(),
+            thr.tolist(),
+            shortage.tolist(),
+            purchase.tolist(),
+            cost.tolist(),
+        )
+    ]
+    out.sort(key=lambda m: (-m.shortage_g, -m.purchase_g, m.name))
+    return out
@@ -0,0 +1,105 @@
+# pricing.py ── Simulación "what-if" de cambios de precio (solo lectura)
+# =============================================================================
+from __future__ import annotations
+
+import math
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, List, Mapping, Optional
+
+import numpy as np
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from composition import CompositionMatrix, load_composition
+from models import Formula, FormulaRevision, RawMaterial
+
+if TYPE_CHECKING:
+    from catalog import MaterialColumns
+
+CHUNK = 500  # revisiones por consulta de metadatos (límite de parámetros de SQLite)
+
+
+@dataclass(frozen=True)
+class PriceImpact:
+    formula_id: int
+    formula_name: str
+    revision_id: int
+    revision_number: int
+    old_cost: float
+    new_cost: float
+
+    @property
+    def delta(self) -> float:
+        return self.new_cost - self.old_cost
+
+    @property
+    def delta_pct(self) -> float:
+        return 100.0 * self.delta / self.old_cost if self.old_cost else 0.0
+
+
+def simulate_price_change(
+    s: Session,
+    new_prices: Mapping[int, float],
+    latest_only: bool = True,
+    comp: Optional[CompositionMatrix] = None,
+    materials: Optional[MaterialColumns] = None,
+) -> List[PriceImpact]:
+    """
+    Recalcula el coste de todas las revisiones con los ``cost_per_g`` propuestos
+    (raw_material_id → €/g) como un único producto matriz dispersa × vector.
+    Devuelve solo las revisiones afectadas, de mayor a menor impacto absoluto.
+    No escribe nada en la base de datos. Con ``materials`` (instantánea del
+    catálogo) los precios actuales salen de sus arrays en vez de la BD.
+    """
+    for rm_id, price in new_prices.items():
+        if not math.isfinite(price) or price < 0:  # NaN/inf contaminarían todos los costes
+            raise ValueError(f"Precio no válido para la materia {rm_id}: {price!r} (>= 0)")
+    if comp is None:  # solo hacen falta las revisiones que usan alguna materia cambiada
+        comp = load_composition(s, latest_only=latest_only, containing=new_prices)
+    mat_ix = comp.material_index()
+
+    if materials is not None:
+        old_p = materials.cost_per_g[materials.rows(comp.material_ids)]
+    else:
+        old_p = np.zeros(len(comp.material_ids))
+        for rm_id, cost in s.execute(select(RawMaterial.id, RawMaterial.cost_per_g)):
+            if rm_id in mat_ix:
+                old_p[mat_ix[rm_id]] = cost or 0.0
+    new_p = old_p.copy()
+    changed = [mat_ix[rm_id] for rm_id in new_prices if rm_id in mat_ix]
+    for rm_id in new_prices:
+        if rm_id in mat_ix:
+            new_p[mat_ix[rm_id]] = new_prices[rm_id]
+    if not changed:
+        return []
+
+    old_cost = comp.weights @ old_p
+    new_cost = comp.weights @ new_p
+    hit = np.flatnonzero(comp.weights[:, changed].getnnz(axis=1))
+    hit = hit[np.argsort(-np.abs(new_cost[hit] - old_cost[hit]), kind="stable")]
+
+    meta = {}
+    hit_ids = comp.revision_ids[hit].tolist()
+    for i in range(0, len(hit_ids), CHUNK):
+        meta.update(
+            (rid, (num, fid, name))
+            for rid, num, fid, name in s.connection().execute(
+                select(FormulaRevision.id, FormulaRevision.number, Formula.id, Formula.name)
+                .join(Formula, Formula.id == FormulaRevision.formula_id)
+                .where(FormulaRevision.id.in_(hit_ids[i : i + CHUNK]))
+            )
+        )
+    out = []
+    for r in hit.tolist():
+        num, fid, name = meta[int(comp.revision_ids[r])]
+        out.append(
+            PriceImpact(
+                formula_id=fid,
+                formula_name=name,
+                revision_id=int(comp.revision_ids[r]),
+                revision_number=num,
+                old_cost=float(old_cost[r]),
+                new_cost=float(new_cost[r]),
+            )
+        )
+    return out
@@ -3,42 +3,38 @@
 from __future__ import annotations
 
 import csv
-from contextlib import contextmanager
+from dataclasses import dataclass
 from pathlib import Path
-from typing import Iterator, List, Sequence
+from typing import Iterable, List, Mapping, Optional, Sequence
 
+import numpy as np
 from deepdiff import DeepDiff
-from sqlalchemy.orm import Session, selectinload
+from sqlalchemy import func, insert, select
+from sqlalchemy.orm import aliased
 
 from models import (
-    SessionLocal,
     RawMaterial,
     InventoryMovement,
+    MovementKind,
     Formula,
     FormulaRevision,
     FormulaEntry,
     PyramidLevel,
     AuditLog,
+    IfraLimit,
 )
 from session import current_user
-
-# ---------------------------------------------------------------------------#
-# Session helper
-# ---------------------------------------------------------------------------#
-
-
-@contextmanager
-def session_scope() -> Iterator[Session]:
-    s = SessionLocal()
-    try:
-        yield s
-        s.commit()
-    except Exception:
-        s.rollback()
-        raise
-    finally:
-        s.close()
-
+from db import session_scope, writer
+from dto import FormulaDTO, MaterialDTO, RevisionDTO, RevisionStatsDTO
+from catalog import MATERIAL_FIELDS, catalog, columns_from_rows
+from compliance import IfraViolation, check_ifra
+import events
+import forecast
+import mrp
+import pricing
+import similarity
+import stocktake
+import substitution
 
 # ---------------------------------------------------------------------------#
 # Auditoría
@@ -46,6 +42,7 @@ def session_scope() -> Iterator[Session]:
 
 
 def _log(action: str, entity: str, entity_id: int):
+    """Dentro de otro session_scope() se confirma en la misma transacción."""
     usr = current_user()
     with session_scope() as s:
         s.add(
@@ -58,22 +55,44 @@ def _log(action: str, entity: str, entity_id: int):
         )
 
 
+def _author() -> str:
+    """Nombre para ``FormulaRevision.author``; "sistema" en procesos sin usuario."""
+    usr = current_user()
+    return usr.username if usr else "sistema"
+
+
 # ---------------------------------------------------------------------------#
 # CRUD materias
 # ---------------------------------------------------------------------------#
 
 
-def list_all(model) -> List:
-    with session_scope() as s:
-        return s.query(model).all()
+def list_materials(ids: Optional[Iterable[int]] = None) -> List[MaterialDTO]:
+    """Materias desde la instantánea del catálogo (los ``ids`` inexistentes se ignoran)."""
+    if ids is None:
+        mats = catalog.materials()
+        return [mats.dto(r) for r in range(len(mats))]
+    ids = list(ids)
+    mats = catalog.materials(ids)
+    return [mats.dto(mats.row[i]) for i in ids if i in mats.row]
+
+
+def reload_catalog() -> None:
+    """
+    Descarta la instantánea del catálogo y el índice de similitud en memoria
+    (p. ej. tras cambios de otro proceso).
+    """
+    catalog.invalidate()
+    similarity.invalidate()
 
 
-def create_raw_material(**kwargs):
+@writer
+def create_raw_material(**kwargs) -> int:
     with session_scope() as s:
         rm = RawMaterial(**kwargs)
         s.add(rm)
         s.flush()
         _log("create", "RawMaterial", rm.id)
+        return rm.id
 
 
 # ---------------------------------------------------------------------------#
@@ -81,36 +100,68 @@ def create_raw_material(**kwargs):
 # ---------------------------------------------------------------------------#
 
 
-def adjust_stock(raw_material_id: int, delta_g: float, desc=""):
+@writer
+def adjust_stock(raw_material_id: int, delta_g: float, desc="", kind: MovementKind = MovementKind.ADJUSTMENT):
+    """Mueve el stock; solo las salidas de tipo ``CONSUMPTION`` cuentan como consumo en la previsión."""
     if delta_g == 0:
         return
     with session_scope() as s:
         rm = s.get(RawMaterial, raw_material_id)
         rm.inventory_g += delta_g
         s.add(
-            InventoryMovement(raw_material_id=rm.id, delta_g=delta_g, description=desc)
+            InventoryMovement(raw_material_id=rm.id, delta_g=delta_g, description=desc, kind=kind)
         )
-    _log("stock", "RawMaterial", raw_material_id)
+        _log("stock", "RawMaterial", raw_material_id)
+
+
+def preview_stocktake(path: Path) -> stocktake.StockTake:
+    """Diferencias entre un recuento físico (CSV) y el stock, sin escribir nada."""
+    with session_scope() as s:
+        return stocktake.reconcile(s, path)
 
 
-def low_stock_alerts() -> List[RawMaterial]:
+@writer
+def apply_stocktake(path: Path, description: str = "Recuento físico") -> stocktake.StockTake:
+    """
+    Ajusta el stock al recuento en una sola transacción: un movimiento por materia
+    con diferencia y una única entrada de auditoría que apunta al primero.
+    """
+    if current_user() is None:
+        raise PermissionError("Aplicar un recuento requiere un usuario (auditoría).")
     with session_scope() as s:
-        return (
-            s.query(RawMaterial)
-            .filter(RawMaterial.inventory_g < RawMaterial.low_stock_threshold_g)
-            .all()
+        res = stocktake.reconcile(s, path, apply=True, description=description)
+        if res.applied:
+            _log("stocktake", "InventoryMovement", res.first_movement_id)
+            events.record(s, "RawMaterial", events.UPDATE, (d.raw_material_id for d in res.discrepancies))
+        return res
+
+
+def low_stock_alerts() -> List[MaterialDTO]:
+    mats = catalog.materials()
+    low = np.flatnonzero(mats.inventory_g < mats.low_stock_threshold_g)
+    return [mats.dto(r) for r in low.tolist()]
+
+
+def stock_forecast(
+    ids: Optional[Iterable[int]] = None,
+    window_days: int = forecast.WINDOW_DAYS,
+    lead_time_days: int = forecast.LEAD_TIME_DAYS,
+) -> List[forecast.StockForecast]:
+    """Consumo previsto y días hasta agotar el stock (materias con consumo reciente)."""
+    with session_scope() as s:
+        return forecast.forecast(
+            s, catalog.materials(ids), ids, window_days=window_days, lead_time_days=lead_time_days
         )
 
 
 # ---------------------------------------------------------------------------#
 # -----------  VERSIONADO DE FÓRMULAS  --------------------------------------
 # ---------------------------------------------------------------------------#
+@writer
 def create_formula(name: str, comment: str, entries: Sequence[tuple]):
     with session_scope() as s:
         form = Formula(name=name)
-        rev = FormulaRevision(
-            number=1, author=current_user().username, comment=comment
-        )
+        rev = FormulaRevision(number=1, author=_author(), comment=comment)
         for rm_id, w, dil in entries:
             rev.entries.append(
                 FormulaEntry(raw_material_id=rm_id, weight_g=w, dilution=dil)
@@ -119,16 +170,23 @@ def create_formula(name: str, comment: str, entries: Sequence[tuple]):
         s.add(form)
         s.flush()
         _log("create", "Formula", form.id)
-        return form.id
+    _reindex(form.id)
+    return form.id
 
 
+@writer
 def clone_revision(formula_id: int, comment: str) -> int:
     with session_scope() as s:
-        form = s.get(Formula, formula_id)
-        base = form.revisions[-1]
+        base = (
+            s.query(FormulaRevision)
+            .filter_by(formula_id=formula_id)
+            .order_by(FormulaRevision.number.desc())
+            .first()
+        )
         new_rev = FormulaRevision(
+            formula_id=formula_id,
             number=base.number + 1,
-            author=current_user().username,
+            author=_author(),
             comment=comment,
         )
         for e in base.entries:
@@ -139,11 +197,47 @@ def clone_revision(formula_id: int, comment: str) -> int:
                     dilution=e.dilution,
                 )
             )
-        form.revisions.append(new_rev)
         s.add(new_rev)
         s.flush()
         _log("clone", "FormulaRevision", new_rev.id)
-        return new_rev.id
+    _reindex(formula_id)
+    return new_rev.id
+
+
+def substitute_material(
+    old_id: int,
+    new_id: int,
+    ratio: float = 1.0,
+    formula_ids: Optional[Iterable[int]] = None,
+    comment: Optional[str] = None,
+    dry_run: bool = False,
+) -> substitution.Substitution:
+    """
+    Sustituye una materia por otra en la última revisión de las fórmulas que la
+    usan, creando una revisión nueva en cada una. ``dry_run`` solo informa del
+    cambio de coste por fórmula.
+    """
+    if dry_run:
+        with session_scope() as s:
+            return substitution.substitute(s, old_id, new_id, ratio, formula_ids)
+    return _apply_substitution(old_id, new_id, ratio, formula_ids, comment)
+
+
+@writer
+def _apply_substitution(old_id, new_id, ratio, formula_ids, comment) -> substitution.Substitution:
+    if current_user() is None:
+        raise PermissionError("Sustituir materias requiere un usuario (auditoría).")
+    with session_scope() as s:
+        res = substitution.substitute(
+            s, old_id, new_id, ratio, formula_ids, apply=True, author=_author(), comment=comment
+        )
+        touched = [i.formula_id for i in res.impacts]
+        if res.applied:
+            _log("substitute", "RawMaterial", old_id)  # una entrada para todo el lote
+            events.record(s, "Formula", events.UPDATE, touched)
+    if res.applied:
+        _reindex(*touched)
+    return res
 
 
 def diff_revisions(rev_a_id: int, rev_b_id: int) -> str:
@@ -161,16 +255,335 @@ def diff_revisions(rev_a_id: int, rev_b_id: int) -> str:
         return diff.pretty()
 
 
-def list_formulas() -> List[Formula]:
+# ---------------------------------------------------------------------------#
+# Similitud
+# ---------------------------------------------------------------------------#
+
+
+def _reindex(*formula_ids: int):
+    """Actualiza el índice de similitud tras confirmar cambios en fórmulas."""
+    with session_scope() as s:
+        similarity.update_formulas(s, formula_ids)
+
+
+def similar_formulas(formula_id: int, k: int = 10) -> List[similarity.SimilarFormula]:
+    with session_scope() as s:
+        return similarity.similar_formulas(s, formula_id, k)
+
+
+def duplicate_report(threshold: float = 0.98) -> List[similarity.DuplicatePair]:
+    with session_scope() as s:
+        return similarity.duplicate_pairs(s, threshold)
+
+
+def list_formulas(ids: Optional[Iterable[int]] = None) -> List[FormulaDTO]:
     """
-    Devuelve todas las fórmulas con sus revisiones ya cargadas (evita DetachedInstanceError).
+    Fórmulas (todas o las de ``ids``) con su última revisión, el nº de revisiones
+    y el peso/coste de la última, en una única consulta agregada.
     """
+    ids = None if ids is None else list(ids)
+    rev, other = FormulaRevision, aliased(FormulaRevision)
+    # subconsultas correlacionadas: cada una es una búsqueda en el índice (formula_id, number)
+    last_number = select(func.max(other.number)).where(other.formula_id == Formula.id).scalar_subquery()
+    n_revisions = select(func.count(other.id)).where(other.formula_id == Formula.id).scalar_subquery()
+    stmt = (
+        select(
+            Formula.id,
+            Formula.name,
+            Formula.description,
+            Formula.category,
+            rev.id,
+            rev.number,
+            rev.created_at,
+            rev.author,
+            rev.comment,
+            n_revisions,
+            func.coalesce(func.sum(FormulaEntry.weight_g), 0.0),
+            func.coalesce(func.sum(FormulaEntry.weight_g * RawMaterial.cost_per_g), 0.0),
+        )
+        .select_from(Formula)
+        .outerjoin(rev, (rev.formula_id == Formula.id) & (rev.number == last_number))
+        .outerjoin(FormulaEntry, FormulaEntry.revision_id == rev.id)
+        .outerjoin(RawMaterial, RawMaterial.id == FormulaEntry.raw_material_id)
+        .group_by(Formula.id, rev.id)
+        .order_by(Formula.id)
+    )
+    if ids is not None:
+        stmt = stmt.where(Formula.id.in_(ids))
     with session_scope() as s:
-        return (
-            s.query(Formula)
-            .options(selectinload(Formula.revisions))
-            .all()
+        rows = s.execute(stmt).all()
+    return [
+        FormulaDTO(
+            id=fid,
+            name=name,
+            description=desc,
+            category=cat,
+            latest_revision=(
+                RevisionDTO(rid, fid, number, created, author, comment) if rid is not None else None
+            ),
+            revision_count=n_revs,
+            total_weight_g=weight,
+            cost_estimate=cost,
         )
+        for fid, name, desc, cat, rid, number, created, author, comment, n_revs, weight, cost in rows
+    ]
+
+
+def revision_history(
+    formula_id: int, after: Optional[int] = None, limit: int = 50
+) -> List[RevisionStatsDTO]:
+    """
+    Revisiones de una fórmula de la más reciente a la más antigua, paginadas por
+    clave: ``after`` es el ``number`` de la última fila de la página anterior.
+    Cada fila trae nº de entradas, peso y coste agregados en la misma consulta.
+    """
+    rev = FormulaRevision
+    page = select(rev.id).where(rev.formula_id == formula_id)
+    if after is not None:
+        page = page.where(rev.number < after)
+    # la página se elige por el índice (formula_id, number) antes de agregar
+    page = page.order_by(rev.number.desc()).limit(limit).subquery()
+    stmt = (
+        select(
+            rev.id,
+            rev.number,
+            rev.created_at,
+            rev.author,
+            rev.comment,
+            func.count(FormulaEntry.id),
+            func.coalesce(func.sum(FormulaEntry.weight_g), 0.0),
+            func.coalesce(func.sum(FormulaEntry.weight_g * RawMaterial.cost_per_g), 0.0),
+        )
+        .join(page, page.c.id == rev.id)
+        .outerjoin(FormulaEntry, FormulaEntry.revision_id == rev.id)
+        .outerjoin(RawMaterial, RawMaterial.id == FormulaEntry.raw_material_id)
+        .group_by(rev.id)
+        .order_by(rev.number.desc())
+    )
+    with session_scope() as s:
+        return [RevisionStatsDTO(*row) for row in s.execute(stmt)]
+
+
+# ---------------------------------------------------------------------------#
+# Consultas paginadas: orden y filtro en SQL (tablas de la GUI)
+# ---------------------------------------------------------------------------#
+
+
+@dataclass(frozen=True)
+class MaterialFilter:
+    category: Optional[str] = None
+    level: Optional[str] = None  # valor de PyramidLevel
+    min_cost: Optional[float] = None
+    max_cost: Optional[float] = None
+    low_stock_only: bool = False
+
+    def where(self) -> list:
+        rm = RawMaterial
+        out = []
+        if self.category:
+            out.append(rm.category == self.category)
+        if self.level:
+            out.append(rm.fragrance_pyramid_level == PyramidLevel(self.level))
+        if self.min_cost is not None:
+            out.append(rm.cost_per_g >= self.min_cost)
+        if self.max_cost is not None:
+            out.append(rm.cost_per_g <= self.max_cost)
+        if self.low_stock_only:
+            out.append(rm.inventory_g < rm.low_stock_threshold_g)
+        return out
+
+
+@dataclass(frozen=True)
+class FormulaFilter:
+    category: Optional[str] = None
+    name_contains: Optional[str] = None
+
+    def where(self) -> list:
+        out = []
+        if self.category:
+            out.append(Formula.category == self.category)
+        if self.name_contains:
+            out.append(Formula.name.ilike(f"%{self.name_contains}%"))
+        return out
+
+
+# Columnas por las que se puede ordenar (todas indexadas); el id desempata
+_MATERIAL_SORT = {
+    "id": RawMaterial.id,
+    "name": RawMaterial.name,
+    "category": RawMaterial.category,
+    "cost_per_g": RawMaterial.cost_per_g,
+    "inventory_g": RawMaterial.inventory_g,
+}
+_FORMULA_SORT = {"id": Formula.id, "name": Formula.name, "category": Formula.category}
+
+
+def _ordered(stmt, columns: Mapping, key_col, order_by: str, descending: bool):
+    col = columns.get(order_by)
+    if col is None:
+        raise ValueError(f"No se puede ordenar por {order_by!r}.")
+    if descending:
+        return stmt.order_by(col.desc(), key_col.desc())
+    return stmt.order_by(col, key_col)
+
+
+def count_materials(flt: MaterialFilter = MaterialFilter()) -> int:
+    with session_scope() as s:
+        return s.scalar(select(func.count(RawMaterial.id)).where(*flt.where()))
+
+
+def page_materials(
+    flt: MaterialFilter = MaterialFilter(),
+    order_by: str = "name",
+    descending: bool = False,
+    offset: int = 0,
+    limit: int = 200,
+) -> List[MaterialDTO]:
+    """
+    La BD ordena y pagina (índices) y devuelve los valores en la misma consulta,
+    así que la página siempre cuadra con su orden aunque el catálogo vaya por detrás.
+    """
+    stmt = _ordered(
+        select(*MATERIAL_FIELDS).where(*flt.where()), _MATERIAL_SORT, RawMaterial.id, order_by, descending
+    )
+    with session_scope() as s:
+        rows = s.connection().execute(stmt.offset(offset).limit(limit)).all()
+    mats = columns_from_rows(rows)
+    return [mats.dto(r) for r in range(len(mats))]
+
+
+def material_ids(
+    flt: MaterialFilter = MaterialFilter(), order_by: str = "name", descending: bool = False
+) -> List[int]:
+    """Ids de todas las materias del filtro en su orden (solo el índice; los valores van por páginas)."""
+    stmt = _ordered(select(RawMaterial.id).where(*flt.where()), _MATERIAL_SORT, RawMaterial.id, order_by, descending)
+    with session_scope() as s:
+        return s.scalars(stmt).all()
+
+
+def count_formulas(flt: FormulaFilter = FormulaFilter()) -> int:
+    with session_scope() as s:
+        return s.scalar(select(func.count(Formula.id)).where(*flt.where()))
+
+
+def page_formulas(
+    flt: FormulaFilter = FormulaFilter(),
+    order_by: str = "name",
+    descending: bool = False,
+    offset: int = 0,
+    limit: int = 200,
+) -> List[FormulaDTO]:
+    """La página se elige por índice; solo sus fórmulas pasan por la agregación."""
+    stmt = _ordered(
+        select(Formula.id).where(*flt.where()), _FORMULA_SORT, Formula.id, order_by, descending
+    )
+    with session_scope() as s:
+        ids = s.scalars(stmt.offset(offset).limit(limit)).all()
+    pos = {fid: i for i, fid in enumerate(ids)}
+    return sorted(list_formulas(ids), key=lambda f: pos[f.id])
+
+
+def formula_ids(
+    flt: FormulaFilter = FormulaFilter(), order_by: str = "name", descending: bool = False
+) -> List[int]:
+    """Ids de todas las fórmulas del filtro en su orden."""
+    stmt = _ordered(select(Formula.id).where(*flt.where()), _FORMULA_SORT, Formula.id, order_by, descending)
+    with session_scope() as s:
+        return s.scalars(stmt).all()
+
+
+def count_revisions() -> int:
+    with session_scope() as s:
+        return s.scalar(select(func.count(FormulaRevision.id)))
+
+
+def _categories(col) -> List[str]:
+    with session_scope() as s:
+        return s.scalars(
+            select(col).where(col.isnot(None), col != "").distinct().order_by(col)
+        ).all()
+
+
+def material_categories() -> List[str]:
+    return _categories(RawMaterial.category)
+
+
+def formula_categories() -> List[str]:
+    return _categories(Formula.category)
+
+
+# ---------------------------------------------------------------------------#
+# IFRA
+# ---------------------------------------------------------------------------#
+
+
+@writer
+def set_ifra_limit(raw_material_id: int, product_category: Optional[str], limit_pct: Optional[float]):
+    """
+    Fija el límite IFRA de una materia. Sin categoría actualiza el límite genérico;
+    con categoría crea/actualiza (o borra, si ``limit_pct`` es None) el específico.
+    """
+    with session_scope() as s:
+        rm = s.get(RawMaterial, raw_material_id)
+        if not product_category:
+            rm.ifra_limit_pct = limit_pct
+        else:
+            lim = (
+                s.query(IfraLimit)
+                .filter_by(raw_material_id=rm.id, product_category=product_category)
+                .first()
+            )
+            if limit_pct is None:
+                if lim:
+                    s.delete(lim)
+            elif lim:
+                lim.limit_pct = limit_pct
+            else:
+                s.add(
+                    IfraLimit(
+                        raw_material_id=rm.id,
+                        product_category=product_category,
+                        limit_pct=limit_pct,
+                    )
+                )
+        _log("ifra", "RawMaterial", raw_material_id)
+        # afecta al cumplimiento de todas las fórmulas que usan la materia
+        events.record(s, "IfraLimit", events.UPDATE, [raw_material_id])
+
+
+def ifra_violations(formula_ids: Optional[Iterable[int]] = None) -> List[IfraViolation]:
+    """Infracciones IFRA de la última revisión de todas las fórmulas (o de ``formula_ids``)."""
+    comp = catalog.composition(formula_ids)
+    with session_scope() as s:
+        return check_ifra(s, comp, catalog.materials())
+
+
+# ---------------------------------------------------------------------------#
+# Simulación de precios
+# ---------------------------------------------------------------------------#
+
+
+def simulate_price_change(
+    new_prices: Mapping[int, float], all_revisions: bool = False
+) -> List[pricing.PriceImpact]:
+    """Impacto de nuevos €/g (raw_material_id → precio) sin tocar la BD."""
+    with session_scope() as s:
+        if all_revisions:
+            return pricing.simulate_price_change(s, new_prices, latest_only=False)
+        return pricing.simulate_price_change(s, new_prices, comp=catalog.composition(), materials=catalog.materials())
+
+
+# ---------------------------------------------------------------------------#
+# MRP
+# ---------------------------------------------------------------------------#
+
+
+def material_requirements(plan: Iterable[mrp.PlanLine]) -> List[mrp.MaterialRequirement]:
+    """Necesidades, faltantes y compra sugerida para un plan de producción."""
+    plan = list(plan)
+    comp = catalog.composition({l.formula_id for l in plan})
+    with session_scope() as s:
+        return mrp.plan_requirements(s, plan, comp, catalog.materials())
 
 
 # ---------------------------------------------------------------------------#
@@ -178,6 +591,7 @@ def list_formulas() -> List[Formula]:
 # ---------------------------------------------------------------------------#
 
 
+@writer
 def import_materials_csv(path: Path) -> dict:
     added = skipped = 0
     with path.open(newline="", encoding="utf-8") as f, session_scope() as s:
@@ -199,3 +613,154 @@ def import_materials_csv(path: Path) -> dict:
             )
             added += 1
     return {"added": added, "skipped": skipped}
+
+
+# ---------------------------------------------------------------------------#
+# Importación CSV (fórmulas)
+# ---------------------------------------------------------------------------#
+FORMULA_CSV_CHUNK = 500  # fórmulas por transacción
+
+
+def import_formulas_csv(path: Path, chunk: int = FORMULA_CSV_CHUNK) -> dict:
+    """
+    Importa fórmulas en formato largo, una fila por entrada: ``formula``,
+    ``revision`` (1 si falta), ``material``, ``weight_g`` y ``dilution``; opcionales
+    ``category`` y ``comment``. El fichero se lee en streaming, así que las filas
+    de una fórmula deben ser consecutivas; cada ``chunk`` fórmulas se insertan en
+    bloque en una transacción propia, un trabajo de la cola de escritura por
+    bloque: otras escrituras no esperan a que termine el fichero. Las revisiones
+    ya existentes se omiten y las filas inválidas se devuelven en ``rejected``
+    como "línea N: motivo"; una revisión con alguna fila inválida se descarta
+    entera (``discarded``).
+    """
+    if current_user() is None:
+        raise PermissionError("Importar fórmulas requiere un usuario (auditoría).")
+    with session_scope() as s:
+        materials = dict(s.execute(select(RawMaterial.name, RawMaterial.id)).tuples().all())
+        formula_ids = dict(s.execute(select(Formula.name, Formula.id)).tuples().all())
+
+    stats = {"formulas": 0, "revisions": 0, "entries": 0, "skipped": 0, "discarded": 0}
+    rejected: List[str] = []
+    finished = set()  # fórmulas ya cerradas: si reaparecen, sus filas no son consecutivas
+    batch: dict = {}  # nombre → {"category": str|None, "revisions": {nº: (comentario, entradas)}}
+    current = None
+
+    with path.open(newline="", encoding="utf-8") as f:
+        for line, row in enumerate(csv.DictReader(f), start=2):
+            name = (row.get("formula") or "").strip()
+            if name != current:
+                if current is not None:
+                    finished.add(current)
+                if len(batch) >= chunk:
+                    _insert_formula_batch(batch, formula_ids, stats)
+                    batch = {}
+                current = name
+            err, number, entry = _parse_formula_row(row, name, finished, materials)
+            if err:
+                rejected.append(f"línea {line}: {err}")
+                if name and name not in finished and number >= 1:
+                    # una revisión incompleta no se importa
+                    form = batch.setdefault(name, {"category": None, "revisions": {}})
+                    form.setdefault("invalid", set()).add(number)
+                continue
+            form = batch.setdefault(name, {"category": None, "revisions": {}})
+            form["category"] = form["category"] or (row.get("category") or "").strip() or None
+            comment = (row.get("comment") or "").strip() or "importado CSV"
+            form["revisions"].setdefault(number, (comment, []))[1].append(entry)
+    if batch:
+        _insert_formula_batch(batch, formula_ids, stats)
+    return {**stats, "rejected": rejected}
+
+
+def _parse_formula_row(row: dict, name: str, finished: set, materials: Mapping[str, int]):
+    """Valida una fila: (error, nº de revisión, (rm_id, peso, dilución))."""
+    try:
+        number = int(row.get("revision") or 1)
+    except ValueError:
+        number = 0
+    if not name:
+        return "falta el nombre de la fórmula", number, None
+    if name in finished:
+        return f"las filas de {name!r} no son consecutivas", number, None
+    if number < 1:
+        return f"revisión {row.get('revision')!r} no válida", number, None
+    material = (row.get("material") or "").strip()
+    rm_id = materials.get(material)
+    if rm_id is None:
+        return f"materia {material!r} no encontrada", number, None
+    raw_w = row.get("weight_g") or row.get("weight") or ""
+    try:
+        weight = float(raw_w.replace(",", "."))
+    except ValueError:
+        weight = float("nan")
+    if not weight > 0:  # también descarta NaN
+        return f"peso {raw_w!r} no válido (> 0)", number, None
+    dilution = (row.get("dilution") or "").strip() or None
+    return None, number, (rm_id, weight, dilution)
+
+
+@writer
+def _insert_formula_batch(batch: dict, formula_ids: dict, stats: dict) -> None:
+    """Inserta un bloque de fórmulas/revisiones/entradas en una transacción."""
+    usr = current_user()
+    author = _author()
+    with session_scope() as s:
+        for form in batch.values():
+            for number in form.get("invalid", ()):
+                form["revisions"].pop(number, None)
+                stats["discarded"] += 1
+        batch = {n: form for n, form in batch.items() if form["revisions"]}
+        new_names = [n for n in batch if n not in formula_ids]
+        old_ids = [formula_ids[n] for n in batch if n in formula_ids]
+        new_ids = []
+        if new_names:
+            new_ids = s.scalars(
+                insert(Formula).returning(Formula.id, sort_by_parameter_order=True),
+                [dict(name=n, category=batch[n]["category"]) for n in new_names],
+            ).all()
+            formula_ids.update(zip(new_names, new_ids))
+        known = set()
+        if old_ids:
+            known = set(
+                s.execute(
+                    select(FormulaRevision.formula_id, FormulaRevision.number).where(
+                        FormulaRevision.formula_id.in_(old_ids)
+                    )
+                ).tuples()
+            )
+
+        revs, entries = [], []
+        for name, form in batch.items():
+            fid = formula_ids[name]
+            for number, (comment, ents) in sorted(form["revisions"].items()):
+                if (fid, number) in known:
+                    stats["skipped"] += 1
+                    continue
+                revs.append(dict(formula_id=fid, number=number, author=author, comment=comment))
+                entries.append(ents)
+        if revs:
+            rev_ids = s.scalars(
+                insert(FormulaRevision).returning(FormulaRevision.id, sort_by_parameter_order=True),
+                revs,
+            ).all()
+            rows = [
+                dict(revision_id=rid, raw_material_id=rm_id, weight_g=w, dilution=dil)
+                for rid, ents in zip(rev_ids, entries)
+                for rm_id, w, dil in ents
+            ]
+            # Core sobre la tabla: un único executemany (el ORM agrupa por claves no nulas)
+            s.connection().execute(insert(FormulaEntry.__table__), rows)
+            stats["entries"] += len(rows)
+            stats["revisions"] += len(revs)
+
+        touched = sorted({r["formula_id"] for r in revs})
+        if touched:
+            s.connection().execute(
+                insert(AuditLog.__table__),
+                [dict(user_id=usr.id, action="import", entity="Formula", entity_id=fid) for fid in touched],
+            )
+        stats["formulas"] += len(new_ids)
+        events.record(s, "Formula", events.INSERT, new_ids)
+        events.record(s, "Formula", events.UPDATE, set(touched) - set(new_ids))
+    if touched:
+        _reindex(*touched)
@@ -1,23 +1,31 @@
 from __future__ import annotations
 
-from typing import Optional
-
-from PyQt5.QtWidgets import QApplication
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator, Optional
 
 from models import User, Role
 
+# Usuario activo por hilo/tarea: sin dependencia de Qt, válido en CLI y workers
+_current_user: ContextVar[Optional[User]] = ContextVar("current_user", default=None)
+
 
 def set_current_user(user: Optional[User]) -> None:
-    app = QApplication.instance()
-    if app:
-        app.setProperty("current_user", user)
+    _current_user.set(user)
 
 
 def current_user() -> Optional[User]:
-    app = QApplication.instance()
-    if app:
-        return app.property("current_user")
-    return None
+    return _current_user.get()
+
+
+@contextmanager
+def as_user(user: Optional[User]) -> Iterator[None]:
+    """Ejecuta un bloque en nombre de ``user`` y restaura el anterior al salir."""
+    token = _current_user.set(user)
+    try:
+        yield
+    finally:
+        _current_user.reset(token)
 
 
 def require_role(*roles: Role) -> bool:
@@ -0,0 +1,328 @@
+# similarity.py ── Índice de similitud de fórmulas (vecinos más próximos)
+# =============================================================================
+# Los vectores se guardan en formula_vectors (entidad "FormulaVector" del bus de
+# events) y el índice en memoria los sigue por versión: las notificaciones de
+# este proceso marcan las fórmulas a releer y, si la versión de la BD no es la
+# que el índice conoce (otro proceso ha reindexado), se recarga entero.
+from __future__ import annotations
+
+import threading
+from dataclasses import dataclass
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+import numpy as np
+from scipy import sparse
+from sqlalchemy import delete, insert, select
+from sqlalchemy.orm import Session
+
+import events
+from composition import load_composition
+from db import session_scope, writer
+from models import Formula, FormulaVector
+
+_ENTITY = "FormulaVector"
+
+# Nº de fórmulas actualizadas que se consultan aparte antes de recompactar la matriz
+_COMPACT_AT = 512
+# Entradas como máximo del producto M·Mᵀ por bloque en el informe de duplicados
+# (≈ 16 bytes cada una en COO): acota la memoria aunque las fórmulas compartan
+# materias muy comunes y el producto sea casi denso
+_DUP_BUDGET = 4_000_000
+
+_Vector = Tuple[np.ndarray, np.ndarray]  # (material_ids int32, pesos float32)
+
+
+@dataclass(frozen=True)
+class SimilarFormula:
+    formula_id: int
+    name: str
+    score: float  # coseno 0…1
+
+
+@dataclass(frozen=True)
+class DuplicatePair:
+    formula_a_id: int
+    formula_a: str
+    formula_b_id: int
+    formula_b: str
+    score: float
+
+
+# ---------------------------------------------------------------------------#
+# Vectores persistidos (formula_vectors)
+# ---------------------------------------------------------------------------#
+
+
+def update_formulas(s: Session, formula_ids: Optional[Iterable[int]] = None) -> int:
+    """
+    Recalcula y guarda el vector de la última revisión de las fórmulas indicadas
+    (todas si ``formula_ids`` es None). No hace commit: el índice en memoria se
+    entera por la notificación que publica el commit de quien llama.
+    """
+    if formula_ids is not None:
+        formula_ids = sorted(set(formula_ids))
+        if s.scalar(select(FormulaVector.formula_id).limit(1)) is None:
+            formula_ids = None  # índice aún no construido: se genera completo
+    comp = load_composition(s, latest_only=True, formula_ids=formula_ids)
+    # Peso activo normalizado L2 → el producto escalar es el coseno
+    active = comp.active.tocsr()
+    norms = np.sqrt(np.asarray(active.multiply(active).sum(axis=1)).ravel())
+    norms[norms == 0] = 1.0
+    active = sparse.csr_matrix(active.multiply(1.0 / norms[:, None]))
+
+    if formula_ids is None:
+        touched = set(s.scalars(select(FormulaVector.formula_id)))  # también los que desaparecen
+        s.execute(delete(FormulaVector))
+    else:
+        touched = set(formula_ids)
+        s.execute(delete(FormulaVector).where(FormulaVector.formula_id.in_(formula_ids)))
+
+    rows = []
+    for r in range(active.shape[0]):
+        lo, hi = active.indptr[r], active.indptr[r + 1]
+        mats = comp.material_ids[active.indices[lo:hi]].astype(np.int32)
+        vals = active.data[lo:hi].astype(np.float32)
+        fid = int(comp.formula_ids[r])
+        touched.add(fid)
+        rows.append(
+            dict(
+                formula_id=fid,
+                revision_id=int(comp.revision_ids[r]),
+                material_ids=mats.tobytes(),
+                weights=vals.tobytes(),
+            )
+        )
+    if rows:
+        s.execute(insert(FormulaVector), rows)
+    events.record(s, _ENTITY, events.UPDATE, touched)
+    return len(rows)
+
+
+@writer
+def rebuild_index() -> int:
+    """Genera en disco los vectores de todas las fórmulas (cola de escritura)."""
+    with session_scope() as s:
+        return update_formulas(s)
+
+
+# ---------------------------------------------------------------------------#
+# Índice en memoria
+# ---------------------------------------------------------------------------#
+
+
+class _Index:
+    """
+    Matriz dispersa fórmulas × materias cargada de ``formula_vectors`` en la
+    versión ``_version``. Las fórmulas notificadas después (``_dirty``) se releen
+    al consultar y se guardan aparte (``_pending``); la matriz se recarga cuando
+    superan ``_COMPACT_AT``.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._matrix: Optional[sparse.csr_matrix] = None
+        self._ids = np.empty(0, dtype=np.int64)
+        self._row: Dict[int, int] = {}
+        self._pending: Dict[int, Optional[_Vector]] = {}
+        self._dirty: Set[int] = set()
+        self._version = 0
+        self._epoch = 0  # fila EPOCH de data_versions: cambia al restaurar una copia
+        events.subscribe(self._on_change)
+
+    def invalidate(self):
+        with self._lock:
+            self._matrix = None
+            self._pending.clear()
+            self._dirty.clear()
+
+    def _on_change(self, ch: events.Change):
+        """Tras un commit de este proceso (ya confirmado: un rollback no llega aquí)."""
+        if ch.entity != _ENTITY:
+            return
+        with self._lock:
+            if self._matrix is None or ch.version <= self._version:
+                return  # la próxima carga (o la actual) ya lo incluye
+            if ch.version != self._version + 1 or len(self._pending) + len(self._dirty | ch.ids) > _COMPACT_AT:
+                self.invalidate()  # cambios de otro proceso por medio, o demasiados
+                return
+            self._dirty |= ch.ids
+            self._version = ch.version
+
+    def _load(self, s: Session, version: int, epoch: int):
+        ids, indptr, cols, vals = [], [0], [], []
+        for fid, mats, w in s.execute(
+            select(FormulaVector.formula_id, FormulaVector.material_ids, FormulaVector.weights)
+        ):
+            m = np.frombuffer(mats, dtype=np.int32)
+            ids.append(fid)
+            cols.append(m)
+            vals.append(np.frombuffer(w, dtype=np.float32))
+            indptr.append(indptr[-1] + len(m))
+        cols_a = np.concatenate(cols) if cols else np.empty(0, dtype=np.int32)
+        n_cols = int(cols_a.max()) + 1 if len(cols_a) else 1
+        self._matrix = sparse.csr_matrix(
+            (
+                np.concatenate(vals) if vals else np.empty(0, dtype=np.float32),
+                cols_a,
+                np.array(indptr),
+            ),
+            shape=(len(ids), n_cols),
+        )
+        self._ids = np.array(ids, dtype=np.int64)
+        self._row = {fid: i for i, fid in enumerate(ids)}
+        self._pending.clear()
+        self._dirty.clear()
+        self._version, self._epoch = version, epoch
+
+    def _refresh(self, s: Session):
+        """Relee los vectores de las fórmulas notificadas (sin fila = ya no está en el índice)."""
+        dirty = sorted(self._dirty)
+        found = {
+            fid: (np.frombuffer(mats, dtype=np.int32), np.frombuffer(w, dtype=np.float32))
+            for fid, mats, w in s.execute(
+                select(FormulaVector.formula_id, FormulaVector.material_ids, FormulaVector.weights).where(
+                    FormulaVector.formula_id.in_(dirty)
+                )
+            )
+        }
+        self._pending.update((fid, found.get(fid)) for fid in dirty)
+        self._dirty.clear()
+
+    def _build(self, s: Session):
+        """
+        Primera vez: genera los vectores en disco por la cola de escritura. Se
+        llama sin el lock, porque el commit notifica a este mismo índice.
+        """
+        if self._matrix is None and s.scalar(select(FormulaVector.formula_id).limit(1)) is None:
+            rebuild_index()
+
+    def _ensure(self, s: Session):
+        # una consulta mínima por llamada: detecta reindexados de otros procesos y
+        # restauraciones (tras las que la versión puede volver a coincidir)
+        versions = events.data_versions(s.connection())
+        version, epoch = versions.get(_ENTITY, 0), versions.get(events.EPOCH, 0)
+        if self._matrix is None or version != self._version or epoch != self._epoch:
+            self._load(s, version, epoch)
+        elif self._dirty:
+            self._refresh(s)
+
+    def vector(self, s: Session, formula_id: int) -> Optional[_Vector]:
+        self._build(s)
+        with self._lock:
+            self._ensure(s)
+            if formula_id in self._pending:
+                return self._pending[formula_id]
+            r = self._row.get(formula_id)
+            if r is None:
+                return None
+            lo, hi = self._matrix.indptr[r], self._matrix.indptr[r + 1]
+            return self._matrix.indices[lo:hi], self._matrix.data[lo:hi]
+
+    def matrix(self, s: Session) -> Tuple[np.ndarray, sparse.csr_matrix]:
+        self._build(s)
+        with self._lock:
+            self._ensure(s)
+            if self._pending:
+                self._load(s, self._version, self._epoch)
+            return self._ids, self._matrix
+
+    def query(self, s: Session, vec: _Vector, k: int) -> List[Tuple[int, float]]:
+        mats, vals = vec
+        self._build(s)
+        with self._lock:
+            self._ensure(s)
+            n_cols = self._matrix.shape[1]
+            q = np.zeros(n_cols, dtype=np.float32)
+            inside = mats < n_cols
+            q[mats[inside]] = vals[inside]
+            scores = self._matrix @ q
+
+            ids = self._ids
+            if self._pending:
+                stale = [self._row[f] for f in self._pending if f in self._row]
+                scores[stale] = -1.0
+                extra_ids, extra = [], []
+                qd = dict(zip(mats.tolist(), vals.tolist()))
+                for fid, v in self._pending.items():
+                    if v is None:
+                        continue
+                    extra_ids.append(fid)
+                    extra.append(sum(qd.get(m, 0.0) * w for m, w in zip(v[0].tolist(), v[1].tolist())))
+                ids = np.concatenate([ids, np.array(extra_ids, dtype=np.int64)])
+                scores = np.concatenate([scores, np.array(extra, dtype=scores.dtype)])
+
+        k = min(k, len(scores))
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [(int(ids[i]), float(scores[i])) for i in top if scores[i] > 0]
+
+
+_index = _Index()
+
+
+def invalidate() -> None:
+    """Descarta el índice en memoria: la próxima consulta lo recarga de la BD."""
+    _index.invalidate()
+
+
+# ---------------------------------------------------------------------------#
+# Consultas
+# ---------------------------------------------------------------------------#
+
+
+def similar_formulas(s: Session, formula_id: int, k: int = 10) -> List[SimilarFormula]:
+    """Las ``k`` fórmulas cuya última revisión más se parece a la de ``formula_id``."""
+    vec = _index.vector(s, formula_id)
+    if vec is None:
+        return []
+    hits = [(fid, sc) for fid, sc in _index.query(s, vec, k + 1) if fid != formula_id][:k]
+    names = dict(
+        s.execute(select(Formula.id, Formula.name).where(Formula.id.in_([f for f, _ in hits])))
+        .tuples()
+        .all()
+    )
+    return [SimilarFormula(fid, names.get(fid, str(fid)), min(sc, 1.0)) for fid, sc in hits]
+
+
+def _dup_blocks(m: sparse.csr_matrix) -> Iterator[Tuple[int, int]]:
+    """
+    Bloques de filas ``[lo, hi)`` cuyo producto con Mᵀ no pasa de ``_DUP_BUDGET``
+    entradas. Cota por fila: suma de cuántas fórmulas usan cada una de sus
+    materias. Una fila que sola pasa del presupuesto va en un bloque propio.
+    """
+    n = m.shape[0]
+    used = np.bincount(m.indices, minlength=m.shape[1])  # fórmulas que usan cada materia
+    rows = np.repeat(np.arange(n), np.diff(m.indptr))
+    cost = np.cumsum(np.bincount(rows, weights=used[m.indices], minlength=n))
+    lo = 0
+    while lo < n:
+        start = cost[lo - 1] if lo else 0
+        hi = max(int(np.searchsorted(cost, start + _DUP_BUDGET, side="right")), lo + 1)
+        yield lo, hi
+        lo = hi
+
+
+def duplicate_pairs(s: Session, threshold: float = 0.98) -> List[DuplicatePair]:
+    """Pares de fórmulas con similitud ≥ ``threshold`` (casi duplicadas)."""
+    ids, m = _index.matrix(s)
+    mt = m.T.tocsc()
+    pairs = []
+    for lo, hi in _dup_blocks(m):
+        # solo columnas ≥ lo: cada par se cuenta una vez (b > a)
+        block = (m[lo:hi] @ mt[:, lo:]).tocoo()
+        a = block.row + lo
+        b = block.col + lo
+        keep = (block.data >= threshold - 1e-6) & (b > a)
+        pairs.extend(zip(a[keep].tolist(), b[keep].tolist(), block.data[keep].tolist()))
+
+    names = dict(s.execute(select(Formula.id, Formula.name)).tuples().all())
+    out = [
+        DuplicatePair(
+            int(ids[a]), names.get(int(ids[a]), ""), int(ids[b]), names.get(int(ids[b]), ""), min(float(sc), 1.0)
+        )
+        for a, b, sc in pairs
+    ]
+    out.sort(key=lambda p: -p.score)
+    return out
@@ -0,0 +1,190 @@
+# stocktake.py ── Conciliación de inventario con un recuento físico
+# =============================================================================
+# El CSV del recuento se vuelca en streaming a una tabla temporal y todas las
+# diferencias con ``RawMaterial.inventory_g`` salen de un único JOIN. Al aplicar,
+# los movimientos se insertan con INSERT … SELECT y el stock se actualiza con un
+# UPDATE por conjuntos, todo en la transacción de la sesión recibida.
+from __future__ import annotations
+
+import csv
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+from typing import List, Optional
+
+from sqlalchemy import Column, Float, Integer, MetaData, String, Table, false, func, insert, literal, select, update
+from sqlalchemy.orm import Session
+
+from models import InventoryMovement, MovementKind, RawMaterial
+
+COUNT_CSV_CHUNK = 5000  # filas por executemany al volcar el CSV
+_EPS = 1e-9  # diferencias menores no generan movimiento (ck_delta_nonzero)
+
+_counts = Table(
+    "stock_count",
+    MetaData(),
+    Column("line", Integer, nullable=False),
+    Column("raw_material_id", Integer),
+    Column("name", String(128)),
+    Column("counted_g", Float, nullable=False),
+    prefixes=["TEMPORARY"],
+)
+# Recuento por materia (suma de ubicaciones), con clave primaria para los JOIN
+_totals = Table(
+    "stock_count_total",
+    _counts.metadata,
+    Column("raw_material_id", Integer, primary_key=True),
+    Column("counted_g", Float, nullable=False),
+    prefixes=["TEMPORARY"],
+)
+
+
+@dataclass(frozen=True)
+class StockDiscrepancy:
+    raw_material_id: int
+    name: str
+    inventory_g: float
+    counted_g: float
+    cost_per_g: float
+
+    @property
+    def delta_g(self) -> float:
+        return self.counted_g - self.inventory_g
+
+    @property
+    def value(self) -> float:
+        return self.delta_g * self.cost_per_g
+
+
+@dataclass(frozen=True)
+class StockTake:
+    counted: int  # materias distintas del recuento
+    discrepancies: List[StockDiscrepancy]  # de mayor a menor valor absoluto
+    rejected: List[str]  # "línea N: motivo"
+    applied: bool
+    first_movement_id: Optional[int] = None  # referencia de la entrada de auditoría
+
+    @property
+    def value(self) -> float:
+        """Valor neto de la regularización (positivo = sobrante)."""
+        return sum(d.value for d in self.discrepancies)
+
+
+def _parse(path: Path, rejected: List[tuple]):
+    """Filas válidas del recuento: columnas ``material`` o ``raw_material_id`` y ``counted_g``."""
+    with path.open(newline="", encoding="utf-8") as f:
+        for line, row in enumerate(csv.DictReader(f), start=2):
+            ref = (row.get("raw_material_id") or "").strip()
+            name = (row.get("material") or "").strip()
+            raw = (row.get("counted_g") or "").strip()
+            try:
+                counted = float(raw.replace(",", "."))
+            except ValueError:
+                counted = float("nan")
+            if not counted >= 0:  # también descarta NaN
+                rejected.append((line, f"cantidad {raw!r} no válida (>= 0)"))
+            elif ref and not ref.isdigit():
+                rejected.append((line, f"raw_material_id {ref!r} no válido"))
+            elif not ref and not name:
+                rejected.append((line, "falta la materia"))
+            else:
+                yield dict(line=line, raw_material_id=int(ref) if ref else None, name=name or None, counted_g=counted)
+
+
+def reconcile(
+    s: Session, path: Path, apply: bool = False, description: str = "Recuento físico", chunk: int = COUNT_CSV_CHUNK
+) -> StockTake:
+    """
+    Compara el recuento con el stock actual. Varias filas de la misma materia
+    (p. ej. distintas ubicaciones) se suman; las materias que no aparecen en el
+    fichero no se tocan. Con ``apply`` deja cada materia en la cantidad contada y
+    registra la diferencia como ``InventoryMovement``; el commit es de quien llama.
+    """
+    conn = s.connection()
+    rm = RawMaterial.__table__
+    c, tot = _counts, _totals
+    meta = _counts.metadata
+    meta.drop_all(conn)  # las tablas temporales viven lo que la conexión del pool
+    meta.create_all(conn)
+    try:
+        rejected: List[tuple] = []  # (línea, motivo)
+        rows = []
+        for row in _parse(path, rejected):
+            rows.append(row)
+            if len(rows) >= chunk:
+                conn.execute(insert(c), rows)
+                rows = []
+        if rows:
+            conn.execute(insert(c), rows)
+
+        # nombres → id con el índice único de raw_materials.name
+        conn.execute(
+            update(c)
+            .where(c.c.raw_material_id.is_(None))
+            .values(raw_material_id=select(rm.c.id).where(rm.c.name == c.c.name).scalar_subquery())
+        )
+        unknown = conn.execute(
+            select(c.c.line, c.c.name, c.c.raw_material_id)
+            .outerjoin(rm, rm.c.id == c.c.raw_material_id)
+            .where(rm.c.id.is_(None))
+        ).all()
+        rejected.extend((line, f"materia {name or rm_id!r} no encontrada") for line, name, rm_id in unknown)
+
+        conn.execute(
+            insert(tot).from_select(
+                ["raw_material_id", "counted_g"],
+                select(c.c.raw_material_id, func.sum(c.c.counted_g))
+                .join(rm, rm.c.id == c.c.raw_material_id)
+                .group_by(c.c.raw_material_id),
+            )
+        )
+        counted = conn.scalar(select(func.count()).select_from(tot))
+        delta = tot.c.counted_g - func.coalesce(rm.c.inventory_g, 0.0)
+        differs = func.abs(delta) > _EPS
+        found = (
+            select(
+                rm.c.id,
+                rm.c.name,
+                func.coalesce(rm.c.inventory_g, 0.0),
+                tot.c.counted_g,
+                func.coalesce(rm.c.cost_per_g, 0.0),
+            )
+            .join(tot, tot.c.raw_material_id == rm.c.id)
+            .where(differs)
+        )
+        lines = [StockDiscrepancy(*r) for r in conn.execute(found)]
+        lines.sort(key=lambda d: (-abs(d.value), d.name))
+
+        if apply and lines:
+            mv = InventoryMovement.__table__
+            mov_ids = conn.scalars(
+                insert(mv).from_select(
+                    ["raw_material_id", "delta_g", "description", "created_at", "opening_balance", "kind"],
+                    select(
+                        rm.c.id,
+                        delta,
+                        literal(description),
+                        literal(datetime.utcnow()),
+                        false(),
+                        literal(MovementKind.STOCKTAKE, mv.c.kind.type),
+                    )
+                    .join(tot, tot.c.raw_material_id == rm.c.id)
+                    .where(differs),
+                ).returning(mv.c.id)
+            ).all()
+            conn.execute(
+                update(rm)
+                .where(rm.c.id.in_(select(tot.c.raw_material_id)))
+                .values(
+                    inventory_g=select(tot.c.counted_g).where(tot.c.raw_material_id == rm.c.id).scalar_subquery()
+                )
+            )
+        return StockTake(
+            counted=counted,
+            discrepancies=lines,
+            rejected=[f"línea {line}: {why}" for line, why in sorted(rejected)],
+            applied=apply and bool(lines),
+            first_movement_id=min(mov_ids) if apply and lines else None,
+        )
+    finally:
+        meta.drop_all(conn)
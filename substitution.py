@@ -0,0 +1,239 @@
+# substitution.py ── Sustitución masiva de una materia en las fórmulas
+# =============================================================================
+# Busca la última revisión de cada fórmula que usa la materia (índice de
+# formula_entries.raw_material_id + uq_form_rev) y crea, con INSERT … SELECT,
+# una revisión nueva por fórmula con las entradas reescritas. Si la revisión ya
+# lleva la materia sustituta con la misma dilución, los gramos se suman a esa
+# entrada; con otra dilución la fórmula se deja como está y se informa aparte.
+# Todo ocurre en la transacción de la sesión recibida; el commit es de quien llama.
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Set
+
+from sqlalchemy import case, func, insert, literal, select
+from sqlalchemy.orm import Session
+
+from models import Formula, FormulaEntry, FormulaRevision, RawMaterial
+
+CHUNK = 500  # revisiones por sentencia (límite de parámetros de SQLite)
+
+
+@dataclass(frozen=True)
+class SubstitutionImpact:
+    formula_id: int
+    formula_name: str
+    revision_id: int  # revisión de partida
+    revision_number: int
+    new_revision_id: Optional[int]  # None en simulación
+    old_cost: float
+    new_cost: float
+
+    @property
+    def delta(self) -> float:
+        return self.new_cost - self.old_cost
+
+    @property
+    def delta_pct(self) -> float:
+        return 100.0 * self.delta / self.old_cost if self.old_cost else 0.0
+
+
+@dataclass(frozen=True)
+class SkippedFormula:
+    formula_id: int
+    formula_name: str
+    revision_id: int
+    revision_number: int
+    reason: str
+
+
+@dataclass(frozen=True)
+class Substitution:
+    old_material_id: int
+    new_material_id: int
+    ratio: float
+    impacts: List[SubstitutionImpact]  # de mayor a menor impacto absoluto
+    applied: bool
+    skipped: List[SkippedFormula] = field(default_factory=list)  # no se tocan
+
+
+def _chunks(seq: list, n: int = CHUNK):
+    for i in range(0, len(seq), n):
+        yield seq[i : i + n]
+
+
+def substitute(
+    s: Session,
+    old_id: int,
+    new_id: int,
+    ratio: float = 1.0,
+    formula_ids: Optional[Iterable[int]] = None,
+    apply: bool = False,
+    author: str = "sistema",
+    comment: Optional[str] = None,
+) -> Substitution:
+    """
+    Sustituye ``old_id`` por ``new_id`` (peso × ``ratio``, misma dilución) en la
+    última revisión de las fórmulas que lo usan, o solo de ``formula_ids``.
+    Donde ya está ``new_id`` con la misma dilución se suman los gramos; con otra
+    dilución la fórmula va a ``skipped``. Sin ``apply`` únicamente calcula el
+    cambio de coste de cada fórmula.
+    """
+    if old_id == new_id:
+        raise ValueError("La materia sustituta debe ser distinta de la original.")
+    if not ratio > 0:
+        raise ValueError("La proporción debe ser > 0")
+    mats = {
+        rm_id: (name, cost or 0.0)
+        for rm_id, name, cost in s.execute(
+            select(RawMaterial.id, RawMaterial.name, RawMaterial.cost_per_g).where(
+                RawMaterial.id.in_([old_id, new_id])
+            )
+        )
+    }
+    for rm_id in (old_id, new_id):
+        if rm_id not in mats:
+            raise ValueError(f"Materia {rm_id} no encontrada.")
+
+    rev, ent, rm = FormulaRevision.__table__, FormulaEntry.__table__, RawMaterial.__table__
+    last = rev.alias("last")
+    latest_number = select(func.max(last.c.number)).where(last.c.formula_id == rev.c.formula_id).scalar_subquery()
+    stmt = (
+        select(rev.c.id, rev.c.number, Formula.id, Formula.name)
+        .join(Formula, Formula.id == rev.c.formula_id)
+        .where(
+            rev.c.id.in_(select(ent.c.revision_id).where(ent.c.raw_material_id == old_id)),
+            rev.c.number == latest_number,
+        )
+        .order_by(rev.c.id)
+    )
+    if formula_ids is not None:
+        stmt = stmt.where(rev.c.formula_id.in_(list(formula_ids)))
+    targets = s.execute(stmt).all()
+
+    # revisiones que ya llevan la sustituta: se fusiona si la dilución coincide
+    dils: Dict[int, Dict[int, list]] = {}
+    for ids in _chunks([t[0] for t in targets]):
+        for rid, rm_id, dil in s.execute(
+            select(ent.c.revision_id, ent.c.raw_material_id, ent.c.dilution).where(
+                ent.c.revision_id.in_(ids),
+                ent.c.revision_id.in_(select(ent.c.revision_id).where(ent.c.raw_material_id == new_id)),
+                ent.c.raw_material_id.in_([old_id, new_id]),
+            )
+        ):
+            dils.setdefault(rid, {old_id: [], new_id: []})[rm_id].append(dil)
+    merge: Set[int] = set()
+    skipped = []
+    for rid, number, fid, name in targets:
+        if rid not in dils:
+            continue
+        olds, news = dils[rid][old_id], dils[rid][new_id]
+        if len(news) == 1 and all(d == news[0] for d in olds):
+            merge.add(rid)
+        else:
+            skipped.append(
+                SkippedFormula(fid, name, rid, number, f"{mats[new_id][0]} ya figura con otra dilución")
+            )
+    if skipped:
+        left = {k.revision_id for k in skipped}
+        targets = [t for t in targets if t[0] not in left]
+    rev_ids = [t[0] for t in targets]
+
+    # coste actual y gramos de la materia sustituida por revisión
+    totals = {}
+    for ids in _chunks(rev_ids):
+        totals.update(
+            (rid, (cost, grams))
+            for rid, cost, grams in s.execute(
+                select(
+                    ent.c.revision_id,
+                    func.sum(ent.c.weight_g * func.coalesce(rm.c.cost_per_g, 0.0)),
+                    func.sum(case((ent.c.raw_material_id == old_id, ent.c.weight_g), else_=0.0)),
+                )
+                .join(rm, rm.c.id == ent.c.raw_material_id)
+                .where(ent.c.revision_id.in_(ids))
+                .group_by(ent.c.revision_id)
+            )
+        )
+
+    new_rev = {}
+    if apply and rev_ids:
+        now = datetime.utcnow()
+        comment = comment or f"Sustitución {mats[old_id][0]} → {mats[new_id][0]} (× {ratio:g})"
+        new = rev.alias("new")
+        for ids in _chunks(rev_ids):
+            s.execute(
+                insert(rev).from_select(
+                    ["formula_id", "number", "created_at", "author", "comment"],
+                    select(rev.c.formula_id, rev.c.number + 1, literal(now), literal(author), literal(comment)).where(
+                        rev.c.id.in_(ids)
+                    ),
+                )
+            )
+            pairs = select(rev.c.id.label("old_id"), new.c.id.label("new_id")).join(
+                new, (new.c.formula_id == rev.c.formula_id) & (new.c.number == rev.c.number + 1)
+            ).where(rev.c.id.in_(ids))
+            new_rev.update(s.execute(pairs).tuples().all())
+            p = pairs.subquery()
+            is_old = ent.c.raw_material_id == old_id
+            cols = ["revision_id", "raw_material_id", "weight_g", "dilution"]
+            plain = [i for i in ids if i not in merge]
+            if plain:
+                s.execute(
+                    insert(ent).from_select(
+                        cols,
+                        select(
+                            p.c.new_id,
+                            case((is_old, new_id), else_=ent.c.raw_material_id),
+                            case((is_old, ent.c.weight_g * ratio), else_=ent.c.weight_g),
+                            ent.c.dilution,
+                        )
+                        .join(p, p.c.old_id == ent.c.revision_id)
+                        .where(p.c.old_id.in_(plain)),
+                    )
+                )
+            merged = [i for i in ids if i in merge]
+            if merged:
+                # la sustituta absorbe los gramos (× ratio) de la materia retirada
+                src = ent.alias("src")
+                old_grams = (
+                    select(func.sum(src.c.weight_g))
+                    .where(src.c.revision_id == ent.c.revision_id, src.c.raw_material_id == old_id)
+                    .scalar_subquery()
+                )
+                s.execute(
+                    insert(ent).from_select(
+                        cols,
+                        select(
+                            p.c.new_id,
+                            ent.c.raw_material_id,
+                            case(
+                                (ent.c.raw_material_id == new_id, ent.c.weight_g + old_grams * ratio),
+                                else_=ent.c.weight_g,
+                            ),
+                            ent.c.dilution,
+                        )
+                        .join(p, p.c.old_id == ent.c.revision_id)
+                        .where(p.c.old_id.in_(merged), ~is_old),
+                    )
+                )
+
+    delta_per_g = ratio * mats[new_id][1] - mats[old_id][1]
+    impacts = []
+    for rid, number, fid, name in targets:
+        cost, grams = totals[rid]
+        impacts.append(
+            SubstitutionImpact(
+                formula_id=fid,
+                formula_name=name,
+                revision_id=rid,
+                revision_number=number,
+                new_revision_id=new_rev.get(rid),
+                old_cost=cost,
+                new_cost=cost + grams * delta_per_g,
+            )
+        )
+    impacts.sort(key=lambda i: (-abs(i.delta), i.formula_name))
+    skipped.sort(key=lambda k: k.formula_name)
+    return Substitution(old_id, new_id, ratio, impacts, applied=apply and bool(impacts), skipped=skipped)
@@ -0,0 +1,27 @@
+# conftest.py ── BD SQLite temporaria para toda la sesión de pruebas
+# =============================================================================
+# models crea el engine al importarse, así que FORMULAIR_DB_URL se fija antes
+# de importar cualquier módulo de la aplicación.
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+_TMP = Path(tempfile.mkdtemp(prefix="formulair-tests-"))
+os.environ["FORMULAIR_DB_URL"] = f"sqlite:///{_TMP / 'test.db'}"
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import auth  # noqa: E402
+import models  # noqa: E402
+from session import set_current_user  # noqa: E402
+
+
+@pytest.fixture(scope="session", autouse=True)
+def db():
+    models.init_db()
+    assert auth.login("admin", "admin")
+    yield models.engine
+    set_current_user(None)
+    models.engine.dispose()
@@ -0,0 +1,49 @@
+from sqlalchemy import create_engine, inspect, select, text
+
+import models
+import services
+from db import session_scope
+from models import AuditLog, FormulaRevision
+from session import as_user
+
+
+def test_headless_writes_are_audited_as_system():
+    with as_user(None):
+        rm_id = services.create_raw_material(name="Sin usuario", cost_per_g=0.1, inventory_g=10)
+        services.adjust_stock(rm_id, -5, "merma")
+        fid = services.create_formula("Fórmula sin usuario", "", [(rm_id, 1.0, None)])
+        rev_id = services.clone_revision(fid, "copia")
+    with session_scope() as s:
+        users = s.scalars(
+            select(AuditLog.user_id).where(
+                ((AuditLog.entity == "RawMaterial") & (AuditLog.entity_id == rm_id))
+                | ((AuditLog.entity == "Formula") & (AuditLog.entity_id == fid))
+            )
+        ).all()
+        assert len(users) == 3 and set(users) == {None}
+        assert s.get(FormulaRevision, rev_id).author == "sistema"
+
+
+def test_upgrade_drops_not_null_on_existing_db(tmp_path):
+    eng = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    with eng.begin() as conn:
+        conn.execute(
+            text(
+                "CREATE TABLE audit_logs (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, action VARCHAR(64), "
+                "entity VARCHAR(64), entity_id INTEGER, created_at DATETIME)"
+            )
+        )
+        conn.execute(text("CREATE INDEX ix_audit_logs_created_at ON audit_logs (created_at)"))
+        conn.execute(text("INSERT INTO audit_logs VALUES (1, 7, 'create', 'Formula', 3, '2024-01-01 00:00:00')"))
+    models._upgrade_schema(eng)
+    cols = {c["name"]: c for c in inspect(eng).get_columns("audit_logs")}
+    assert cols["user_id"]["nullable"]
+    with eng.begin() as conn:
+        assert conn.execute(text("SELECT user_id, action FROM audit_logs")).all() == [(7, "create")]
+        conn.execute(
+            text(
+                "INSERT INTO audit_logs (user_id, action, entity, entity_id, created_at) "
+                "VALUES (NULL, 'x', 'y', 1, '2024-01-02')"
+            )
+        )
+    eng.dispose()
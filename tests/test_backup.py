@@ -0,0 +1,30 @@
+import backup
+import events
+import services
+
+
+def _similar(fid):
+    return {s.name for s in services.similar_formulas(fid, k=50)}
+
+
+def test_restore_resets_in_process_state(tmp_path):
+    a = services.create_raw_material(name="Copia A", cost_per_g=1.0)
+    b = services.create_raw_material(name="Copia B", cost_per_g=2.0)
+    f = services.create_formula("Copia base", "", [(a, 5.0, None), (b, 5.0, None)])
+    snap = backup.take_snapshot(dest_dir=tmp_path).path
+
+    services.create_formula("Copia posterior", "", [(a, 5.0, None), (b, 4.0, None)])
+    assert "Copia posterior" in _similar(f)
+
+    seen = []
+    unsubscribe = events.subscribe(seen.append)
+    try:
+        backup.restore_snapshot(snap, safety_copy=False)
+    finally:
+        unsubscribe()
+    assert [ch.entity for ch in seen] == [events.EPOCH]
+
+    # la misma versión del índice que antes de restaurar (SQLite reutiliza el id), con otro contenido
+    services.create_formula("Copia tras restaurar", "", [(a, 5.0, None), (b, 6.0, None)])
+    assert _similar(f) == {"Copia tras restaurar"}
+    assert "Copia posterior" not in {fo.name for fo in services.list_formulas()}
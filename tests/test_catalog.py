@@ -0,0 +1,52 @@
+import pytest
+from sqlalchemy import create_engine, text
+
+import events
+import models
+import services
+from catalog import catalog
+
+
+@pytest.fixture
+def other_process():
+    """Conexión propia, sin el bus de events de este proceso (como la CLI o jobs)."""
+    eng = create_engine(models.DB_URL)
+    yield eng
+    eng.dispose()
+
+
+def test_sees_writes_from_other_processes(other_process):
+    rm_id = services.create_raw_material(name="Catálogo externo", cost_per_g=1.0, inventory_g=0)
+    fid = services.create_formula("Catálogo externo", "", [(rm_id, 2.0, None)])
+    mats = catalog.materials()
+    comp = catalog.composition()
+    assert mats.cost_per_g[mats.row[rm_id]] == 1.0
+
+    with other_process.begin() as conn:
+        conn.execute(text("UPDATE raw_materials SET cost_per_g = 3.0 WHERE id = :i"), {"i": rm_id})
+        rev = conn.execute(
+            text(
+                "INSERT INTO formula_revisions (formula_id, number, created_at, author) "
+                "VALUES (:f, 2, CURRENT_TIMESTAMP, 'cli') RETURNING id"
+            ),
+            {"f": fid},
+        ).scalar()
+        conn.execute(
+            text("INSERT INTO formula_entries (revision_id, raw_material_id, weight_g) VALUES (:r, :m, 5.0)"),
+            {"r": rev, "m": rm_id},
+        )
+        events._bump(conn, ["RawMaterial", "Formula"])
+
+    mats = catalog.materials()
+    assert mats.cost_per_g[mats.row[rm_id]] == 3.0
+    comp = catalog.composition(i for i in [fid])  # un generador se recorre una sola vez
+    assert comp.revision_ids.tolist() == [rev]
+    assert comp.weights.sum() == 5.0
+
+
+def test_page_matches_its_sort_order():
+    for i, cost in enumerate((0.3, 0.1, 0.2)):
+        services.create_raw_material(name=f"Página {i}", category="Página", cost_per_g=cost, inventory_g=0)
+    flt = services.MaterialFilter(category="Página")
+    page = services.page_materials(flt, order_by="cost_per_g")
+    assert [m.cost_per_g for m in page] == [0.1, 0.2, 0.3]
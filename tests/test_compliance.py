@@ -0,0 +1,20 @@
+import services
+
+
+def test_zero_limit_prohibits_and_none_does_not():
+    banned = services.create_raw_material(name="IFRA prohibida", cost_per_g=1.0, ifra_limit_pct=0.0)
+    free = services.create_raw_material(name="IFRA sin límite", cost_per_g=1.0, ifra_limit_pct=None)
+    fid = services.create_formula("IFRA cero", "", [(banned, 0.1, None), (free, 99.9, None)])
+
+    (v,) = services.ifra_violations([fid])
+    assert (v.raw_material_id, v.limit_pct, v.product_category) == (banned, 0.0, "")
+    assert v.concentration_pct == 0.1
+
+
+def test_violations_sorted_by_formula_then_material():
+    a = services.create_raw_material(name="IFRA orden b", cost_per_g=1.0, ifra_limit_pct=1.0)
+    b = services.create_raw_material(name="IFRA orden a", cost_per_g=1.0, ifra_limit_pct=1.0)
+    f2 = services.create_formula("IFRA orden 2", "", [(a, 50.0, None), (b, 50.0, None)])
+    f1 = services.create_formula("IFRA orden 1", "", [(a, 50.0, None), (b, 50.0, None)])
+    got = [(v.formula_name, v.material_name) for v in services.ifra_violations([f1, f2])]
+    assert got == sorted(got) and len(got) == 4
@@ -0,0 +1,75 @@
+import threading
+
+from sqlalchemy import func, select
+
+import services
+from db import session_scope
+from models import InventoryMovement, RawMaterial
+from session import as_user, current_user
+
+WRITERS = READERS = 4
+ADJUSTMENTS = 25
+
+
+def _run(targets):
+    errors = []
+
+    def guard(fn):
+        def run():
+            try:
+                fn()
+            except Exception as e:  # se comprueban al final, en el hilo principal
+                errors.append(e)
+
+        return run
+
+    threads = [threading.Thread(target=guard(fn)) for fn in targets]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(timeout=120)
+    assert not any(t.is_alive() for t in threads)
+    return errors
+
+
+def _snapshot(rm_id):
+    """Stock y nº de movimientos en una sola consulta (pysqlite no abre transacción al leer)."""
+    n = select(func.count()).where(InventoryMovement.raw_material_id == rm_id).scalar_subquery()
+    with session_scope() as s:
+        return tuple(s.execute(select(RawMaterial.inventory_g, n).where(RawMaterial.id == rm_id)).one())
+
+
+def test_writers_and_readers():
+    user = current_user()
+    rm_id = services.create_raw_material(name="Concurrencia", cost_per_g=0.1, inventory_g=0)
+    done = threading.Event()
+    seen = []
+
+    def write():
+        with as_user(user):
+            for _ in range(ADJUSTMENTS):
+                services.adjust_stock(rm_id, 1.0, "prueba")
+
+    def read():
+        last = 0
+        while not done.is_set():
+            inv, n = _snapshot(rm_id)
+            assert inv == n  # cada movimiento suma 1 g: nunca una escritura a medias
+            assert n >= last  # ni una lectura que vuelva atrás
+            last = n
+            services.list_materials()
+        seen.append(last)
+
+    readers = [read] * READERS
+    writers = [write] * WRITERS
+
+    def writers_then_stop():
+        try:
+            assert not _run(writers)
+        finally:
+            done.set()
+
+    errors = _run(readers + [writers_then_stop])
+    assert not errors, errors
+    assert _snapshot(rm_id) == (WRITERS * ADJUSTMENTS, WRITERS * ADJUSTMENTS)
+    assert len(seen) == READERS
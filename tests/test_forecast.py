@@ -0,0 +1,23 @@
+import pytest
+
+import services
+from models import MovementKind
+
+
+def test_only_consumption_counts(tmp_path):
+    rm = services.create_raw_material(name="Previsión", cost_per_g=0.1, inventory_g=1000)
+    services.adjust_stock(rm, -300, "merma")  # ajuste manual
+    count = tmp_path / "recuento.csv"
+    count.write_text(f"raw_material_id,counted_g\n{rm},500\n", encoding="utf-8")
+    services.apply_stocktake(count)  # -200 g de recuento
+    assert services.stock_forecast([rm]) == []
+
+    services.adjust_stock(rm, -60, "lote 1", kind=MovementKind.CONSUMPTION)
+    (fc,) = services.stock_forecast([rm])
+    assert fc.rate_g_day == pytest.approx(60 / 30)
+    assert fc.inventory_g == pytest.approx(440)
+
+
+def test_recent_days_within_window():
+    with pytest.raises(ValueError):
+        services.stock_forecast(window_days=5)  # RECENT_DAYS = 7
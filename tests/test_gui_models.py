@@ -0,0 +1,77 @@
+import os
+
+import pytest
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+QtWidgets = pytest.importorskip("PyQt5.QtWidgets")
+from PyQt5 import sip  # noqa: E402
+from PyQt5.QtCore import Qt  # noqa: E402
+from PyQt5.QtTest import QAbstractItemModelTester  # noqa: E402
+
+import services  # noqa: E402
+
+
+@pytest.fixture(scope="module")
+def app():
+    return QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+
+
+@pytest.fixture
+def tab(app):
+    import gui
+
+    tab = gui.RmTab(None)
+    # comprueba la coherencia de cada señal que emite el modelo
+    tab._tester = QAbstractItemModelTester(tab.model, QAbstractItemModelTester.FailureReportingMode.Fatal)
+    tab.chk_low.setChecked(True)  # solo stock bajo: ajustar el stock saca filas del filtro
+    tab.table.sortByColumn(tab.model._headers.index("inventory_g"), Qt.AscendingOrder)
+    yield tab
+    sip.delete(tab)  # destroyed → se da de baja del bus de events
+
+
+def _signals(model):
+    seen = []
+    model.rowsInserted.connect(lambda _p, a, b: seen.append(("insert", a, b)))
+    model.rowsRemoved.connect(lambda _p, a, b: seen.append(("remove", a, b)))
+    model.modelReset.connect(lambda: seen.append("reset"))
+    return seen
+
+
+def _ids(model):
+    return [model.id_at(r) for r in range(model.rowCount())]
+
+
+def _selected(tab):
+    return [tab.model.id_at(ix.row()) for ix in tab.table.selectionModel().selectedRows()]
+
+
+def test_row_level_updates_follow_sort_filter_and_keep_selection(app, tab):
+    kw = dict(category="Tabla GUI", low_stock_threshold_g=100)
+    a = services.create_raw_material(name="GUI a", inventory_g=10, **kw)
+    b = services.create_raw_material(name="GUI b", inventory_g=20, **kw)
+    c = services.create_raw_material(name="GUI c", inventory_g=30, **kw)
+    app.processEvents()
+    m = tab.model
+    assert [i for i in _ids(m) if i in (a, b, c)] == [a, b, c]
+    tab.table.selectRow(m.row_of(b))
+    seen = _signals(m)
+    row_a = m.row_of(a)
+
+    services.adjust_stock(a, 25, "prueba")  # 35 g: pasa detrás de c
+    app.processEvents()
+    assert [i for i in _ids(m) if i in (a, b, c)] == [b, c, a]
+    assert seen == [("remove", row_a, row_a), ("insert", m.row_of(a), m.row_of(a))]
+    assert _selected(tab) == [b]
+
+    seen.clear()
+    services.adjust_stock(b, 500, "prueba")  # ya no tiene stock bajo
+    app.processEvents()
+    assert b not in _ids(m)
+    assert [s[0] for s in seen] == ["remove"]
+
+    seen.clear()
+    d = services.create_raw_material(name="GUI d", inventory_g=32, **kw)
+    app.processEvents()
+    assert [i for i in _ids(m) if i in (a, c, d)] == [c, d, a]
+    assert seen == [("insert", m.row_of(d), m.row_of(d))]
+    assert m.item(m.row_of(d)).name == "GUI d"
@@ -0,0 +1,28 @@
+import db
+import services
+
+
+def test_import_formulas_one_writer_job_per_chunk(tmp_path, monkeypatch):
+    services.create_raw_material(name="Import A", cost_per_g=0.1, inventory_g=0)
+    services.create_raw_material(name="Import B", cost_per_g=0.2, inventory_g=0)
+    path = tmp_path / "formulas.csv"
+    path.write_text(
+        "formula,revision,material,weight_g,dilution\n"
+        "Imp 1,1,Import A,10,\n"
+        "Imp 1,1,Import B,5,10%\n"
+        "Imp 2,1,Import A,3,\n"
+        "Imp 3,1,Import X,3,\n"
+        "Imp 4,1,Import B,2,\n",
+        encoding="utf-8",
+    )
+    jobs = []
+    submit = db.write_queue.submit
+
+    def counting(fn, *args, **kwargs):
+        jobs.append(fn.__name__)
+        return submit(fn, *args, **kwargs)
+
+    monkeypatch.setattr(db.write_queue, "submit", counting)
+    res = services.import_formulas_csv(path, chunk=1)
+    assert res["formulas"] == 3 and res["entries"] == 4 and len(res["rejected"]) == 1
+    assert jobs == ["_insert_formula_batch"] * 4  # uno por bloque, no uno para todo el fichero
@@ -0,0 +1,18 @@
+import math
+
+import pytest
+
+import services
+
+
+def test_simulate_price_change_rejects_invalid_prices():
+    rm = services.create_raw_material(name="Pricing check", category="test", cost_per_g=0.2)
+    services.create_formula("Pricing formula", "", [(rm, 10.0, "TOP")])
+
+    (imp,) = services.simulate_price_change({rm: 0.3})
+    assert imp.new_cost == pytest.approx(3.0)
+    for bad in (math.nan, math.inf, -0.1):
+        with pytest.raises(ValueError):
+            services.simulate_price_change({rm: bad})
+        with pytest.raises(ValueError):
+            services.simulate_price_change({rm: bad}, all_revisions=True)
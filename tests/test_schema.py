@@ -0,0 +1,23 @@
+from sqlalchemy import create_engine, text
+
+import models
+
+
+def test_upgrade_adds_boolean_column_with_default(tmp_path):
+    eng = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    with eng.begin() as conn:
+        conn.execute(
+            text(
+                "CREATE TABLE inventory_movements (id INTEGER PRIMARY KEY, raw_material_id INTEGER NOT NULL, "
+                "delta_g FLOAT NOT NULL, description VARCHAR(200), created_at DATETIME NOT NULL)"
+            )
+        )
+        conn.execute(text("INSERT INTO inventory_movements VALUES (1, 1, -5, 'x', '2024-01-01 00:00:00')"))
+    models._upgrade_schema(eng)
+    with eng.begin() as conn:
+        assert conn.execute(text("SELECT opening_balance FROM inventory_movements")).scalar() == 0
+        conn.execute(
+            text("INSERT INTO inventory_movements (raw_material_id, delta_g, created_at) VALUES (1, 2, '2024-01-02')")
+        )
+        assert conn.execute(text("SELECT count(*) FROM inventory_movements WHERE opening_balance = 0")).scalar() == 2
+    eng.dispose()
@@ -0,0 +1,23 @@
+import services
+import similarity
+from db import session_scope
+
+
+def test_duplicate_pairs_same_result_with_small_blocks(monkeypatch):
+    common = services.create_raw_material(name="Dup común", cost_per_g=1.0)
+    rare = [services.create_raw_material(name=f"Dup rara {i}", cost_per_g=1.0) for i in range(3)]
+    for i in range(12):  # todas comparten la materia común: producto casi denso
+        services.create_formula(f"Dup {i}", "", [(common, 50.0, None), (rare[i % 3], 50.0, None)])
+
+    with session_scope() as s:
+        full = similarity.duplicate_pairs(s)
+        monkeypatch.setattr(similarity, "_DUP_BUDGET", 5)
+        _, m = similarity._index.matrix(s)
+        blocks = list(similarity._dup_blocks(m))
+        small = similarity.duplicate_pairs(s)
+
+    assert len(blocks) > 1 and blocks[0][0] == 0 and blocks[-1][1] == m.shape[0]
+    assert all(lo < hi for lo, hi in blocks)
+    key = lambda p: (p.formula_a_id, p.formula_b_id)  # noqa: E731
+    assert sorted(map(key, small)) == sorted(map(key, full))
+    assert sum(p.formula_a.startswith("Dup ") for p in full) == 3 * 6  # 4 fórmulas iguales por materia rara
@@ -0,0 +1,69 @@
+import pytest
+from sqlalchemy import select
+
+import services
+from db import session_scope
+from models import FormulaEntry, FormulaRevision
+
+
+def _material(name, cost):
+    return services.create_raw_material(name=name, cost_per_g=cost, inventory_g=1000)
+
+
+def _entries(formula_id):
+    """Entradas de la última revisión: {materia: (gramos, dilución)}."""
+    with session_scope() as s:
+        rev = s.scalar(
+            select(FormulaRevision)
+            .where(FormulaRevision.formula_id == formula_id)
+            .order_by(FormulaRevision.number.desc())
+            .limit(1)
+        )
+        rows = s.execute(
+            select(FormulaEntry.raw_material_id, FormulaEntry.weight_g, FormulaEntry.dilution).where(
+                FormulaEntry.revision_id == rev.id
+            )
+        )
+        return rev.number, {rm: (w, dil) for rm, w, dil in rows}
+
+
+@pytest.fixture
+def mats(request):
+    tag = request.node.name
+    return _material(f"Lilial {tag}", 0.2), _material(f"Florhydral {tag}", 0.5), _material(f"Hedione {tag}", 0.1)
+
+
+def test_replaces_material(mats):
+    old, new, other = mats
+    fid = services.create_formula("Sust simple", "", [(old, 10, None), (other, 5, None)])
+    res = services.substitute_material(old, new, ratio=0.8)
+    assert res.applied and not res.skipped
+    assert [i.formula_id for i in res.impacts] == [fid]
+    assert res.impacts[0].new_cost == pytest.approx(10 * 0.8 * 0.5 + 5 * 0.1)
+    number, entries = _entries(fid)
+    assert number == 2
+    assert entries == {new: (pytest.approx(8.0), None), other: (5.0, None)}
+
+
+def test_merges_into_existing_entry_with_same_dilution(mats):
+    old, new, other = mats
+    fid = services.create_formula("Sust fusión", "", [(old, 10, "10%"), (new, 4, "10%"), (other, 5, None)])
+    res = services.substitute_material(old, new, ratio=0.5)
+    assert [i.formula_id for i in res.impacts] == [fid] and not res.skipped
+    assert res.impacts[0].new_cost == pytest.approx((4 + 5) * 0.5 + 5 * 0.1)
+    _, entries = _entries(fid)
+    assert entries == {new: (pytest.approx(9.0), "10%"), other: (5.0, None)}
+
+
+def test_skips_formula_with_other_dilution(mats):
+    old, new, other = mats
+    fid = services.create_formula("Sust omitida", "", [(old, 10, "10%"), (new, 4, None), (other, 5, None)])
+    plain = services.create_formula("Sust normal", "", [(old, 2, None)])
+    res = services.substitute_material(old, new)
+    assert [k.formula_id for k in res.skipped] == [fid]
+    assert [i.formula_id for i in res.impacts] == [plain]
+    number, entries = _entries(fid)
+    assert number == 1 and len(entries) == 3
+
+    dry = services.substitute_material(old, new, dry_run=True)
+    assert [k.formula_id for k in dry.skipped] == [fid] and not dry.impacts and not dry.applied